@@ -0,0 +1,669 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from qgis.PyQt.QtCore import pyqtSignal
+from qgis.core import QgsTask
+
+from .httpcall import RequestsExceptionHostUnavailable
+from .httpcall import RequestsExceptionUserAbort
+from .save_ckan_to_sqlite import save_ckan_packages_to_sqlite
+from .save_ckan_to_sqlite import save_ckan_groups_to_sqlite
+from .save_ckan_to_sqlite import get_sync_state
+from .save_ckan_to_sqlite import update_sync_state
+from .save_ckan_to_sqlite import get_cached_package_ids
+from .save_ckan_to_sqlite import delete_packages
+from .save_ckan_to_sqlite import get_harvest_checkpoint
+from .save_ckan_to_sqlite import start_harvest_checkpoint
+from .save_ckan_to_sqlite import update_harvest_checkpoint
+from .save_ckan_to_sqlite import clear_harvest_checkpoint
+from .save_ckan_to_sqlite import staging_db_path
+from .save_ckan_to_sqlite import create_staging_db
+from .save_ckan_to_sqlite import swap_staging_db
+
+
+def _solr_date(value):
+    """
+    CKANのmetadata_modified（例: 2024-01-02T03:04:05.678901）をSolrの日付形式に変換する
+    Solrはミリ秒までなので切り捨てる（範囲は[X TO *]で境界を含むため取りこぼしは無い）
+    """
+    if not value:
+        return None
+    value = value.rstrip('Z')
+    if '.' in value:
+        base, frac = value.split('.', 1)
+        value = u'{0}.{1}'.format(base, frac[:3])
+    return value + 'Z'
+
+
+# 軽量プロファイルで要求する項目（CKANのSolrインデックスの格納フィールド名）
+# リソースはres_name/res_format/res_urlの並列リストとして返る
+LIGHT_FIELDS = (
+    'id', 'name', 'title', 'notes', 'author', 'author_email', 'maintainer', 'maintainer_email',
+    'license_id', 'organization', 'groups', 'tags', 'metadata_modified',
+    'res_name', 'res_format', 'res_url',
+)
+
+
+def resource_key(package_id, url):
+    """
+    リソースを識別する短いキー（パッケージIDとURLのハッシュ）
+    軽量・完全どちらのプロファイルで取得しても同じ値になり、ファイル名にそのまま使える
+    """
+    return hashlib.sha1(u'{0}\n{1}'.format(package_id or '', url or '').encode('utf-8')).hexdigest()[:12]
+
+
+def expand_projected_package(doc):
+    """
+    fl指定のpackage_searchが返すSolrドキュメントを、通常のパッケージdictと同じ形に組み立てる
+    詳細（extrasやリソースの全項目）は含まないため'_partial'を付け、表示時にpackage_showで補う
+    flに対応していない古いCKANは完全なパッケージを返すので、そのまま返す
+    """
+    if 'resources' in doc:
+        return doc
+    pkg = {key: value for key, value in doc.items() if not key.startswith('res_')}
+    org = doc.get('organization')
+    pkg['organization'] = {'name': org} if isinstance(org, str) and org else None
+    pkg['groups'] = [{'name': group} for group in doc.get('groups') or [] if isinstance(group, str)]
+    pkg['tags'] = [{'name': tag} for tag in doc.get('tags') or [] if isinstance(tag, str)]
+    urls = doc.get('res_url') or []
+    names = doc.get('res_name') or []
+    formats = doc.get('res_format') or []
+    resources = []
+    for i, url in enumerate(urls):
+        resources.append({
+            # リソースIDはSolrに格納されていないため仮のIDを振る（完全な情報の取得時に置き換わる）
+            # 同じURLのリソースが複数あっても重ならないよう順番を付ける
+            'id': u'{0}-{1}'.format(resource_key(doc.get('id'), url), i),
+            'url': url,
+            'name': names[i] if i < len(names) else '',
+            'format': formats[i] if i < len(formats) else '',
+        })
+    pkg['resources'] = resources
+    pkg['_partial'] = True
+    return pkg
+
+
+class _CheckpointTracker:
+    """
+    取得したページ（シャード, start）とSQLiteへの書き込み件数を突き合わせ、
+    書き込みがコミットされたページまでシャードごとの再開オフセットを進める
+    ページは完了順が前後するため、オフセットは先頭から連続して書き込み済みの位置までとする
+    """
+
+    def __init__(self, db_path, server_url, shards):
+        self.db_path = db_path
+        self.server_url = server_url
+        self.next_offset = {shard: start for shard, start, total in shards}
+        self.totals = {shard: total for shard, start, total in shards}
+        # 書き込み待ちのページ: (累計件数, シャード, start, ページの範囲)
+        self.pending = deque()
+        # 書き込み済みでまだ連続していないページ: シャード -> {start: 次のstart}
+        self.done = {}
+        self.fetched_count = 0
+
+    def set_total(self, shard, total):
+        self.totals[shard] = total
+
+    def fetched(self, shard, start, rows, count):
+        self.fetched_count += count
+        self.pending.append((self.fetched_count, shard, start, rows))
+
+    def saved(self, saved_count):
+        """save_ckan_packages_to_sqliteのバッチコミットごとに呼ばれる"""
+        changed = set()
+        while self.pending and self.pending[0][0] <= saved_count:
+            _, shard, start, rows = self.pending.popleft()
+            self.done.setdefault(shard, {})[start] = start + rows
+            changed.add(shard)
+        for shard in changed:
+            done = self.done[shard]
+            offset = self.next_offset.get(shard, 0)
+            while offset in done:
+                offset = done.pop(offset)
+            total = self.totals.get(shard)
+            if total is not None:
+                offset = min(offset, total)
+            self.next_offset[shard] = offset
+            update_harvest_checkpoint(self.db_path, self.server_url, shard, offset, total)
+
+
+class _PageSizer:
+    """
+    package_searchのページサイズ（rows）を調整する
+    応答が遅い・大きいときは半分にし、十分速く小さいときは1.5倍にする（上限はサーバーの実際の上限件数）
+    """
+
+    def __init__(self, rows, min_rows, target_seconds, max_bytes):
+        self.rows = rows
+        self.max_rows = rows
+        self.min_rows = min_rows
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+
+    def observe(self, requested, returned, elapsed, nbytes, capped):
+        if capped and returned > 0:
+            # サーバー側のrows上限を検出
+            self.max_rows = min(self.max_rows, returned)
+            self.rows = min(self.rows, self.max_rows)
+        if elapsed > self.target_seconds or nbytes > self.max_bytes:
+            self.rows = min(self.max_rows, max(self.min_rows, self.rows // 2))
+        elif returned >= requested and elapsed < self.target_seconds / 4 and nbytes < self.max_bytes / 4:
+            self.rows = min(self.max_rows, int(self.rows * 1.5))
+
+    def failed(self):
+        self.rows = min(self.max_rows, max(self.min_rows, self.rows // 2))
+
+
+class CkanHarvester:
+    """
+    CKANカタログをpackage_searchでページング取得し、SQLiteキャッシュに保存する
+    前回同期時のmetadata_modifiedの最大値が記録されていれば、それ以降に更新されたものだけを取得する
+    取得中はキャッシュDBの複製（ステージングDB）に書き込み、完了時にまとめてキャッシュDBへ反映する
+    """
+
+    # ページサイズの初期値・上限（CKANのckan.search.rows_maxの既定値）と下限
+    ROWS_PER_PAGE = 1000
+    MIN_ROWS_PER_PAGE = 50
+    # 1ページの受信サイズの目安（これを超えるとページサイズを小さくする）
+    MAX_PAGE_BYTES = 16 * 1024 * 1024
+    # 削除検出用のID一覧はペイロードが小さいので大きめのページで取得する
+    ID_ROWS_PER_PAGE = 1000
+    # 'auto'でシャード分割に切り替える件数（これを超えると深いstartのページングが遅くなる）
+    SHARD_THRESHOLD = 10000
+
+    def __init__(self, settings, util, cc, db_path):
+        self.settings = settings
+        self.util = util
+        self.cc = cc
+        # 検索が読むキャッシュDBと、取得中の書き込み先
+        self.cache_path = db_path
+        self.db_path = staging_db_path(db_path)
+        self.server_url = getattr(settings, 'ckan_url', '') or ''
+        # 進捗表示用（受信バイト数）
+        self.bytes_received = 0
+        # 中断されたか（HarvestTaskが設定する。遮断中のホストを待つ間の確認に使う）
+        self.cancel_check = None
+        # ページ取得を打ち切った後は、遮断明けを待っているワーカーも待たずに終える
+        self._stopping = False
+
+    def harvest(self, progress_callback=None, force_full=False, groups=None):
+        """
+        カタログを取得してキャッシュを更新する
+        progress_callback(page, max_page, results): ページ取得ごとに呼ばれ、Falseを返すと中断する
+        force_full: Trueなら同期状態・チェックポイントを無視して全件取得する
+        groups: 取得済みのカテゴリ一覧（指定時は反映前にgroupsテーブルも更新する）
+        戻り値: (ok, 結果dict またはエラーメッセージ)
+        結果dict: {'mode': 'full'|'delta', 'packages': 件数, 'completed': bool, 'resumed': bool, 'deleted': 削除件数, 'stats': 書き込み統計}
+        取得したページはその場でSQLiteに書き込み、パッケージ本体は保持しない（メモリ使用量はおよそ数ページ分）
+        中断・失敗した場合はシャードごとの書き込み済みオフセットを記録し、次回はその続きから取得する
+        キャッシュDBは完了時にだけ置き換わるため、中断・失敗してもそれまでの内容がそのまま残る
+        """
+        checkpoint = None
+        discarded = False
+        if not force_full and os.path.exists(self.db_path):
+            # 中断したステージングDBが残っていればそのまま続きを書き込む
+            checkpoint, discarded = self._resumable_checkpoint()
+        if checkpoint is None:
+            # 再開しない場合は、途中まで書き込んだステージングDBを捨てて作り直す
+            create_staging_db(self.cache_path)
+            if force_full:
+                clear_harvest_checkpoint(self.db_path, self.server_url)
+            else:
+                checkpoint, stale = self._resumable_checkpoint()
+                discarded = discarded or stale
+
+        if checkpoint is not None:
+            # 前回中断した取得を同じ条件（モード・ハイウォーターマーク・シャード）で再開する
+            mode = checkpoint['mode']
+            high_water_mark = checkpoint['high_water_mark']
+            fq = self._harvest_fq(high_water_mark)
+            shards = checkpoint['shards']
+            self.util.msg_log_debug(u'中断したカタログ取得を再開します（{0}開始, {1}シャード）'.format(checkpoint['started'], len(shards)))
+        else:
+            high_water_mark = None
+            # 条件の違うチェックポイントを破棄した場合も全件取得する
+            sync = None if force_full or discarded else get_sync_state(self.db_path, self.server_url)
+            if sync and sync.get('high_water_mark'):
+                if (sync.get('harvest_filter') or '') == (self._profile_fq() or ''):
+                    high_water_mark = sync['high_water_mark']
+                else:
+                    # 絞り込み条件が前回と違う場合、差分だけでは対象のデータセットが揃わないので全件取得する
+                    self.util.msg_log_debug(u'取得条件が変更されたため全件同期します')
+            mode = 'delta' if high_water_mark else 'full'
+            fq = self._harvest_fq(high_water_mark)
+            if high_water_mark:
+                self.util.msg_log_debug(u'差分同期: {0} 以降に更新されたデータセットを取得します'.format(_solr_date(high_water_mark)))
+            else:
+                self.util.msg_log_debug(u'全件同期: カタログ全体を取得します')
+            shard_fqs = self._resolve_shards(fq)
+            start_harvest_checkpoint(self.db_path, self.server_url, mode, high_water_mark, shard_fqs, self._profile_fq())
+            shards = [(shard, 0, None) for shard in shard_fqs]
+
+        state = {'completed': False, 'error': None, 'count': 0, 'ids': set(), 'expected': 0}
+        tracker = _CheckpointTracker(self.db_path, self.server_url, shards)
+        pages = self._iter_pages(shards, progress_callback, state, tracker)
+        stats = save_ckan_packages_to_sqlite(
+            self.db_path, pages, self.settings.search_tokenizer,
+            batch_size=self.ROWS_PER_PAGE, progress_callback=tracker.saved
+        )
+        package_count = state['count']
+        completed = state['completed']
+        error = state['error']
+        if not package_count:
+            stats = None
+        # 途中で中断・失敗した場合はハイウォーターマークを進めない（次回チェックポイントから再開する）
+        deleted = 0
+        if completed:
+            # 取得中に更新されたデータセットはオフセットがずれて取りこぼすことがある
+            fetched_all = len(state['ids']) == state['expected']
+            if not fetched_all:
+                self.util.msg_log_warning(
+                    u'取得したID数がサーバーの件数と一致しません ({0}/{1})'.format(len(state['ids']), state['expected'])
+                )
+            # 全件取得時は取得したIDで、差分取得・再開時はID一覧を別途取得して削除を検出する
+            # （ID数が一致しない場合もID一覧を取得し直し、取りこぼしたものを削除扱いにしない）
+            server_ids = state['ids'] if mode == 'full' and checkpoint is None and fetched_all else None
+            ok, deleted = self.reconcile(server_ids)
+            if not ok:
+                self.util.msg_log_error(u'削除検出に失敗: {0}'.format(deleted))
+                deleted = 0
+            # 取りこぼしがあれば、その範囲を次回も取得するようハイウォーターマークは進めない
+            update_sync_state(
+                self.db_path, self.server_url, full_sync=(mode == 'full'), harvest_filter=self._profile_fq(),
+                advance=len(state['ids']) >= state['expected']
+            )
+            clear_harvest_checkpoint(self.db_path, self.server_url)
+            if groups is not None:
+                save_ckan_groups_to_sqlite(self.db_path, groups)
+            swap_staging_db(self.cache_path)
+            self.util.msg_log_debug(u'キャッシュDBを更新しました: {0}'.format(self.cache_path))
+        elif error is not None and not package_count:
+            return False, error
+        return True, {
+            'mode': mode,
+            'packages': package_count,
+            'completed': completed,
+            'resumed': checkpoint is not None,
+            'deleted': deleted,
+            'error': error,
+            'stats': stats,
+        }
+
+    def _resumable_checkpoint(self):
+        """
+        再開できるチェックポイントを返す
+        シャードのfqには開始時の絞り込み条件が含まれるため、条件が変わっていれば再開しない
+        （古い条件のまま続けると、現在の条件で記録した同期状態と内容が食い違う）
+        戻り値: (チェックポイント または None, 条件の違うチェックポイントを破棄したか)
+        """
+        checkpoint = get_harvest_checkpoint(self.db_path, self.server_url)
+        if checkpoint is None:
+            return None, False
+        if (checkpoint.get('harvest_filter') or '') != (self._profile_fq() or ''):
+            self.util.msg_log_debug(u'取得条件が変更されたため、中断したカタログ取得を破棄して全件同期します')
+            return None, True
+        return checkpoint, False
+
+    def _harvest_fq(self, high_water_mark):
+        """取得条件のfq（取得プロファイルの絞り込み＋差分同期の範囲）"""
+        conditions = []
+        profile_fq = self._profile_fq()
+        if profile_fq:
+            conditions.append(profile_fq)
+        if high_water_mark:
+            conditions.append(u'metadata_modified:[{0} TO *]'.format(_solr_date(high_water_mark)))
+        if not conditions:
+            return None
+        return u' AND '.join(conditions)
+
+    def _profile_fq(self):
+        """
+        harvest_geo_onlyが有効なら、地理空間データ形式のリソースを持つデータセットに絞るfq
+        res_formatは大文字小文字を区別するため、設定値・大文字・小文字のすべてを条件にする
+        """
+        if not getattr(self.settings, 'harvest_geo_only', False):
+            return None
+        formats = []
+        for fmt in (getattr(self.settings, 'harvest_geo_formats', '') or '').split(','):
+            fmt = fmt.strip().replace('"', '')
+            for variant in (fmt, fmt.upper(), fmt.lower()):
+                if variant and variant not in formats:
+                    formats.append(variant)
+        if not formats:
+            return None
+        return u'res_format:({0})'.format(u' OR '.join(u'"{0}"'.format(fmt) for fmt in formats))
+
+    def _search_page(self, start, rows, fq):
+        """
+        1ページ分のpackage_search（ワーカースレッドから呼ばれる）
+        harvest_profileが'light'なら必要な項目だけをflで要求する
+        """
+        fl = None
+        if getattr(self.settings, 'harvest_profile', 'light') == 'light':
+            fl = ','.join(LIGHT_FIELDS)
+        ok, result = self.cc.package_search('', None, None, rows=rows, start=start, fq=fq, sort='metadata_modified asc', fl=fl)
+        if ok and fl and isinstance(result, dict) and 'results' in result:
+            result['results'] = [expand_projected_package(doc) for doc in result['results']]
+        return ok, result
+
+    def _resolve_shards(self, fq):
+        """
+        設定harvest_shard_strategyに従ってシャード（fq条件）のリストを決める
+        'auto'の場合は件数がSHARD_THRESHOLDを超えるときだけIDの先頭文字で分割する
+        """
+        strategy = getattr(self.settings, 'harvest_shard_strategy', 'auto') or 'none'
+        if strategy == 'auto':
+            ok, result = self.cc.package_search('', None, None, rows=0, start=0, fq=fq)
+            if not ok or result.get('count', 0) <= self.SHARD_THRESHOLD:
+                return [fq]
+            strategy = 'id_prefix'
+        if strategy not in self.cc.SHARD_STRATEGIES:
+            return [fq]
+        ok, shards = self.cc.get_harvest_shards(strategy, fq)
+        if not ok or not shards:
+            self.util.msg_log_warning(u'シャード分割に失敗したため分割せずに取得します: {0}'.format(shards))
+            return [fq]
+        return shards
+
+    def _timed_search_page(self, start, rows, fq, delay=0.0):
+        # 遮断中のホストは、遮断が明けるまで待ってから送る
+        if delay and not self._sleep(delay):
+            return False, RequestsExceptionUserAbort('Cancelled'), 0.0
+        started = time.monotonic()
+        ok, result = self._search_page(start, rows, fq)
+        return ok, result, time.monotonic() - started
+
+    def _sleep(self, seconds):
+        """中断を確認しながら待つ（中断されたらFalse）"""
+        deadline = time.monotonic() + seconds
+        while True:
+            if self._stopping or (self.cancel_check is not None and self.cancel_check()):
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(1.0, remaining))
+
+    def _iter_pages(self, shards, progress_callback, state, tracker):
+        """
+        各シャードの先頭ページ（start=0、再開時は書き込み済みオフセット）でcountを取得し、続きのページを順に投入する
+        ワーカーはharvest_concurrency並列で、シャードをまたいで同時に実行する
+        ページサイズは_PageSizerが応答時間・受信サイズ・サーバーの上限件数に合わせて調整する
+        サーバーが要求より少ない件数しか返さなかった場合は、欠けた範囲を取り直す
+        取得に失敗したページはページサイズを半分にして取り直す（最小ページサイズでも失敗したらエラー）
+        ホストが遮断中（HostHealth）で送れなかったページは分割せず、遮断が明けてから同じページを取り直す
+        （1ページあたりの待ち時間の合計がharvest_host_waitを超えたらエラーとして取得を打ち切る）
+        取得できたページから順にパッケージを返すジェネレータ（呼び出し側でそのままSQLiteに書き込む）
+        未処理のページが溜まらないよう、投入済み（取得中・取得済み未書き込み）のページはworkers*2件までに抑える
+        shards: (fq, 開始オフセット, 件数) のリスト（取得済みのシャードは件数＝開始オフセット）
+        state: completed / error / count / ids / expected（今回取得するはずの件数: シャードごとのcount－開始オフセット）を書き戻す
+        tracker: 取得したページを記録し、書き込み完了後にチェックポイントを進める
+        """
+        sizer = _PageSizer(
+            self.ROWS_PER_PAGE, self.MIN_ROWS_PER_PAGE,
+            target_seconds=max(1.0, (getattr(self.settings, 'request_timeout', 15) or 15) / 3.0),
+            max_bytes=self.MAX_PAGE_BYTES
+        )
+        workers = max(1, int(getattr(self.settings, 'harvest_concurrency', 4) or 1))
+        max_in_flight = workers * 2
+        self.util.msg_log_debug(u'並列取得: {0}シャードを{1}並列で取得します'.format(len(shards), workers))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        self._stopping = False
+        cancelled = False
+        host_down = False
+        host_wait = max(0, int(getattr(self.settings, 'harvest_host_wait', 300) or 0))
+        page = 0
+        # 先頭ページ待ちのシャード、続きを投入中のシャード、取り直す範囲
+        first_pages = deque((shard, start) for shard, start, total in shards if total is None or start < total)
+        offsets = {shard: start for shard, start, total in shards}
+        active = deque()
+        gaps = deque()
+        cursors = {}
+        totals = {}
+        pending = {}
+        # ページごとの遮断明け待ちの累計秒数: (シャード, start) -> 秒
+        waited = {}
+
+        def _submit(shard, start, rows, first, delay=0.0):
+            future = executor.submit(self._timed_search_page, start, rows, shard, delay)
+            pending[future] = (shard, start, rows, first)
+
+        def _fill():
+            while len(pending) < max_in_flight:
+                if gaps:
+                    _submit(*gaps.popleft(), first=False)
+                elif first_pages:
+                    shard, start = first_pages.popleft()
+                    _submit(shard, start, sizer.rows, first=True)
+                elif active:
+                    shard = active.popleft()
+                    start = cursors[shard]
+                    rows = min(sizer.rows, totals[shard] - start)
+                    cursors[shard] = start + rows
+                    if cursors[shard] < totals[shard]:
+                        active.append(shard)
+                    _submit(shard, start, rows, first=False)
+                else:
+                    break
+
+        def _remaining_pages():
+            remaining = sum(totals[shard] - cursors[shard] for shard in active)
+            return len(pending) + len(gaps) + len(first_pages) + (remaining + sizer.rows - 1) // sizer.rows
+
+        try:
+            _fill()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard, start, rows, first = pending.pop(future)
+                    try:
+                        ok, page_result, elapsed = future.result()
+                    except Exception as e:
+                        ok, page_result, elapsed = False, str(e), 0.0
+                    if isinstance(page_result, RequestsExceptionUserAbort):
+                        cancelled = True
+                        break
+                    if isinstance(page_result, RequestsExceptionHostUnavailable):
+                        # 遮断中でリクエストを送っていないので、ページは分割せずに遮断が明けてから同じページを取り直す
+                        delay = max(1.0, page_result.retry_after)
+                        total_wait = waited.get((shard, start), 0.0) + delay
+                        if total_wait > host_wait:
+                            # ホストが回復しないので打ち切る（書き込み済みのページまではチェックポイントに残る）
+                            state['error'] = str(page_result)
+                            self.util.msg_log_error(
+                                u'サーバーが{0:.0f}秒以上回復しないため取得を中断します (fq={1}, start={2}): {3}'.format(
+                                    waited.get((shard, start), 0.0), shard, start, page_result
+                                )
+                            )
+                            host_down = True
+                            break
+                        waited[(shard, start)] = total_wait
+                        self.util.msg_log_warning(
+                            u'サーバーが一時的に遮断されているため{0:.0f}秒後に取り直します (fq={1}, start={2}): {3}'.format(
+                                delay, shard, start, page_result
+                            )
+                        )
+                        _submit(shard, start, rows, first, delay=delay)
+                        continue
+                    if not ok or 'results' not in page_result:
+                        error = page_result if not ok else self.util.tr(u'cc_invalid_json')
+                        if rows > self.MIN_ROWS_PER_PAGE:
+                            # タイムアウト等はページを小さくして取り直す
+                            sizer.failed()
+                            half = rows // 2
+                            self.util.msg_log_warning(
+                                u'package_search失敗 (fq={0}, start={1}, rows={2})、{3}件ずつ取り直します: {4}'.format(shard, start, rows, half, error)
+                            )
+                            if first:
+                                first_pages.appendleft((shard, start))
+                            else:
+                                gaps.append((shard, start, half))
+                                gaps.append((shard, start + half, rows - half))
+                            continue
+                        # 失敗したページがあっても他のページは書き込む（完了扱いにはしない）
+                        state['error'] = str(error)
+                        self.util.msg_log_error(u'package_search失敗 (fq={0}, start={1}): {2}'.format(shard, start, error))
+                        continue
+                    page += 1
+                    nbytes = page_result.get('_response_bytes', 0)
+                    self.bytes_received += nbytes
+                    count = page_result.get('count', 0)
+                    results = page_result.pop('results')
+                    page_result = None
+                    returned = len(results)
+                    # 要求より少なく、かつ末尾でもない場合はサーバー側の上限件数で切り詰められている
+                    capped = returned < rows and start + returned < count
+                    sizer.observe(rows, returned, elapsed, nbytes, capped)
+                    if first:
+                        totals[shard] = count
+                        tracker.set_total(shard, count)
+                        cursors[shard] = start + (returned if capped else rows)
+                        if cursors[shard] < count:
+                            active.append(shard)
+                    elif capped and returned > 0:
+                        gaps.append((shard, start + returned, rows - returned))
+                    elif capped:
+                        state['error'] = u'package_searchが空の結果を返しました (fq={0}, start={1})'.format(shard, start)
+                        self.util.msg_log_error(state['error'])
+                    state['count'] += returned
+                    state['ids'].update(pkg.get('id') for pkg in results)
+                    tracker.fetched(shard, start, returned if capped else rows, returned)
+                    yield from results
+                    if progress_callback is not None and progress_callback(page, page + _remaining_pages(), results) is False:
+                        cancelled = True
+                        break
+                    results = None
+                if cancelled or host_down:
+                    break
+                _fill()
+        finally:
+            # 中断時は未着手のページを取り消す
+            self._stopping = True
+            executor.shutdown(wait=True, cancel_futures=True)
+        self.util.msg_log_debug(u'ページサイズ: 最終 {0}件 (サーバー上限 {1}件)'.format(sizer.rows, sizer.max_rows))
+        state['expected'] = sum(totals[shard] - offsets[shard] for shard in totals)
+        if not cancelled and state['error'] is None:
+            state['completed'] = True
+
+    def fetch_server_ids(self):
+        """
+        package_searchをfl=idで呼び出し、サーバー上の公開パッケージID一覧を取得する
+        取得プロファイルの絞り込みも適用するため、条件に合わなくなったデータセットも削除対象になる
+        戻り値: (ok, IDの集合 またはエラーメッセージ)
+        """
+        rows_per_page = self.ID_ROWS_PER_PAGE
+        start = 0
+        ids = set()
+        total_count = None
+        while True:
+            ok, page_result = self.cc.package_search(
+                '', None, None, rows=rows_per_page, start=start, fq=self._profile_fq(), sort='id asc', fl='id'
+            )
+            if not ok:
+                return False, page_result
+            if 'results' not in page_result:
+                return False, self.util.tr(u'cc_invalid_json')
+            if total_count is None:
+                total_count = page_result.get('count', 0)
+            results = page_result['results']
+            if not results:
+                break
+            for entry in results:
+                # 古いCKANはflを無視してパッケージ全体を返すが、idは含まれる
+                if isinstance(entry, dict) and entry.get('id'):
+                    ids.add(entry['id'])
+            # サーバーのrows上限で切り詰められても取りこぼさないよう、返ってきた件数だけ進める
+            start += len(results)
+            if start >= total_count:
+                break
+        if len(ids) < total_count:
+            # 取得中に件数が変わった等で一覧が不完全な場合は削除を行わない
+            return False, u'ID一覧が不完全です ({0}/{1})'.format(len(ids), total_count)
+        return True, ids
+
+    def reconcile(self, server_ids=None):
+        """
+        サーバーのID一覧とキャッシュのpackages.idを突き合わせ、サーバーから消えた（削除・非公開化）パッケージをキャッシュから除く
+        server_ids: 取得済みのID集合（Noneならfetch_server_idsで取得する）
+        戻り値: (ok, 削除件数 またはエラーメッセージ)
+        """
+        if server_ids is None:
+            ok, server_ids = self.fetch_server_ids()
+            if not ok:
+                return False, server_ids
+        cached_ids = get_cached_package_ids(self.db_path)
+        if not server_ids and cached_ids:
+            # 空の一覧で全件消さないよう、サーバー側が0件のときは何もしない
+            self.util.msg_log_debug(u'削除検出: サーバーのID一覧が空のためスキップします')
+            return True, 0
+        vanished = cached_ids - server_ids
+        if not vanished:
+            return True, 0
+        deleted = delete_packages(self.db_path, sorted(vanished))
+        self.util.msg_log_debug(u'削除検出: サーバーから消えた {0}件 をキャッシュから削除しました'.format(deleted))
+        return True, deleted
+
+
+class HarvestTask(QgsTask):
+    """
+    カタログ取得をQGISのバックグラウンドタスクとして実行する
+    UIスレッドは止めず、進捗（ページ数・受信バイト数・残り時間）はharvestProgressで通知する
+    """
+
+    # (取得ページ数, 総ページ数, 受信バイト数, 残り秒数（不明なら-1）)
+    harvestProgress = pyqtSignal(int, int, int, float)
+    # (ok, 結果dict またはエラーメッセージ)
+    harvestFinished = pyqtSignal(bool, object)
+
+    def __init__(self, description, settings, util, cc, db_path, force_full=False):
+        super().__init__(description, QgsTask.CanCancel)
+        self.util = util
+        self.cc = cc
+        self.force_full = force_full
+        self.harvester = CkanHarvester(settings, util, cc, db_path)
+        self.harvester.cancel_check = self.isCanceled
+        self.ok = False
+        self.result = None
+        self.started = None
+
+    def run(self):
+        self.started = time.monotonic()
+        try:
+            ok, groups = self.cc.get_groups()
+            if ok is False:
+                self.result = groups
+                return False
+            ok, result = self.harvester.harvest(self._on_page, force_full=self.force_full, groups=groups or [])
+        except Exception as e:
+            # 例外はタスクの外に出さず、エラーメッセージとして完了を通知する
+            self.util.msg_log_error(u'カタログ取得中の予期せぬエラー: {0}\n{1}'.format(e, traceback.format_exc()))
+            self.ok = False
+            self.result = u'{0}: {1}'.format(type(e).__name__, e)
+            return False
+        self.ok = ok
+        self.result = result
+        if not ok:
+            return False
+        return not self.isCanceled()
+
+    def _on_page(self, page, max_page, results):
+        if max_page > 0:
+            self.setProgress(min(100.0, 100.0 * page / max_page))
+        eta = -1.0
+        elapsed = time.monotonic() - self.started
+        if 0 < page < max_page:
+            eta = elapsed / page * (max_page - page)
+        self.harvestProgress.emit(page, max_page, self.harvester.bytes_received, eta)
+        return not self.isCanceled()
+
+    def finished(self, result):
+        # メインスレッドで呼ばれる
+        if self.isCanceled() and self.ok:
+            self.result['completed'] = False
+        self.harvestFinished.emit(self.ok, self.result)
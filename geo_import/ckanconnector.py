@@ -4,14 +4,20 @@ import json
 import os
 import sys
 import string
+from urllib.parse import quote
 
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QThread
 
+from .httpcall import HostHealth
 from .httpcall import HttpCall
 from .httpcall import RequestsException
 from .httpcall import RequestsExceptionTimeout
 from .httpcall import RequestsExceptionConnectionError
 from .httpcall import RequestsExceptionUserAbort
+from .httpcall import RequestsExceptionHostUnavailable
 from .pyperclip import copy
+from .pyperclip import PyperclipException
 
 
 class CkanConnector:
@@ -29,10 +35,8 @@ class CkanConnector:
         # Chrome風のユーザーエージェント設定（CKAN APIへのHTTPリクエストで使用）
         self.ua_chrome = {
             b'Accept': b'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            # DON'T use: haven't found a way to tell QNetworkRequest to decompress on the fly
-            # although it should automatically when this header is present
+            # Accept-Encodingは指定しない: 未設定ならQtがgzip/deflateを要求して展開する
             # https://code.qt.io/cgit/qt/qtbase.git/tree/src/network/access/qhttpnetworkconnection.cpp?h=5.11#n299
-            b'Accept-Encoding': b'gzip, deflate',
             b'Accept-Language': b'en-US,en;q=0.8,de;q=0.6,de-DE;q=0.4,de-CH;q=0.2',
             b'User-Agent': b'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'
         }
@@ -88,7 +92,7 @@ class CkanConnector:
             return False, self.util.tr(u'cc_api_not_accessible').format(error_message)
             
         self.util.msg_log_debug(u'サーバー接続OK、グループリスト取得を実行します')
-        return self.__get_data(result, 'action/group_list?all_fields=true')
+        return self.__get_data(result, 'action/group_list?all_fields=true', cache=True)
 
     def test_groups(self, test_path):
         ok, result = self._validate_ckan_url(test_path)
@@ -117,9 +121,13 @@ class CkanConnector:
             return False, self.util.tr(u'cc_api_not_accessible').format(error_message)
             
         self.util.msg_log_debug(u'テスト: サーバー接続OK、グループリスト取得を実行します')
-        return self.__get_data(result, 'action/group_list?all_fields=true')
+        return self.__get_data(result, 'action/group_list?all_fields=true', cache=True)
 
-    def package_search(self, text, groups=None, page=None, rows=None, start=None):
+    def package_search(self, text, groups=None, page=None, rows=None, start=None, fq=None, sort=None, fl=None, facet_fields=None, cache=False):
+        """
+        cache: Trueなら応答をHTTPキャッシュで再検証する（画面からの検索用）
+        カタログ取得のページやID一覧は大きく再利用もされないため、既定ではキャッシュしない
+        """
         # BoxDriveなどの特殊パターンを早期検出して処理
         if isinstance(self.settings.ckan_url, str) and (
             'Box' in self.settings.ckan_url or 
@@ -165,7 +173,7 @@ class CkanConnector:
         connection_ok, error_message = self.__check_connection(result)
         if not connection_ok:
             self.util.msg_log_error(u'サーバー接続確認に失敗: {0}'.format(error_message))
-            return False, self.util.tr(u'cc_api_not_accessible').format(error_message)
+            return False, self.__connection_error(error_message)
             
         self.util.msg_log_debug(u'サーバー接続OK、パッケージ検索を実行します')
 
@@ -188,12 +196,137 @@ class CkanConnector:
         else:
             q = '*:*'
 
+        # 絞り込みクエリ（例: 差分同期の metadata_modified:[X TO *]）、ソート順、返却フィールド
+        # 値には空白・引用符・[]・*・:・+・&などが入るため、パラメータごとにエンコードする
+        extra_query = ''
+        if fq:
+            extra_query += u'&fq={0}'.format(quote(fq, safe=''))
+        if sort:
+            extra_query += u'&sort={0}'.format(quote(sort, safe=''))
+        # 返却フィールドの限定（例: 削除検出の fl=id）
+        if fl:
+            extra_query += u'&fl={0}'.format(quote(fl, safe=''))
+        # ファセット集計（例: シャード分割用の組織別件数）
+        if facet_fields:
+            extra_query += u'&facet.field={0}&facet.limit=-1&facet.mincount=1'.format(quote(json.dumps(list(facet_fields)), safe=''))
+
         # rows指定（なければsettings.results_limit）
         rows_val = rows if rows is not None else self.settings.results_limit
         return self.__get_data(
             result,
-            u'action/package_search?q={0}&rows={1}{2}'.format(q, rows_val, start_query)
+            u'action/package_search?q={0}&rows={1}{2}{3}'.format(quote(q, safe=''), rows_val, start_query, extra_query),
+            cache=cache
+        )
+
+    def package_show(self, package_id):
+        """
+        パッケージの完全な情報を取得する
+        （軽量プロファイルで取得したキャッシュの詳細表示時に遅延取得する）
+        """
+        ok, result = self._validate_ckan_url(self.settings.ckan_url)
+        if not ok:
+            self.util.msg_log_error(u'CKAN URL検証に失敗: {0}'.format(result))
+            return ok, result
+        return self.__get_data(result, u'action/package_show?id={0}'.format(quote(package_id, safe='')), cache=True)
+
+    def package_show_async(self, package_id, callback):
+        """
+        package_showを非同期で実行し、完了時にcallback(ok, result)を呼ぶ（画面操作を止めない）
+        戻り値: HttpRequest（送信前に失敗した場合はcallbackを呼んだうえでNone）
+        """
+        ok, result = self._validate_ckan_url(self.settings.ckan_url)
+        if not ok:
+            self.util.msg_log_error(u'CKAN URL検証に失敗: {0}'.format(result))
+            callback(ok, result)
+            return None
+        connection_ok, error_message = self.__check_connection(result)
+        if not connection_ok:
+            callback(False, self.util.tr(u'cc_api_not_accessible').format(error_message))
+            return None
+        action = u'action/package_show?id={0}'.format(quote(package_id, safe=''))
+        url = self.util.remove_newline(self.__get_api_url(result, action))
+        self.util.msg_log_debug(u'api request: {0}'.format(url))
+        request = HttpCall(self.settings, self.util).execute_request_async(
+            url
+            , headers=self.ua_chrome
+            , verify=False
+            , timeout=self.settings.request_timeout
+            , cache=True
+            , encoded=True
         )
+        request.add_done_callback(lambda response: callback(*self.__read_data(response, action)))
+        return request
+
+    # シャード分割の方式
+    SHARD_STRATEGIES = ('organization', 'metadata_modified', 'id_prefix')
+
+    def get_harvest_shards(self, strategy, fq=None, shard_count=16):
+        """
+        カタログ全件取得を互いに重ならないシャード（fq条件）に分割する
+        Solrはstartが大きいほど遅くなるため、各シャードをstart=0からページングすることで1リクエストのコストを一定に保つ
+        strategy: 'organization'（組織ファセット）/ 'metadata_modified'（更新日時の範囲）/ 'id_prefix'（IDの先頭文字）
+        fq: 全シャードに共通の絞り込み条件（差分同期の条件など）
+        戻り値: (ok, fq文字列のリスト またはエラーメッセージ)
+        """
+        if strategy == 'organization':
+            ok, result = self.package_search('', None, None, rows=0, start=0, fq=fq, facet_fields=['organization'])
+            if not ok:
+                return ok, result
+            counts = (result.get('facets') or {}).get('organization') or {}
+            shards = [u'organization:"{0}"'.format(name) for name in sorted(counts)]
+            # 組織に属さないデータセット
+            shards.append(u'-organization:[* TO *]')
+        elif strategy == 'metadata_modified':
+            ok, first = self.package_search('', None, None, rows=1, start=0, fq=fq, sort='metadata_modified asc', fl='metadata_modified')
+            if not ok:
+                return ok, first
+            ok, last = self.package_search('', None, None, rows=1, start=0, fq=fq, sort='metadata_modified desc', fl='metadata_modified')
+            if not ok:
+                return ok, last
+            if not first.get('results') or not last.get('results'):
+                return True, [fq] if fq else [None]
+            shards = self.__time_range_shards(
+                first['results'][0].get('metadata_modified'),
+                last['results'][0].get('metadata_modified'),
+                shard_count
+            )
+        elif strategy == 'id_prefix':
+            # CKANのIDはUUID（16進）なので先頭1文字で16分割し、それ以外のIDは残りのシャードで拾う
+            prefixes = '0123456789abcdef'
+            shards = [u'id:{0}*'.format(prefix) for prefix in prefixes]
+            shards.append(u'-id:({0})'.format(u' OR '.join(u'{0}*'.format(prefix) for prefix in prefixes)))
+        else:
+            return False, u'Unknown shard strategy: {0}'.format(strategy)
+        if fq:
+            shards = [fq if shard is None else u'({0}) AND {1}'.format(fq, shard) for shard in shards]
+        self.util.msg_log_debug(u'シャード分割 ({0}): {1}件'.format(strategy, len(shards)))
+        return True, shards
+
+    def __time_range_shards(self, oldest, newest, shard_count):
+        """metadata_modifiedの最古～最新をshard_count個の半開区間 [a TO b} に等分する"""
+        import datetime
+
+        def _parse(value):
+            value = (value or '').rstrip('Z')[:19]
+            return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+        def _fmt(value):
+            return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        try:
+            lo = _parse(oldest)
+            hi = _parse(newest)
+        except ValueError:
+            return [None]
+        step = (hi - lo) / max(1, shard_count)
+        if step.total_seconds() < 1:
+            return [None]
+        bounds = [lo + step * i for i in range(1, shard_count)]
+        shards = [u'metadata_modified:[* TO {0}}}'.format(_fmt(bounds[0]))]
+        for a, b in zip(bounds, bounds[1:]):
+            shards.append(u'metadata_modified:[{0} TO {1}}}'.format(_fmt(a), _fmt(b)))
+        shards.append(u'metadata_modified:[{0} TO *]'.format(_fmt(bounds[-1])))
+        return shards
 
     def show_group(self, group_name, page=None):
         ok, result = self._validate_ckan_url(self.settings.ckan_url)
@@ -218,12 +351,13 @@ class CkanConnector:
         self.util.msg_log_debug(u'サーバー接続OK、グループ表示を実行します')
 
         return self.__get_data(
-            result, u'action/package_search?q=&fq=(groups:{0})&sort={1}&rows={2}{3}'.format(
-                group_name,
-                self.sort,
+            result, u'action/package_search?q=&fq={0}&sort={1}&rows={2}{3}'.format(
+                quote(u'(groups:{0})'.format(group_name), safe=''),
+                quote(self.sort, safe=''),
                 self.settings.results_limit,
                 start_query
-            )
+            ),
+            cache=True
         )
 
     def get_file_size(self, url):
@@ -278,12 +412,6 @@ class CkanConnector:
 
         return True, file_size, None
 
-    def __is_chunked(self, te):
-        if not te:
-            return False
-        te = te.lower()
-        return 'chunked' == te
-
     def __file_name_from_service(self, url, cd, ct):
         self.util.msg_log_debug(
             u'__file_name_from_service:\nurl: {}\nContent-Description: {}\nContent-Type: {}'
@@ -324,7 +452,29 @@ class CkanConnector:
 
         return None
 
-    def download_resource(self, url, resource_format, dest_file, delete):
+    def download_resource(self, url, resource_format, dest_file, delete, progress_callback=None, size_callback=None):
+        """
+        リソースをdest_fileへダウンロードする（完了まで待つ）
+        本文は受信しながら<dest_file>.partへ書き込み、完了後に最終的なファイル名へ置き換える
+        失敗時は.partと検証子（ETag/Last-Modified）を残し、次回はRangeで続きから取得する
+        progress_callback(bytes_received, bytes_total)で進捗を通知する
+        size_callback(file_size_mb)は応答ヘッダーを受け取った時点で呼ばれ、Falseを返すと転送を中止する
+        （HEADでサイズを確認してからGETする往復を省く）
+        """
+        ok, err_msg, file_name, request = self.start_download(url, dest_file, delete, size_callback)
+        if request is None:
+            return ok, err_msg, file_name
+        if progress_callback is not None:
+            request.downloadProgress.connect(progress_callback)
+        request.wait()
+        return self.finish_download(request, dest_file)
+
+    def start_download(self, url, dest_file, delete, size_callback=None):
+        """
+        ダウンロードを開始して(ok, err_msg, file_name, request)を返す（完了は待たない）
+        通信する場合はrequest（HttpRequest）を返すので、完了後にfinish_download()を呼ぶ
+        ローカルファイルのコピーや接続エラーなど、その場で終わった場合はrequestがNone
+        """
         try:
 #             if resource_format is not None:
 #                 if resource_format.lower() == 'georss':
@@ -367,10 +517,10 @@ class CkanConnector:
                         # コピー
                         try:
                             shutil.copyfile(local_path, dest_file)
-                            return True, '', dest_file
+                            return True, '', dest_file, None
                         except Exception as e:
                             self.util.msg_log_error(u'ローカルファイルのコピーに失敗: {0}'.format(str(e)))
-                            return False, self.util.tr(u'cc_download_error').format(str(e)), None
+                            return False, self.util.tr(u'cc_download_error').format(str(e)), None, None
             except Exception:
                 # ローカル処理に失敗した場合は標準のネットワーク処理にフォールバック
                 pass
@@ -379,11 +529,13 @@ class CkanConnector:
             connection_ok, error_message = self.__check_connection(url)
             if not connection_ok:
                 self.util.msg_log_error(u'リソースダウンロード: サーバー接続確認に失敗: {0}'.format(error_message))
-                return False, self.util.tr(u'cc_api_not_accessible').format(error_message), None
+                return False, self.util.tr(u'cc_api_not_accessible').format(error_message), None, None
 
             self.util.msg_log_debug(u'サーバー接続OK、リソースダウンロードを実行します')
+            part_file = dest_file + '.part'
+            validator = self.__load_part_validator(part_file, url)
             http_call = HttpCall(self.settings, self.util)
-            response = http_call.execute_request(
+            request = http_call.execute_request_async(
                 url
                 , headers=self.ua_chrome
                 , verify=False
@@ -391,7 +543,38 @@ class CkanConnector:
                 # not needed anymore, as we use QgsNetworkAccessManager.instance() now
                 #, proxies=self.settings.get_proxies()[1]
                 , timeout=self.settings.request_timeout
+                , download_file=part_file
+                , if_range=validator
             )
+            if size_callback is not None:
+                def check_size(status_code, headers):
+                    size = HttpCall.content_size(status_code, headers)
+                    self.util.msg_log_debug(u'Content-Length: {0}'.format(size))
+                    if size is not None and size_callback(size / 1000000) is False:
+                        self.util.msg_log_debug(u'ファイルサイズの確認によりダウンロードを中止します: {0}'.format(url))
+                        request.abort()
+                request.headersReceived.connect(check_size)
+            return None, '', None, request
+        except IOError as e:
+            self.util.msg_log_debug("download_resource, Can't retrieve {0} to {1}: {2}".format(url, dest_file, e))
+            return False, self.util.tr(u'cc_download_error').format(e.strerror), None, None
+        except NameError as ne:
+            self.util.msg_log_debug(u'{0}'.format(ne))
+            return False, ne.message, None, None
+        except:
+            self.util.msg_log_last_exception()
+            return False, self.util.tr(u'cc_download_error').format(sys.exc_info()[0]), None, None
+
+    def finish_download(self, request, dest_file):
+        """start_download()で開始したダウンロードの完了後に最終的なファイル名を決め、(ok, err_msg, file_name)を返す"""
+        url = request.url
+        part_file = request.download_file
+        keep_part = False
+        try:
+            response = request.result()
+            if request.aborted:
+                # サイズ確認での中止・キャンセルは途中のファイルを残さない
+                return False, self.util.tr(u'cc_download_error').format(u'cancelled'), None
 
             self.util.msg_log_debug(
                 u'download_resource response:\nex:{0}\nhdr:{1}\nok:{2}\nreason:{3}\nstcode:{4}\nstmsg:{5}\ncontent:{6}'
@@ -407,7 +590,10 @@ class CkanConnector:
             )
 
             if not response.ok:
+                keep_part = self.__save_part_validator(part_file, url, response)
                 return False, self.util.tr(u'cc_download_error').format(response.reason), None
+            if response.resumed_from:
+                self.util.msg_log_debug(u'{0}バイト目から再開してダウンロードしました: {1}'.format(response.resumed_from, url))
 
             # Content-Disposition:
             # http://www.w3.org/Protocols/rfc2616/rfc2616-sec19.html
@@ -461,17 +647,9 @@ class CkanConnector:
                 # set return value to full path
                 file_name_from_service = dest_file
 
-            #chunk_size = 1024
-            chunk_size = None
-            #http://docs.python-requests.org/en/latest/user/advanced/#chunk-encoded-requests
-            if self.__is_chunked(response.headers.get(b'Transfer-Encoding')):
-                self.util.msg_log_debug('response is chunked')
-                chunk_size = None
-
-            with open(dest_file, 'wb') as handle:
-                for chunk in response.iter_content(chunk_size):
-                    if chunk:
-                        handle.write(chunk)
+            # 受信済みの.partを置き換え（同じフォルダ内なのでアトミック）
+            os.replace(response.download_file, dest_file)
+            self.util.msg_log_debug(u'downloaded {0} bytes: {1}'.format(response.bytes_written, dest_file))
 
             return True, '', file_name_from_service
         #except RequestsExceptionsTimeout as cte:
@@ -486,109 +664,86 @@ class CkanConnector:
         except:
             self.util.msg_log_last_exception()
             return False, self.util.tr(u'cc_download_error').format(sys.exc_info()[0]), None
+        finally:
+            # 再開できない.partは残さない
+            if part_file and not keep_part:
+                for path in (part_file, part_file + '.json'):
+                    if os.path.exists(path):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
 
-    def __check_connection(self, url):
-        """サーバーとの接続を確認するためのヘルパーメソッド"""
-        self.util.msg_log_debug(u'サーバー接続確認: {0}'.format(url))
-        
-        # クラウドストレージパスやローカルパスの場合はチェックせずに成功とする
+    def __load_part_validator(self, part_file, url):
+        """前回中断した.partが同じURLのものなら、再開に使う検証子を返す"""
+        if not os.path.exists(part_file) or not os.path.exists(part_file + '.json'):
+            return None
         try:
-            # クラウドストレージの特徴的なパターンを確認（事前にURL検証をすり抜けた場合のため）
-            if isinstance(url, str) and ('Box' in url or 'OneDrive' in url or 
-                ('Google' in url and 'Drive' in url) or url.startswith('\\\\') or
-                url.startswith('file://') or url.startswith('local://')):
-                
-                # BoxDrive特別ログ
-                if 'Box' in url or url.startswith('B:\\'):
-                    self.util.msg_log(u'【BoxDrive接続チェック】BoxDriveパスを検出: {0}'.format(url))
-                    self.util.msg_log(u'【BoxDrive接続スキップ】BoxDriveはHTTP接続チェックをスキップします')
-                    self.util.msg_log(u'【BoxDrive接続状態】接続は成功と判定されました')
-                else:
-                    self.util.msg_log_debug(u'クラウドストレージまたはローカルパス。接続チェックをスキップ: {0}'.format(url))
-                
-                return True, None
-        except Exception:
-            # 何かエラーがあっても処理を続行
-            pass
-            
-        # 通常のHTTP接続の場合はより短いタイムアウトで確認
+            with open(part_file + '.json', 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if state.get('url') != url:
+            return None
+        self.util.msg_log_debug(u'中断したダウンロードを再開します ({0}バイト): {1}'.format(os.path.getsize(part_file), url))
+        return state.get('validator')
+
+    def __save_part_validator(self, part_file, url, response):
+        """再開できる.partなら検証子を保存してTrueを返す"""
+        if not os.path.exists(part_file) or os.path.getsize(part_file) == 0:
+            return False
+        # 本文を書き込んだ応答（200/206）の検証子だけを使う。無ければ前回保存したものを残す
+        validator = None
+        if response.status_code in (200, 206):
+            validator = HttpCall.range_validator(response.headers)
+        if validator is None:
+            return os.path.exists(part_file + '.json')
         try:
-            import threading
-            import time
-            
-            # タイムアウト用のフラグとスレッド結果
-            connection_result = [False, None]
-            
-            def connection_check_thread():
-                try:
-                    url_clean = self.util.remove_newline(url)
-                    http_call = HttpCall(self.settings, self.util)
-                    response = http_call.execute_request(
-                        url_clean
-                        , headers=self.ua_chrome
-                        , verify=False
-                        # 接続確認は非常に短いタイムアウトに設定
-                        , timeout=min(3.0, self.settings.request_timeout / 3)
-                    )
-                    
-                    if response.ok:
-                        connection_result[0] = True
-                    else:
-                        connection_result[1] = response.reason
-                except RequestsExceptionTimeout as cte:
-                    connection_result[1] = self.util.tr(u'cc_connection_timeout').format(
-                        getattr(cte, 'message', str(cte))
-                    )
-                except RequestsExceptionConnectionError as ce:
-                    connection_result[1] = str(ce)
-                except Exception as e:
-                    connection_result[1] = str(e)
-            
-            # スレッドを作成して実行
-            thread = threading.Thread(target=connection_check_thread)
-            thread.daemon = True
-            thread.start()
-            
-            # 3秒間だけスレッドの完了を待つ
-            thread.join(3.0)
-            
-            if thread.is_alive():
-                # スレッドが3秒以内に終わらなかった = タイムアウト
-                self.util.msg_log_error(u'サーバー接続確認がタイムアウトしました: {0}'.format(url))
-                return False, self.util.tr(u'cc_connection_timeout').format("Connection check timeout")
-                
-            if connection_result[0]:
-                self.util.msg_log_debug(u'サーバー接続成功: {0}'.format(url))
-                return True, None
-            else:
-                reason = connection_result[1] if connection_result[1] else "Unknown error"
-                self.util.msg_log_error(u'サーバー接続失敗: {0} - {1}'.format(url, reason))
-                return False, reason
-                
-        except Exception as e:
-            self.util.msg_log_error(u'サーバー接続確認プロセス自体でエラー発生: {0} - {1}'.format(url, str(e)))
-            self.util.msg_log_last_exception()
-            return False, str(e)
+            with open(part_file + '.json', 'w', encoding='utf-8') as f:
+                json.dump({'url': url, 'validator': validator}, f)
+        except IOError:
+            return False
+        return True
 
-    def __get_data(self, api, action):
+    def __get_api_url(self, api, action):
         # データカタログ横断検索システムのAPIエンドポイント対応
         if api.endswith('backend/api/'):
             # backend/api/action/ の形式になるように調整
             if action.startswith('action/'):
-                url = u'{0}{1}'.format(api, action)
-            else:
-                url = u'{0}action/{1}'.format(api, action.replace('action/', ''))
-        else:
-            url = u'{0}{1}'.format(api, action)
-            
+                return u'{0}{1}'.format(api, action)
+            return u'{0}action/{1}'.format(api, action.replace('action/', ''))
+        return u'{0}{1}'.format(api, action)
+
+    def __connection_error(self, error_message):
+        """
+        接続確認の失敗を呼び出し元に返すエラーにする
+        遮断中で送らなかった場合は、呼び出し元（カタログ取得）が判別して待てるよう例外のまま返す
+        """
+        message = self.util.tr(u'cc_api_not_accessible').format(error_message)
+        if isinstance(error_message, RequestsExceptionHostUnavailable):
+            return RequestsExceptionHostUnavailable(message, error_message.retry_after)
+        return message
+
+    def __get_data(self, api, action, cache=False):
+        """
+        cache: Trueなら応答をHTTPキャッシュに保存し、次回は条件付きリクエストで再検証する
+        （閲覧用の小さな応答だけに使い、カタログ取得の大きなページでキャッシュを押し出さない）
+        """
+        url = self.__get_api_url(api, action)
         self.util.msg_log_debug(u'api request: {0}'.format(url))
-        copy(url)
+        # デバッグ用にAPIのURLをクリップボードへ（クリップボードはメインスレッドからのみ使う。
+        # カタログ取得のワーカースレッドから呼ぶと、Windowsでは競合時に例外になりページの失敗扱いになる）
+        if self.settings.debug and QThread.currentThread() == QCoreApplication.instance().thread():
+            try:
+                copy(url)
+            except PyperclipException as e:
+                self.util.msg_log_debug(u'クリップボードへのコピーに失敗: {0}'.format(e))
         
         # 接続確認を先に行う
         connection_ok, error_message = self.__check_connection(api)
         if not connection_ok:
             self.util.msg_log_error(u'サーバー接続確認に失敗したため、APIリクエストを中断します: {0}'.format(error_message))
-            return False, self.util.tr(u'cc_api_not_accessible').format(error_message)
+            return False, self.__connection_error(error_message)
             
         # 接続確認OKの場合のみデータ取得を実行
         try:
@@ -601,24 +756,11 @@ class CkanConnector:
                 # not needed anymore, as we use QgsNetworkAccessManager.instance() now
                 #, proxies=self.settings.get_proxies()[1]
                 , timeout=self.settings.request_timeout
+                # 変更が無ければ304で保存済みの応答を使う
+                , cache=cache
+                # クエリの値はエンコード済み
+                , encoded=True
             )
-
-            self.util.msg_log_debug(
-                u'__get_data response:\nex:{0}\nhdr:{1}\nok:{2}\nreason:{3}\nstcode:{4}\nstmsg:{5}\ncontent:{6}'
-                .format(
-                    response.exception,
-                    response.headers,
-                    response.ok,
-                    response.reason,
-                    response.status_code,
-                    response.status_message,
-                    response.text[:255]
-                )
-            )
-
-            if not response.ok:
-                return False, self.util.tr(u'cc_api_not_accessible').format(response.reason)
-
         except RequestsExceptionTimeout as cte:
             self.util.msg_log_error(u'connection timeout for: {0}'.format(url))
             return False, self.util.tr(u'cc_connection_timeout').format(cte.message)
@@ -632,13 +774,33 @@ class CkanConnector:
         #    self.util.msg_log_error(u'unexpected error during request: {0}'.format(sys.exc_info()[0]))
         #    self.util.msg_log_last_exception()
         #    return False, self.util.tr(u'cc_api_not_accessible')
+        return self.__read_data(response, action)
+
+    def __read_data(self, response, action):
+        """APIの応答を(ok, result)にする"""
+        self.util.msg_log_debug(
+            u'__get_data response:\nex:{0}\nhdr:{1}\nok:{2}\nreason:{3}\nstcode:{4}\nstmsg:{5}\ncontent:{6}'
+            .format(
+                response.exception,
+                response.headers,
+                response.ok,
+                response.reason,
+                response.status_code,
+                response.status_message,
+                response.text[:255]
+            )
+        )
+
+        if not response.ok:
+            return False, self.util.tr(u'cc_api_not_accessible').format(response.reason)
 
         if response.status_code != 200:
             return False, self.util.tr(u'cc_server_fault')
 
         # decode QByteArray
         try:
-            json_txt = response.text.data().decode()
+            raw = response.text.data()
+            json_txt = raw.decode()
             self.util.msg_log_debug(u'resp_msg (decoded):\n{} .......'.format(json_txt[:255]))
             result = json.loads(json_txt)
         except TypeError as te:
@@ -654,7 +816,11 @@ class CkanConnector:
 
         if result['success'] is False:
             return False, result['error']['message']
-        return True, result['result']
+        data = result['result']
+        # package_searchの結果には受信バイト数を付与する（取得進捗の表示用）
+        if isinstance(data, dict) and 'package_search' in action:
+            data['_response_bytes'] = len(raw)
+        return True, data
 
     def __get_start(self, page):
         start = self.settings.results_limit * page - self.settings.results_limit
@@ -763,8 +929,6 @@ class CkanConnector:
         """
         URLへの接続を確認
         """
-        import threading
-        
         if url is None:
             return False, "URL is None"
             
@@ -796,55 +960,38 @@ class CkanConnector:
             self.util.msg_log_error(u'ローカルパスのアクセス確認に失敗: {0}'.format(str(e)))
             return False, f"ローカルパスアクセスエラー: {str(e)}"
 
-        # HTTP URLの場合：接続確認
+        # HTTP URLの場合：事前の接続確認はせず、ホストの状態キャッシュだけを見る
+        # 正常なホストへのリクエストはそのまま送り、最近失敗したホストだけを確認する
         if url.startswith('http'):
+            state = HostHealth.acquire(url)
+            if state == HostHealth.CLOSED:
+                return True, None
+            if state == HostHealth.OPEN:
+                reason = HostHealth.reason(url) or "Connection failed recently"
+                self.util.msg_log_warning(u'最近接続に失敗したサーバーのためリクエストを送りません: {0} - {1}'.format(url, reason))
+                return False, RequestsExceptionHostUnavailable(reason, HostHealth.remaining_open_seconds(url))
+            # 遮断時間を過ぎたので1回だけ軽いリクエストで確認する（結果はHttpCallがHostHealthに記録）
             try:
-                # タイムアウト付きで接続テスト
-                result = [False, "Connection timed out"]
-                
-                def check_url():
-                    try:
-                        self.util.msg_log_debug(u'サーバーへの接続を確認中: {0}'.format(url))
-                        http_call = HttpCall(self.settings, self.util)
-                        response = http_call.execute_request(
-                            url,
-                            http_method='head',
-                            timeout=self.settings.request_timeout
-                        )
-                        if response.ok:
-                            result[0] = True
-                            result[1] = None
-                            self.util.msg_log_debug(u'サーバー接続成功: {0}'.format(url))
-                        else:
-                            result[0] = False
-                            result[1] = f"Status: {response.status_code} - {response.reason}"
-                            self.util.msg_log_warning(u'サーバー接続エラー: {0} - ステータス: {1}'.format(
-                                url, f"{response.status_code} - {response.reason}"))
-                    except Exception as e:
-                        result[0] = False
-                        result[1] = str(e)
-                        self.util.msg_log_warning(u'サーバー接続例外: {0} - {1}'.format(url, str(e)))
-                
-                # スレッド作成と実行
-                thread = threading.Thread(target=check_url)
-                thread.daemon = True
-                thread.start()
-                
-                # タイムアウト
-                timeout_seconds = min(30, max(5, self.settings.request_timeout))  # 5～30秒の範囲内に制限
-                self.util.msg_log_debug(u'接続確認タイムアウト: {0}秒'.format(timeout_seconds))
-                thread.join(timeout_seconds)
-                
-                if thread.is_alive():
-                    self.util.msg_log_warning(u'サーバー接続タイムアウト: {0}'.format(url))
-                    return False, "Connection timed out"
-                
-                return result[0], result[1]
-                
+                self.util.msg_log_debug(u'サーバーへの接続を再確認中: {0}'.format(url))
+                http_call = HttpCall(self.settings, self.util)
+                response = http_call.execute_request(
+                    url,
+                    http_method='head',
+                    retry=False,
+                    timeout=min(5, self.settings.request_timeout)
+                )
             except Exception as e:
+                HostHealth.record_failure(url, str(e))
                 self.util.msg_log_error(u'接続確認中の予期せぬエラー: {0}'.format(str(e)))
                 return False, str(e)
-        
+            if HostHealth.is_failure(response):
+                self.util.msg_log_warning(u'サーバー接続エラー: {0} - {1}'.format(url, response.reason or response.status_code))
+                # 確認に失敗したため再び遮断されている
+                reason = response.reason or "Status: {0}".format(response.status_code)
+                return False, RequestsExceptionHostUnavailable(reason, HostHealth.remaining_open_seconds(url))
+            self.util.msg_log_debug(u'サーバー接続が回復しました: {0}'.format(url))
+            return True, None
+
         # その他のURLスキーム：未サポート
         self.util.msg_log_warning(u'未サポートのURLスキーム: {0}'.format(url))
         return False, f"Unsupported URL scheme: {url}"
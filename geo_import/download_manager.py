@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+from urllib.parse import urlparse
+
+from qgis.PyQt.QtCore import QObject
+from qgis.PyQt.QtCore import pyqtSignal
+
+
+class DownloadManager(QObject):
+    """
+    複数リソースの並列ダウンロード
+    全体の同時実行数とホストごとの同時実行数の範囲で、キューの先頭から順に開始する
+    通信はメインスレッドのイベントループで非同期に行い、各ダウンロードの完了を
+    downloadFinishedで通知する（レイヤの追加は受け取り側がメインスレッドで行う）
+    """
+
+    # job, ok, err_msg, file_name（jobはadd()が返すdict。dataに呼び出し元の情報を持たせる）
+    downloadFinished = pyqtSignal(object, bool, object, object)
+    # 完了数, 全体数, 受信バイト数, 全体バイト数（サイズ不明のものは含まない）
+    progressChanged = pyqtSignal(int, int, object, object)
+    allFinished = pyqtSignal()
+
+    def __init__(self, settings, util, cc):
+        super().__init__()
+        self.settings = settings
+        self.util = util
+        self.cc = cc
+        self.max_concurrency = getattr(settings, 'download_concurrency', 4)
+        self.max_per_host = getattr(settings, 'download_host_concurrency', 2)
+        # size_callback(file_size_mb, job): Falseを返すとそのダウンロードを中止する
+        # Noneを返した場合は回答を保留し、後でsize_answered()で知らせる
+        # 回答までは転送が終わっても完了処理（ファイルの配置・downloadFinished）を行わない
+        self.size_callback = None
+        self.jobs = []
+        self.pending = []
+        self.active = []
+        # 転送は終わったがサイズ確認の回答待ちのもの
+        self.waiting = []
+        self.host_active = {}
+        self.finished_count = 0
+        self.cancelled = False
+        self._all_finished = False
+
+    def add(self, url, dest_file, delete, data=None):
+        """ダウンロードをキューに追加する"""
+        job = {
+            'url': url,
+            'dest_file': dest_file,
+            'delete': delete,
+            'data': data,
+            'host': urlparse(url).netloc.lower(),
+            'request': None,
+            'bytes_received': 0,
+            'bytes_total': 0,
+            'size_pending': False,
+        }
+        self.jobs.append(job)
+        self.pending.append(job)
+        return job
+
+    def start(self):
+        self.util.msg_log_debug(
+            u'ダウンロード開始: {0}件 (同時{1}件, 同一ホスト{2}件)'.format(
+                len(self.pending), self.max_concurrency, self.max_per_host
+            )
+        )
+        self._schedule()
+
+    def is_running(self):
+        return not self._all_finished
+
+    def cancel(self):
+        """未開始のものを取り消し、実行中の転送を中止する"""
+        if self._all_finished:
+            return
+        self.util.msg_log_debug(u'ダウンロードをキャンセルします（実行中{0}件, 未開始{1}件）'.format(len(self.active), len(self.pending)))
+        self.cancelled = True
+        for job in self.pending:
+            self.jobs.remove(job)
+        self.pending = []
+        for job in list(self.active):
+            job['request'].abort()
+        for job in list(self.waiting):
+            self.size_answered(job, False)
+        self._schedule()
+
+    def _schedule(self):
+        # 上限に空きがあれば、同時実行数がいっぱいのホストを飛ばしてキューの先頭から開始する
+        index = 0
+        while index < len(self.pending) and len(self.active) < self.max_concurrency:
+            job = self.pending[index]
+            if self.host_active.get(job['host'], 0) >= self.max_per_host:
+                index += 1
+                continue
+            del self.pending[index]
+            self._start_job(job)
+        if not self.pending and not self.active and not self.waiting and not self._all_finished:
+            self._all_finished = True
+            self.allFinished.emit()
+
+    def _start_job(self, job):
+        size_callback = None
+        if self.size_callback is not None:
+            size_callback = lambda file_size, job=job: self._check_size(file_size, job)
+        ok, err_msg, file_name, request = self.cc.start_download(
+            job['url'], job['dest_file'], job['delete'], size_callback=size_callback
+        )
+        if request is None:
+            # ローカルファイルのコピーや接続エラーはその場で完了
+            self._complete(job, ok, err_msg, file_name)
+            return
+        job['request'] = request
+        self.active.append(job)
+        self.host_active[job['host']] = self.host_active.get(job['host'], 0) + 1
+        request.downloadProgress.connect(lambda received, total, job=job: self._on_progress(job, received, total))
+        request.add_done_callback(lambda response, job=job: self._on_request_finished(job))
+
+    def _check_size(self, file_size, job):
+        # 確認ダイアログの表示中（入れ子のイベントループ）に転送が終わっても、回答までは完了処理をしない
+        job['size_pending'] = True
+        accepted = self.size_callback(file_size, job)
+        if accepted is not None:
+            self.size_answered(job, accepted)
+        return True
+
+    def size_answered(self, job, accepted):
+        """サイズ確認の回答。Falseなら転送を中止し、転送済みなら一時ファイルを破棄する"""
+        if not job['size_pending']:
+            return
+        job['size_pending'] = False
+        if not accepted:
+            job['request'].abort()
+        if job in self.waiting:
+            self.waiting.remove(job)
+            self._finish_job(job)
+            self._schedule()
+
+    def _on_progress(self, job, bytes_received, bytes_total):
+        job['bytes_received'] = bytes_received
+        job['bytes_total'] = max(bytes_total, 0)
+        self._emit_progress()
+
+    def _on_request_finished(self, job):
+        self.active.remove(job)
+        self.host_active[job['host']] -= 1
+        if job['size_pending']:
+            self.waiting.append(job)
+        else:
+            self._finish_job(job)
+        self._schedule()
+
+    def _finish_job(self, job):
+        # 中止したもの（abort済み）はfinish_downloadが一時ファイルを破棄する
+        ok, err_msg, file_name = self.cc.finish_download(job['request'], job['dest_file'])
+        self._complete(job, ok, err_msg, file_name)
+
+    def _complete(self, job, ok, err_msg, file_name):
+        self.finished_count += 1
+        if job['bytes_total']:
+            job['bytes_received'] = job['bytes_total']
+        self.downloadFinished.emit(job, bool(ok), err_msg, file_name)
+        self._emit_progress()
+
+    def _emit_progress(self):
+        received = sum(job['bytes_received'] for job in self.jobs)
+        total = sum(job['bytes_total'] for job in self.jobs)
+        self.progressChanged.emit(self.finished_count, len(self.jobs), received, total)
@@ -12,7 +12,10 @@ SOURCES = geo_import_main.py \
           xml_diagnostics.py \
           mlit_xml_checker.py \
           zip_ckan_browser_dialog.py \
-          save_ckan_to_sqlite.py
+          save_ckan_to_sqlite.py \
+          ckan_harvester.py \
+          download_manager.py \
+          http_cache.py
 
 FORMS = geo_import_dialog_base.ui \
         geo_import_dialog_settings.ui \
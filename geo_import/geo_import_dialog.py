@@ -3,9 +3,14 @@ from qgis.PyQt.QtCore import QThread, pyqtSignal
 
 
 class DataFetchThread(QThread):
-    result_ready = pyqtSignal(list, int, int, int)  # (page_results, result_count, page_count, total_resource_count)
+    result_ready = pyqtSignal(list, int, int, int, object)  # (page_results, result_count, page_count, total_resource_count, next_page_key)
 
-    def __init__(self, db_path, format_text, format_lc, current_page, results_limit, search_txt=None, group_names=None):
+    # 件数キャッシュ: (db_path, キャッシュ世代, WHERE句, パラメータ) -> (result_count, total_resource_count)
+    # ページ送りのたびにCOUNTを数え直さないため。キャッシュ更新で世代が変わると自然に無効になる
+    _count_cache = {}
+    COUNT_CACHE_SIZE = 64
+
+    def __init__(self, db_path, format_text, format_lc, current_page, results_limit, search_txt=None, group_names=None, page_key=None):
         super().__init__()
         self.db_path = db_path
         self.format_text = format_text
@@ -14,85 +19,176 @@ class DataFetchThread(QThread):
         self.results_limit = results_limit
         self.search_txt = search_txt or ''
         self.group_names = group_names  # 追加: グループ名リスト
+        self.fts_query = None
+        self.like_terms = []
+        self.fts_snippet = False
+        # キーセットページング: 前ページ末尾のソートキー（Noneの場合はOFFSETで取得）
+        self.page_key = page_key
+
+    # bm25の列重み（title, notes, tags, author, organization）
+    FTS_WEIGHTS = (10.0, 1.0, 5.0, 2.0, 2.0)
+
+    def _prepare_text_query(self, c):
+        """
+        検索語を全文検索インデックスのMATCH式と、部分一致で絞り込む語に振り分ける
+        """
+        from .save_ckan_to_sqlite import get_fts_tokenizer, build_fts_query
+        self.fts_query = None
+        self.like_terms = []
+        self.fts_snippet = False
+        if not self.search_txt.strip():
+            return
+        tokenizer = get_fts_tokenizer(c)
+        if tokenizer is None:
+            # FTS5が使えない場合は従来どおり検索語全体の部分一致
+            self.like_terms = [self.search_txt]
+            return
+        self.fts_query, self.like_terms = build_fts_query(self.search_txt, tokenizer)
+        # bigramは索引用に展開したテキストになるため、抜粋はPython側で作る
+        self.fts_snippet = self.fts_query is not None and tokenizer != 'bigram'
+
+    def _build_where(self, include_text=True):
+        """
+        グループ・データ形式・検索語の絞り込みをSQLのWHERE句として組み立てる
+        include_text: Falseの場合は全文検索のMATCH条件を含めない（呼び出し側でMATCHする場合）
+        """
+        clauses = []
+        params = []
+        # カテゴリ（グループ）フィルタ: 1つでも一致すればOK（OR条件）
+        if self.group_names is not None:
+            placeholders = ', '.join('?' for _ in self.group_names)
+            clauses.append(
+                'p.id IN (SELECT package_id FROM package_groups WHERE group_name IN ({0}))'.format(placeholders)
+            )
+            params.extend(self.group_names)
+        # データ形式フィルタ
+        if self.format_text != 'すべて':
+            clauses.append('p.id IN (SELECT package_id FROM resources WHERE format_lc = ?)')
+            params.append(self.format_lc.strip())
+        # 検索語フィルタ（タイトル・説明・タグ・作成者・組織）
+        if include_text and self.fts_query:
+            clauses.append('p.rowid IN (SELECT rowid FROM packages_fts WHERE packages_fts MATCH ?)')
+            params.append(self.fts_query)
+        for term in self.like_terms:
+            clauses.append('instr(p.search_text, ?) > 0')
+            params.append(term.lower())
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, params
+
+    def _python_snippet(self, entry, width=40):
+        """タイトル・説明から検索語の周辺を抜き出し、検索語を<b>で強調する"""
+        import re
+        terms = [t for t in self.search_txt.split() if t]
+        if not terms:
+            return None
+        pattern = re.compile('|'.join(re.escape(t) for t in terms), re.IGNORECASE)
+        title = entry.get('title')
+        if isinstance(title, dict):
+            title = ' '.join(str(v) for v in title.values())
+        for text in (title, entry.get('notes')):
+            if not text:
+                continue
+            text = str(text)
+            m = pattern.search(text)
+            if m is None:
+                continue
+            begin = max(0, m.start() - width)
+            end = min(len(text), m.end() + width)
+            excerpt = pattern.sub(lambda x: '<b>' + x.group(0) + '</b>', text[begin:end])
+            return ('…' if begin > 0 else '') + excerpt + ('…' if end < len(text) else '')
+        return None
+
+    def _fetch_page(self, c):
+        """
+        表示するページ分だけを取得してデコードする（全文検索時は関連度順・ハイライト付き）
+        前ページ末尾のソートキーがあればキーセットページング、無ければOFFSETで取得する
+        戻り値: (page_results, 次ページ用のソートキー)
+        """
+        import json
+        offset = max(0, (self.current_page - 1) * self.results_limit)
+        if self.fts_query:
+            where, params = self._build_where(include_text=False)
+            where = (where + ' AND ' if where else ' WHERE ') + 'packages_fts MATCH ?'
+            params.append(self.fts_query)
+            score_sql = 'bm25(packages_fts, {0})'.format(', '.join(str(w) for w in self.FTS_WEIGHTS))
+            snippet_sql = "snippet(packages_fts, -1, '<b>', '</b>', '…', 16)" if self.fts_snippet else 'NULL'
+            if self.page_key is not None:
+                where += ' AND ({0}, p.rowid) > (?, ?)'.format(score_sql)
+                params.extend(self.page_key)
+                offset = 0
+            c.execute(
+                'SELECT p.raw_json, {0}, {1}, p.rowid'
+                ' FROM packages_fts JOIN packages p ON p.rowid = packages_fts.rowid{2}'
+                ' ORDER BY {1}, p.rowid LIMIT ? OFFSET ?'.format(snippet_sql, score_sql, where),
+                params + [self.results_limit, offset]
+            )
+        else:
+            where, params = self._build_where()
+            if self.page_key is not None:
+                where = (where + ' AND ' if where else ' WHERE ') + 'p.rowid > ?'
+                params.append(self.page_key[-1])
+                offset = 0
+            c.execute(
+                'SELECT p.raw_json, NULL, NULL, p.rowid FROM packages p' + where + ' ORDER BY p.rowid LIMIT ? OFFSET ?',
+                params + [self.results_limit, offset]
+            )
+        rows = c.fetchall()
+        page_results = []
+        for raw_json, snippet, score, rowid in rows:
+            entry = json.loads(raw_json)
+            if self.search_txt.strip():
+                entry['_search_snippet'] = snippet or self._python_snippet(entry)
+            page_results.append(entry)
+        next_key = None
+        if len(rows) == self.results_limit:
+            last = rows[-1]
+            next_key = (last[2], last[3]) if self.fts_query else (last[3],)
+        return page_results, next_key
+
+    def _count(self, c, generation):
+        """検索条件に一致するデータセット数・リソース数（キャッシュ済みなら再計算しない）"""
+        where, params = self._build_where()
+        res_sql = 'SELECT COUNT(*) FROM resources r WHERE r.package_id IN (SELECT p.id FROM packages p{0})'.format(where)
+        res_params = list(params)
+        if self.format_text != 'すべて':
+            res_sql += ' AND r.format_lc = ?'
+            res_params.append(self.format_lc.strip())
+        cache_key = (self.db_path, generation, res_sql, tuple(res_params))
+        cached = self._count_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        c.execute('SELECT COUNT(*) FROM packages p' + where, params)
+        result_count = c.fetchone()[0]
+        # 全件分のリソース数を集計（形式フィルタを考慮）
+        c.execute(res_sql, res_params)
+        total_resource_count = c.fetchone()[0]
+        if len(self._count_cache) >= self.COUNT_CACHE_SIZE:
+            self._count_cache.clear()
+        self._count_cache[cache_key] = (result_count, total_resource_count)
+        return result_count, total_resource_count
 
     def run(self):
         import sqlite3
-        filtered_results = []
+        from .save_ckan_to_sqlite import ensure_cache_schema, get_cache_generation
+        page_results = []
         result_count = 0
         total_resource_count = 0
+        next_key = None
         try:
             conn = sqlite3.connect(self.db_path)
+            ensure_cache_schema(conn)
             c = conn.cursor()
-            # まず全件取得（形式フィルタは後でPython側で）
-            c.execute('SELECT raw_json FROM packages')
-            rows = c.fetchall()
-            import json
-            for row in rows:
-                entry = json.loads(row[0])
-                # カテゴリ（グループ）フィルタ
-                group_match = True
-                if self.group_names is not None:
-                    # entry['groups']はリスト（各要素はdictで'name'キーあり）
-                    entry_groups = [g['name'] for g in entry.get('groups', []) if 'name' in g]
-                    # 1つでも一致すればOK（OR条件）
-                    group_match = any(g in entry_groups for g in self.group_names)
-                if not group_match:
-                    continue
-                # 検索語フィルタ
-                if self.search_txt:
-                    text_fields = []
-                    if 'title' in entry and entry['title']:
-                        if isinstance(entry['title'], dict):
-                            text_fields.extend(str(v) for v in entry['title'].values())
-                        else:
-                            text_fields.append(str(entry['title']))
-                    if 'notes' in entry and entry['notes']:
-                        text_fields.append(str(entry['notes']))
-                    if 'tags' in entry and entry['tags']:
-                        for tag in entry['tags']:
-                            if isinstance(tag, dict) and 'name' in tag:
-                                text_fields.append(str(tag['name']))
-                            elif isinstance(tag, str):
-                                text_fields.append(tag)
-                    if 'author' in entry and entry['author']:
-                        text_fields.append(str(entry['author']))
-                    if 'maintainer' in entry and entry['maintainer']:
-                        text_fields.append(str(entry['maintainer']))
-                    if 'organization' in entry and entry['organization']:
-                        org = entry['organization']
-                        if isinstance(org, dict):
-                            for k in ('name', 'title', 'description'):
-                                v = org.get(k)
-                                if v:
-                                    text_fields.append(str(v))
-                    search_hit = any(self.search_txt.lower() in t.lower() for t in text_fields)
-                else:
-                    search_hit = True
-                # データ形式フィルタ
-                if self.format_text == 'すべて':
-                    if search_hit:
-                        filtered_results.append(entry)
-                else:
-                    if any(self.format_lc == (res.get('format','').strip().lower()) for res in entry.get('resources', [])) and search_hit:
-                        filtered_results.append(entry)
-            # 全件分のリソース数を集計（形式フィルタを考慮）
-            if self.format_text == 'すべて':
-                total_resource_count = sum(len(entry.get('resources', [])) for entry in filtered_results)
-            else:
-                total_resource_count = sum(
-                    len([res for res in entry.get('resources', []) if self.format_lc == (res.get('format') or '').strip().lower()])
-                    for entry in filtered_results
-                )
+            self._prepare_text_query(c)
+            result_count, total_resource_count = self._count(c, get_cache_generation(c))
+            page_results, next_key = self._fetch_page(c)
             conn.close()
         except Exception as e:
-            filtered_results = []
+            page_results = []
+            result_count = 0
             total_resource_count = 0
-        result_count = len(filtered_results)
+            next_key = None
         page_count = max(1, (result_count + self.results_limit - 1) // self.results_limit)
-        start_idx = (self.current_page - 1) * self.results_limit
-        end_idx = start_idx + self.results_limit
-        page_results = filtered_results[start_idx:end_idx]
-        self.result_ready.emit(page_results, result_count, page_count, total_resource_count)
+        self.result_ready.emit(page_results, result_count, page_count, total_resource_count, next_key)
 # -*- coding: utf-8 -*-
 """
 /***************************************************************************
@@ -195,9 +291,10 @@ class GeoImportDialog(QDialog, FORM_CLASS):
             self.IDC_plainTextLink.clear()
         if hasattr(self, 'IDC_lblSelectedCount'):
             self.IDC_lblSelectedCount.setText("選択中: 0件")
-    def update_format_list(self, results):
+    def update_format_list(self, results, found_formats=None):
         """
         データ形式リストを一般的な形式+GISでよく使われる形式の固定リスト＋実データ形式一覧で構成し、手入力もできるようにする
+        found_formats: キャッシュDBから集計済みのformat値（指定時はresultsを走査しない）
         """
         # 固定リスト
         format_list = [
@@ -209,13 +306,15 @@ class GeoImportDialog(QDialog, FORM_CLASS):
             'jpg', 'jpeg', 'png', 'gif', 'tiff', 'svg',
         ]
         # 検索結果から実際のformat値を抽出
-        if results:
+        if results and found_formats is None:
             found_formats = set()
             for entry in results:
                 for res in entry.get('resources', []):
                     fmt = res.get('format', '').strip()
                     if fmt:
                         found_formats.add(fmt)
+        if found_formats:
+            found_formats = {fmt.strip() for fmt in found_formats if fmt and fmt.strip()}
             # 固定リストにないものを追加
             for fmt in sorted(found_formats, key=lambda x: x.lower()):
                 if fmt.lower() not in [f.lower() for f in format_list]:
@@ -255,7 +354,21 @@ class GeoImportDialog(QDialog, FORM_CLASS):
         self.result_count = 0
         self.current_page = 1
         self.page_count = 0
+        # キーセットページング用: ページ番号 -> そのページの直前の行のソートキー
+        self.page_keys = {1: None}
         self.current_group = None
+        # 実行中のカタログ取得タスク
+        self.harvest_task = None
+        self.refresh_button_text = None
+        # 実行中のリソースダウンロードと、進捗を表示する前のボタン表示
+        self.download_manager = None
+        self.load_button_text = None
+        # package_showで完全な情報を取得中のパッケージID
+        self.package_show_pending = set()
+        # 完全な情報をキャッシュへ書き込むタスク（完了まで参照を保持する）
+        self.package_save_tasks = set()
+        # カタログ取得中に取得した完全な情報（取得完了後に書き込む）: パッケージID -> パッケージ
+        self.deferred_full_packages = {}
         # TODO:
         # * create settings dialog
         # * read SETTINGS
@@ -598,7 +711,7 @@ class GeoImportDialog(QDialog, FORM_CLASS):
 
             db_path = self._get_cache_db_path()
             from .save_ckan_to_sqlite import save_ckan_packages_to_sqlite
-            save_ckan_packages_to_sqlite(db_path, all_results)
+            save_ckan_packages_to_sqlite(db_path, all_results, self.settings.search_tokenizer)
 
             # groups
             groups_path = os.path.join(local_path, 'groups.json')
@@ -633,7 +746,12 @@ class GeoImportDialog(QDialog, FORM_CLASS):
     def refresh_sqlite_clicked(self):
         """
         全データセットを再取得しSQLiteキャッシュを再作成する（CKAN APIのstartパラメータでページング取得）
+        取得中にもう一度押すと取得を中断する
         """
+        if self.harvest_task is not None:
+            self.util.msg_log_debug(u'カタログ取得を中断します')
+            self.harvest_task.cancel()
+            return
         QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
         try:
             # 1. APIからカテゴリ取得
@@ -864,7 +982,7 @@ class GeoImportDialog(QDialog, FORM_CLASS):
                     if all_results:
                         db_path = self._get_cache_db_path()
                         from .save_ckan_to_sqlite import save_ckan_packages_to_sqlite
-                        save_ckan_packages_to_sqlite(db_path, all_results)
+                        save_ckan_packages_to_sqlite(db_path, all_results, self.settings.search_tokenizer)
                         conn = sqlite3.connect(db_path)
                         c = conn.cursor()
                         c.execute('''CREATE TABLE IF NOT EXISTS groups (raw_json TEXT)''')
@@ -909,89 +1027,79 @@ class GeoImportDialog(QDialog, FORM_CLASS):
                         self.util.dlg_warning(self.util.tr('py_dlg_set_info_local_read_error').format(error_msg))
                     return
 
-            # 1. APIからカテゴリ取得
-            ok, group_result = self.cc.get_groups()
-            if ok is False:
-                QApplication.restoreOverrideCursor()
-                self.util.dlg_warning(group_result)
-                return
-            if not group_result:
-                self.list_all_clicked()
-                return
-            # 2. ページングで全件取得
-            from qgis.PyQt.QtWidgets import QProgressDialog
-            rows_per_page = 1000
-            start = 0
-            all_results = []
-            total_count = None
-            page = 1
-            progress = None
-            while True:
-                ok, page_result = self.cc.package_search('', None, None, rows=rows_per_page, start=start)
-                if not ok or 'results' not in page_result:
-                    break
-                results = page_result['results']
-                if total_count is None:
-                    total_count = page_result.get('count', 0)
-                    max_page = (total_count + rows_per_page - 1) // rows_per_page
-                    progress = QProgressDialog(self.util.tr('CKAN全件取得中...'), self.util.tr('キャンセル'), 0, max_page, self)
-                    progress.setWindowTitle(self.util.tr('進捗'))
-                    progress.setWindowModality(Qt.WindowModality.WindowModal)
-                    progress.setMinimumDuration(0)
-                    progress.setValue(0)
-                if not results:
-                    break
-                all_results.extend(results)
-                if progress:
-                    progress.setValue(page)
-                    progress.setLabelText(self.util.tr('CKAN全件取得中... ({}/{})').format(page, max_page))
-                    titles = [entry.get('title', 'no title') for entry in results]
-                    try:
-                        from qgis.core import QgsMessageLog, Qgis
-                        QgsMessageLog.logMessage(f"取得データセット（ページ{page}）: {titles}", self.util.dlg_caption, Qgis.Info)
-                    except Exception:
-                        pass
-                    QApplication.processEvents()
-                    if progress.wasCanceled():
-                        break
-                if len(all_results) >= total_count:
-                    break
-                if progress and progress.wasCanceled():
-                    break
-                page += 1
-                start += rows_per_page
-            if progress:
-                progress.setValue(max_page)
-                progress.close()
-            if all_results:
-                from qgis.core import QgsMessageLog, Qgis
-                try:
-                    import sqlite3, json
-                    db_path = self._get_cache_db_path()
-                    QgsMessageLog.logMessage(self.util.tr(u"Caching data to SQLite has started."), self.util.dlg_caption, Qgis.Info)
-                    # --- パッケージ保存 ---
-                    from .save_ckan_to_sqlite import save_ckan_packages_to_sqlite
-                    save_ckan_packages_to_sqlite(db_path, all_results)
-                    # --- カテゴリリストも保存 ---
-                    conn = sqlite3.connect(db_path)
-                    c = conn.cursor()
-                    c.execute('''CREATE TABLE IF NOT EXISTS groups (raw_json TEXT)''')
-                    c.execute('DELETE FROM groups')
-                    for group in group_result:
-                        c.execute('INSERT INTO groups (raw_json) VALUES (?)', (json.dumps(group),))
-                    conn.commit()
-                    conn.close()
-                    QgsMessageLog.logMessage(self.util.tr(u"Caching data to SQLite has finished."), self.util.dlg_caption, Qgis.Info)
-                    self.util.msg_log_debug(self.util.tr(u"Saved {} records to SQLite DB: {}.").format(len(all_results), db_path))
-                except Exception as e:
-                    QgsMessageLog.logMessage(self.util.tr(u"SQLite save error: {}".format(e)), self.util.dlg_caption, Qgis.Critical)
-                    self.util.msg_log_error(self.util.tr(u"SQLite save error: {}".format(e)))
-                self.update_format_list(all_results)
-                self.list_all_clicked()
-                self.window_loaded()  # カテゴリ一覧を再表示
+            # 1. カテゴリとデータセットをバックグラウンドタスクで取得（前回同期済みなら差分のみ。Shiftキー押下時は全件取得）
+            from qgis.core import QgsApplication, QgsMessageLog, Qgis
+            from .ckan_harvester import HarvestTask
+            db_path = self._get_cache_db_path()
+            force_full = bool(QApplication.keyboardModifiers() & Qt.KeyboardModifier.ShiftModifier)
+            QgsMessageLog.logMessage(self.util.tr(u"Caching data to SQLite has started."), self.util.dlg_caption, Qgis.Info)
+            self.harvest_task = HarvestTask(
+                self.util.tr(u'CKAN全件取得中...'), self.settings, self.util, self.cc, db_path, force_full=force_full
+            )
+            self.harvest_task.harvestProgress.connect(self._on_harvest_progress)
+            self.harvest_task.harvestFinished.connect(lambda ok, result, db_path=db_path: self._on_harvest_finished(ok, result, db_path))
+            if hasattr(self, 'IDC_bRefreshSqlite'):
+                self.refresh_button_text = self.IDC_bRefreshSqlite.text()
+                self.IDC_bRefreshSqlite.setText(self.util.tr(u'キャンセル'))
+            QgsApplication.taskManager().addTask(self.harvest_task)
         finally:
             QApplication.restoreOverrideCursor()
 
+    def _on_harvest_progress(self, page, max_page, bytes_received, eta):
+        """カタログ取得タスクの進捗をボタンの表示に反映する"""
+        if not hasattr(self, 'IDC_bRefreshSqlite'):
+            return
+        text = self.util.tr(u'CKAN全件取得中... ({}/{})').format(page, max_page)
+        text += u' {0:.1f}MB'.format(bytes_received / (1024 * 1024))
+        if eta >= 0:
+            text += u' ' + self.util.tr(u'残り約{0}秒').format(int(eta))
+        self.IDC_bRefreshSqlite.setToolTip(text)
+        self.IDC_bRefreshSqlite.setText(self.util.tr(u'キャンセル') + u' ({0}/{1})'.format(page, max_page))
+
+    def _on_harvest_finished(self, ok, result, db_path):
+        """カタログ取得タスクの完了時（メインスレッド）にキャッシュを読み直す"""
+        from qgis.core import QgsMessageLog, Qgis
+        self.harvest_task = None
+        if self.deferred_full_packages:
+            # 取得中に保留した完全な情報を、置き換わった（または元のままの）キャッシュDBへ書き込む
+            packages = list(self.deferred_full_packages.values())
+            self.deferred_full_packages = {}
+            self._write_full_packages(packages)
+        if hasattr(self, 'IDC_bRefreshSqlite'):
+            if self.refresh_button_text is not None:
+                self.IDC_bRefreshSqlite.setText(self.refresh_button_text)
+            self.IDC_bRefreshSqlite.setToolTip('')
+        if ok is False:
+            QgsMessageLog.logMessage(self.util.tr(u"SQLite save error: {}".format(result)), self.util.dlg_caption, Qgis.Critical)
+            self.util.dlg_warning(result)
+            return
+        stats = result['stats']
+        self.util.msg_log_debug(
+            u'同期モード: {0}, 取得 {1}件, 削除 {2}件, 完了: {3}, 再開: {4}'.format(
+                result['mode'], result['packages'], result['deleted'], result['completed'], result['resumed']
+            )
+        )
+        if stats:
+            self.util.msg_log_debug(
+                u'SQLite書き込み: {packages}件 / リソース{resources}件, {seconds:.1f}秒 ({rows_per_second:.0f}行/秒)'.format(**stats)
+            )
+        if not result['completed']:
+            # 中断・一部のページの取得失敗ではキャッシュDBは置き換わらない（次回の更新で続きから取得する）
+            if result['error']:
+                message = self.util.tr(u'カタログの取得に失敗したページがあるため、キャッシュは更新されていません: {0}').format(result['error'])
+            else:
+                message = self.util.tr(u'カタログの取得が中断されたため、キャッシュは更新されていません。')
+            message += u'\n' + self.util.tr(u'次回の更新時に続きから取得します。')
+            QgsMessageLog.logMessage(message, self.util.dlg_caption, Qgis.Warning)
+            self.util.dlg_warning(message)
+            return
+        QgsMessageLog.logMessage(self.util.tr(u"Caching data to SQLite has finished."), self.util.dlg_caption, Qgis.Info)
+        self.util.msg_log_debug(self.util.tr(u"Saved {} records to SQLite DB: {}.").format(result['packages'], db_path))
+        if not self.isVisible():
+            return
+        self.list_all_clicked()
+        self.window_loaded()  # カテゴリ一覧とデータ形式リストをキャッシュから再表示
+
 
     def showEvent(self, event):
         self.util.msg_log_debug('showevent')
@@ -1020,7 +1128,7 @@ class GeoImportDialog(QDialog, FORM_CLASS):
             # --- カテゴリリストをSQLiteから取得 ---
             import sqlite3, json
             db_path = self._get_cache_db_path()
-            all_results = []
+            found_formats = []
             # determine if current server is a local folder and get path
             local_path = None
             try:
@@ -1072,12 +1180,9 @@ class GeoImportDialog(QDialog, FORM_CLASS):
                             item.setData(Qt.ItemDataRole.UserRole, group)
                             item.setCheckState(Qt.CheckState.Unchecked)
                             self.IDC_listGroup.addItem(item)
-                    # パッケージ一覧取得
-                    c.execute('SELECT raw_json FROM packages')
-                    rows = c.fetchall()
-                    for row in rows:
-                        entry = json.loads(row[0])
-                        res_list.append(entry)
+                    # データ形式一覧取得（パッケージ全件はデコードしない）
+                    c.execute("SELECT DISTINCT format FROM resources WHERE format IS NOT NULL AND format != ''")
+                    res_list = [row[0] for row in c.fetchall()]
                     conn.close()
                     return True, res_list
                 except Exception as e:
@@ -1086,7 +1191,7 @@ class GeoImportDialog(QDialog, FORM_CLASS):
 
             ok, result = _read_db_and_fill(db_path)
             if ok:
-                all_results = result
+                found_formats = result
             else:
                 # try to auto-create DB from local folder if available
                 if local_path:
@@ -1095,15 +1200,15 @@ class GeoImportDialog(QDialog, FORM_CLASS):
                         # re-read db
                         ok2, result2 = _read_db_and_fill(db_path)
                         if ok2:
-                            all_results = result2
+                            found_formats = result2
                         else:
-                            all_results = None
+                            found_formats = None
                     else:
                         self.util.msg_log_error(f"Failed to create DB from local: {msg}")
-                        all_results = None
+                        found_formats = None
                 else:
-                    all_results = None
-            self.update_format_list(all_results)
+                    found_formats = None
+            self.update_format_list(None, found_formats)
             # 起動時に必ず検索結果を表示
             self.list_all_clicked()
         except Exception as e:
@@ -1153,7 +1258,10 @@ class GeoImportDialog(QDialog, FORM_CLASS):
     def __search_package(self, page=None):
         self.IDC_listResults.clear()
         # ページング制御
-        if page is not None:
+        if page is None:
+            # 検索条件が変わったのでページ送り用のソートキーを破棄
+            self.page_keys = {1: None}
+        else:
             self.util.msg_log_debug(u'page is not None, cp:{0} pg:{1}'.format(self.current_page, page))
             self.current_page = self.current_page + page
             if self.current_page < 1:
@@ -1169,14 +1277,18 @@ class GeoImportDialog(QDialog, FORM_CLASS):
         # カテゴリ（グループ）フィルタを取得
         group_names = self.__get_selected_groups()
         # QThreadでデータ取得
-        self.data_thread = DataFetchThread(db_path, format_text, format_lc, self.current_page, results_limit, self.search_txt, group_names)
+        # 前後ページのソートキーが分かっていればキーセットで1ページ分だけ取得する
+        page_key = self.page_keys.get(self.current_page)
+        self.data_thread = DataFetchThread(db_path, format_text, format_lc, self.current_page, results_limit, self.search_txt, group_names, page_key)
         self.data_thread.result_ready.connect(self._on_data_ready)
         self.data_thread.start()
 
-    def _on_data_ready(self, page_results, result_count, page_count, total_resource_count):
+    def _on_data_ready(self, page_results, result_count, page_count, total_resource_count, next_page_key=None):
         QApplication.restoreOverrideCursor()
         self.result_count = result_count
         self.page_count = page_count
+        if next_page_key is not None:
+            self.page_keys[self.current_page + 1] = next_page_key
         # 全検索結果分のリソース数を表示
         erg_text = f"検索結果　データセット: {self.result_count}件 / データ: {total_resource_count}件"
         self.util.msg_log_debug(erg_text)
@@ -1199,6 +1311,10 @@ class GeoImportDialog(QDialog, FORM_CLASS):
                 title_txt = e
             item = QListWidgetItem(title_txt)
             item.setData(Qt.ItemDataRole.UserRole, entry)
+            # 全文検索のヒット箇所（ハイライト付き抜粋）をツールチップに表示
+            snippet = entry.get('_search_snippet')
+            if snippet:
+                item.setToolTip(snippet.replace('\n', '<br />'))
             self.IDC_listResults.addItem(item)
 
     def list_group_item_changed(self, item):
@@ -1223,8 +1339,11 @@ class GeoImportDialog(QDialog, FORM_CLASS):
         # 詳細情報はcurrentのみ
         if current is not None:
             package = current.data(Qt.ItemDataRole.UserRole)
+            if package is not None and package.get('_partial'):
+                # 取得できるまではキャッシュの情報で表示し、取得後に表示し直す
+                self._fetch_full_package(current, package)
             if package is not None:
-                org = package.get('organization', {})
+                org = package.get('organization') or {}
                 org_name = org.get('title') or org.get('name') or 'no organization'
                 org_desc = org.get('description', '') if isinstance(org, dict) else ''
                 details_text = (
@@ -1261,6 +1380,64 @@ class GeoImportDialog(QDialog, FORM_CLASS):
             sel_count = len(selected_items)
             self.IDC_lblSelectedCount.setText(f"選択中　データセット: {sel_count}件 / データ: {len(all_resources)}件")
 
+    def _fetch_full_package(self, item, package):
+        """
+        軽量プロファイルでキャッシュしたパッケージの完全な情報をpackage_showで非同期に取得する
+        取得できたら一覧とキャッシュを更新する（取得できなければキャッシュの情報のまま表示する）
+        """
+        package_id = package.get('id')
+        if package_id in self.package_show_pending:
+            return
+        self.package_show_pending.add(package_id)
+        self.cc.package_show_async(
+            package_id,
+            lambda ok, full_package, item=item, package_id=package_id: self._on_full_package(item, package_id, ok, full_package)
+        )
+
+    def _on_full_package(self, item, package_id, ok, full_package):
+        self.package_show_pending.discard(package_id)
+        if not ok or not isinstance(full_package, dict):
+            self.util.msg_log_debug(u'package_show失敗: {0}'.format(full_package))
+            return
+        try:
+            item.setData(Qt.ItemDataRole.UserRole, full_package)
+            selected = item.isSelected()
+        except RuntimeError:
+            # 取得中に再検索され、一覧の項目は削除済み
+            selected = False
+        self._save_full_package(full_package)
+        if selected:
+            # リソース一覧を完全な情報で作り直す
+            self.resultitemchanged(self.IDC_listResults.currentItem(), None)
+
+    def _save_full_package(self, full_package):
+        """
+        完全な情報をバックグラウンドでキャッシュへ書き込む
+        カタログ取得中は、完了時にキャッシュDBがステージングDBで置き換わり書き込みが失われるため、取得の完了まで保留する
+        """
+        if self.harvest_task is not None:
+            self.deferred_full_packages[full_package.get('id')] = full_package
+            return
+        self._write_full_packages([full_package])
+
+    def _write_full_packages(self, packages):
+        from qgis.core import QgsApplication, QgsTask
+        db_path = self._get_cache_db_path()
+        tokenizer = self.settings.search_tokenizer
+
+        def save(task):
+            from .save_ckan_to_sqlite import save_ckan_packages_to_sqlite
+            save_ckan_packages_to_sqlite(db_path, packages, tokenizer)
+
+        def finished(exception, result=None):
+            self.package_save_tasks.discard(task)
+            if exception is not None:
+                self.util.msg_log_error(self.util.tr(u"SQLite save error: {}".format(exception)))
+
+        task = QgsTask.fromFunction(self.util.tr(u'パッケージ情報を保存中...'), save, on_finished=finished)
+        self.package_save_tasks.add(task)
+        QgsApplication.taskManager().addTask(task)
+
     def resource_item_changed(self, new_item):
         if new_item is None:
             return
@@ -1269,6 +1446,10 @@ class GeoImportDialog(QDialog, FORM_CLASS):
         self.__fill_link_box(url)
 
     def load_resource_clicked(self):
+        # ダウンロード中にもう一度押すとキャンセル
+        if self.download_manager is not None:
+            self.download_manager.cancel()
+            return
         # シンプルに、UI上に表示されているリソース一覧を基準にダウンロード対象を決定する
         if not hasattr(self, 'IDC_listRessources'):
             self.util.dlg_warning(self.util.tr(u'py_dlg_base_warn_no_resource'))
@@ -1310,12 +1491,22 @@ class GeoImportDialog(QDialog, FORM_CLASS):
         # --- ここからダイアログ抑制用フラグ ---
         # 既存ファイル上書き確認ダイアログの選択（1回目だけ表示、以降は自動適用）
         already_loaded_dialog_answer = None
-        # 大容量ファイル警告ダイアログの選択（1回目だけ表示、以降は自動適用）
-        bigfile_dialog_answer = None
-        # ZIP展開失敗時のダイアログ選択（1回目だけ表示、以降は自動適用）
-        extract_dialog_answer = None
-        # レイヤ追加失敗時のマネージャで開くか確認ダイアログ選択（1回目だけ表示、以降は自動適用）
-        addlayer_dialog_answer = None
+        # ダウンロード完了時の処理と共有する選択（1回目だけ表示、以降は自動適用）
+        answers = {
+            # 大容量ファイル警告ダイアログの選択
+            'bigfile': None,
+            # 大容量ファイル警告ダイアログの表示中に届いた大容量ファイル（「いいえ」なら中止する）
+            'bigfile_pending': None,
+            # ZIP展開失敗時のダイアログ選択
+            'extract': None,
+            # レイヤ追加失敗時のマネージャで開くか確認ダイアログ選択
+            'addlayer': None,
+        }
+
+        # ダウンロードは並列に行い、1件終わるごとにメインスレッドでレイヤを追加する
+        from .download_manager import DownloadManager
+        manager = DownloadManager(self.settings, self.util, self.cc)
+        manager.size_callback = lambda file_size, job: self._confirm_download_size(file_size, job, answers)
 
         # XMLファイル統合処理のセッションは、XMLと判定されるリソースがある場合のみ開始
         xml_candidates = [r for r in all_resources if (r.get('format') and r.get('format').lower() == 'xml') or (r.get('url') and r.get('url').lower().endswith('.xml'))]
@@ -1335,10 +1526,16 @@ class GeoImportDialog(QDialog, FORM_CLASS):
                 resource['name'] = "Unnamed resource"
             self.util.msg_log_debug(u'Bearbeite: {0}'.format(resource['name']))
             # Build readable folder names: <server>_<urlid>/<safe_title>_<package_id>/<safe_name>_<resource_id>
+            # 軽量プロファイルのリソースIDは仮のもの（完全な情報の取得で変わる）のため、フォルダ名には
+            # 代わりにパッケージIDとURLから作るキーを使う
+            from .ckan_harvester import resource_key
+            res_key = resource_key(package.get('id'), resource.get('url'))
+            res_id = resource.get('id') or ''
+            is_placeholder = not res_id or res_id.startswith(res_key + '-')
             pkg_title = package.get('title') or package.get('name') or package.get('id')
-            res_name = resource.get('name') or resource.get('title') or resource.get('id')
+            res_name = resource.get('name') or resource.get('title') or (res_key if is_placeholder else res_id)
             safe_pkg = self.util.safe_filename(pkg_title, fallback=package.get('id'))
-            safe_res = self.util.safe_filename(res_name, fallback=resource.get('id'))
+            safe_res = self.util.safe_filename(res_name, fallback=res_key if is_placeholder else res_id)
 
             # Derive server folder from current CKAN API URL
             server_url = getattr(self.settings, 'ckan_url', '') or 'default'
@@ -1359,15 +1556,20 @@ class GeoImportDialog(QDialog, FORM_CLASS):
             except Exception:
                 pass
 
-            dest_dir = os.path.join(
-                self.settings.cache_dir,
-                server_dir,
-                f"{safe_pkg}_{package['id']}",
-                f"{safe_res}_{resource['id']}"
-            )
+            pkg_dir = os.path.join(self.settings.cache_dir, server_dir, f"{safe_pkg}_{package['id']}")
+            key_dir = os.path.join(pkg_dir, f"{safe_res}_{res_key}")
+            if is_placeholder:
+                dest_dir = key_dir
+            else:
+                # 本来のリソースIDのフォルダ（従来どおり）。軽量プロファイルの表示中に
+                # ダウンロード済みのものがあれば、そのフォルダを使い続ける
+                dest_dir = os.path.join(pkg_dir, f"{safe_res}_{res_id}")
+                if not os.path.isdir(dest_dir) and os.path.isdir(key_dir):
+                    dest_dir = key_dir
             if self.util.create_dir(dest_dir) is False:
                 self.util.dlg_warning(self.util.tr(u'py_dlg_base_warn_cache_dir_not_created').format(dest_dir))
-                return
+                # ここまでにキューへ追加した分はダウンロードする
+                break
             dest_file = os.path.join(dest_dir, os.path.split(resource['url'])[1])
             format_lower = resource['format'].lower()
             url_val = resource.get('url', '').strip()
@@ -1499,91 +1701,130 @@ class GeoImportDialog(QDialog, FORM_CLASS):
                         do_download = True
                     else:
                         do_download = False
-            download_failed = False
             if do_download is True:
-                QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
-                QtWidgets.qApp.processEvents()
-                file_size_ok, file_size, hdr_exception = self.cc.get_file_size(url_val)
-                QApplication.restoreOverrideCursor()
-                if not file_size_ok:
-                    file_size = 0
-                # --- 大容量ファイル警告ダイアログ（1回目だけ表示） ---
-                if file_size > 50:
-                    if bigfile_dialog_answer is None:
+                manager.add(url_val, dest_file, do_delete, data={'resource': resource, 'dest_dir': dest_dir})
+                continue
+            # XYZ形式でURLが空や不正な場合は何もしない（警告も不要）
+            self._add_resource_layers(resource, dest_dir, answers)
+
+        if not manager.jobs:
+            self._finish_xml_session(xml_session_started)
+            return
+        manager.downloadFinished.connect(
+            lambda job, ok, err_msg, file_name: self._on_resource_downloaded(job, ok, err_msg, file_name, answers)
+        )
+        manager.progressChanged.connect(self._on_download_progress)
+        manager.allFinished.connect(lambda: self._on_downloads_finished(xml_session_started))
+        self.download_manager = manager
+        if hasattr(self, 'IDC_bLoadResource'):
+            self.load_button_text = self.IDC_bLoadResource.text()
+            self.IDC_bLoadResource.setText(self.util.tr(u'キャンセル'))
+        manager.start()
+
+    def _confirm_download_size(self, file_size, job, answers):
+        """
+        応答ヘッダーで分かったサイズが大きければ確認する（1回目だけ表示、以降は自動適用）
+        確認ダイアログの表示中に届いたものは回答まで保留し（Noneを返す）、回答後にまとめて知らせる
+        """
+        if file_size <= 50:
+            return True
+        if answers['bigfile'] is None:
+            if answers['bigfile_pending'] is not None:
+                answers['bigfile_pending'].append(job)
+                return None
+            answers['bigfile_pending'] = []
+            if QMessageBox.No == self.util.dlg_yes_no(self.util.tr(u'py_dlg_base_big_file').format(file_size)):
+                answers['bigfile'] = QMessageBox.No
+            else:
+                answers['bigfile'] = QMessageBox.Yes
+            pending_jobs, answers['bigfile_pending'] = answers['bigfile_pending'], []
+            for pending_job in pending_jobs:
+                self.download_manager.size_answered(pending_job, answers['bigfile'] == QMessageBox.Yes)
+        # 2回目以降は前回の選択を自動適用
+        return answers['bigfile'] == QMessageBox.Yes
+
+    def _on_resource_downloaded(self, job, ok, err_msg, file_name, answers):
+        """リソース1件のダウンロード完了時（メインスレッド）にZIPを展開してレイヤを追加する"""
+        resource = job['data']['resource']
+        dest_dir = job['data']['dest_dir']
+        dest_file = job['dest_file']
+        if job['request'] is not None and job['request'].aborted:
+            # キャンセル・大容量ファイルの確認で中止したもの
+            return
+        if ok is False:
+            self.util.dlg_warning(err_msg)
+        else:
+            if file_name:
+                dest_file = file_name
+            if os.path.basename(dest_file).lower().endswith('.zip'):
+                ok, err_msg = self.util.extract_zip(dest_file, dest_dir)
+                # --- ZIP展開失敗時のダイアログ（1回目だけ表示） ---
+                if ok is False:
+                    if answers['extract'] is None:
                         # 1回目だけダイアログ表示し、選択を記憶
-                        if QMessageBox.No == self.util.dlg_yes_no(self.util.tr(u'py_dlg_base_big_file').format(file_size)):
-                            bigfile_dialog_answer = QMessageBox.No
-                            continue
+                        if QMessageBox.No == self.util.dlg_yes_no(self.util.tr(u'py_dlg_base_warn_not_extracted').format(err_msg)):
+                            answers['extract'] = QMessageBox.No
+                            return
                         else:
-                            bigfile_dialog_answer = QMessageBox.Yes
+                            answers['extract'] = QMessageBox.Yes
                     else:
                         # 2回目以降は前回の選択を自動適用
-                        if bigfile_dialog_answer == QMessageBox.No:
-                            continue
-                if hdr_exception:
-                    self.util.msg_log_error(u'error getting size of response, HEAD request failed: {}'.format(hdr_exception))
-                self.util.msg_log_debug('setting wait cursor')
-                QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
-                QtWidgets.qApp.processEvents()
-                self.util.msg_log_debug('wait cursor set')
-                ok, err_msg, new_file_name = self.cc.download_resource(
-                    url_val
-                    , resource['format']
-                    , dest_file
-                    , do_delete
-                )
-                QApplication.restoreOverrideCursor()
-                if ok is False:
-                    self.util.dlg_warning(err_msg)
-                    download_failed = True
-                else:
-                    if new_file_name:
-                        dest_file = new_file_name
-                    if os.path.basename(dest_file).lower().endswith('.zip'):
-                        ok, err_msg = self.util.extract_zip(dest_file, dest_dir)
-                        QApplication.restoreOverrideCursor()
-                        # --- ZIP展開失敗時のダイアログ（1回目だけ表示） ---
-                        if ok is False:
-                            if extract_dialog_answer is None:
-                                # 1回目だけダイアログ表示し、選択を記憶
-                                if QMessageBox.No == self.util.dlg_yes_no(self.util.tr(u'py_dlg_base_warn_not_extracted').format(err_msg)):
-                                    extract_dialog_answer = QMessageBox.No
-                                    continue
-                                else:
-                                    extract_dialog_answer = QMessageBox.Yes
-                            else:
-                                # 2回目以降は前回の選択を自動適用
-                                if extract_dialog_answer == QMessageBox.No:
-                                    continue
-            # XYZ形式でURLが空や不正な場合は何もしない（警告も不要）
-            ok, err_msg = self.util.add_lyrs_from_dir(dest_dir, resource['name'], resource['url'])
-            if ok is False:
-                # --- レイヤ追加失敗時のマネージャで開くか確認ダイアログ（1回目だけ表示） ---
-                if addlayer_dialog_answer is None:
-                    # 1回目だけダイアログ表示し、選択を記憶
-                    if isinstance(err_msg, dict):
-                        if QMessageBox.Yes == self.util.dlg_yes_no(self.util.tr(u'py_dlg_base_open_manager').format(resource['url'])):
-                            addlayer_dialog_answer = QMessageBox.Yes
-                            self.util.open_in_manager(err_msg["dir_path"])
-                        else:
-                            addlayer_dialog_answer = QMessageBox.No
+                        if answers['extract'] == QMessageBox.No:
+                            return
+        self._add_resource_layers(resource, dest_dir, answers)
+
+    def _add_resource_layers(self, resource, dest_dir, answers):
+        ok, err_msg = self.util.add_lyrs_from_dir(dest_dir, resource['name'], resource['url'])
+        if ok is False:
+            # --- レイヤ追加失敗時のマネージャで開くか確認ダイアログ（1回目だけ表示） ---
+            if answers['addlayer'] is None:
+                # 1回目だけダイアログ表示し、選択を記憶
+                if isinstance(err_msg, dict):
+                    if QMessageBox.Yes == self.util.dlg_yes_no(self.util.tr(u'py_dlg_base_open_manager').format(resource['url'])):
+                        answers['addlayer'] = QMessageBox.Yes
+                        self.util.open_in_manager(err_msg["dir_path"])
                     else:
-                        self.util.dlg_warning(self.util.tr(u'py_dlg_base_lyr_not_loaded').format(resource['name'], err_msg))
-                        addlayer_dialog_answer = QMessageBox.No
+                        answers['addlayer'] = QMessageBox.No
                 else:
-                    # 2回目以降は前回の選択を自動適用
-                    if addlayer_dialog_answer == QMessageBox.Yes and isinstance(err_msg, dict):
-                        self.util.open_in_manager(err_msg["dir_path"])
-                continue
+                    self.util.dlg_warning(self.util.tr(u'py_dlg_base_lyr_not_loaded').format(resource['name'], err_msg))
+                    answers['addlayer'] = QMessageBox.No
+            else:
+                # 2回目以降は前回の選択を自動適用
+                if answers['addlayer'] == QMessageBox.Yes and isinstance(err_msg, dict):
+                    self.util.open_in_manager(err_msg["dir_path"])
+
+    def _on_downloads_finished(self, xml_session_started):
+        manager = self.download_manager
+        self.download_manager = None
+        self._restore_load_button()
+        if manager is not None:
+            self.util.msg_log_debug(
+                u'ダウンロード完了: {0}/{1}件{2}'.format(
+                    manager.finished_count, len(manager.jobs), u'（キャンセル）' if manager.cancelled else u''
+                )
+            )
+        self._finish_xml_session(xml_session_started)
 
+    def _finish_xml_session(self, xml_session_started):
         # XMLファイル統合処理のセッションを終了（開始していた場合のみ）
-        try:
-            if xml_session_started:
-                self.util.finish_xml_collection_session()
-        except NameError:
-            # 古いコードパスでは xml_session_started が定義されていない場合がある
-            # その場合は finish を呼ばない
-            pass
+        if xml_session_started:
+            self.util.finish_xml_collection_session()
+
+    def _on_download_progress(self, finished, total, bytes_received, bytes_total):
+        """リソースのダウンロード進捗（全体）をボタンの表示に反映する"""
+        if not hasattr(self, 'IDC_bLoadResource'):
+            return
+        text = u'{0:.1f}MB'.format(bytes_received / (1024 * 1024))
+        if bytes_total > 0:
+            text += u' / {0:.1f}MB ({1}%)'.format(bytes_total / (1024 * 1024), int(bytes_received * 100 / bytes_total))
+        self.IDC_bLoadResource.setToolTip(text)
+        self.IDC_bLoadResource.setText(self.util.tr(u'キャンセル') + u' ({0}/{1})'.format(finished, total))
+
+    def _restore_load_button(self):
+        if self.load_button_text is not None and hasattr(self, 'IDC_bLoadResource'):
+            self.IDC_bLoadResource.setText(self.load_button_text)
+            self.IDC_bLoadResource.setToolTip('')
+        self.load_button_text = None
 
     def next_page_clicked(self):
         self.__search_package(page=+1)
@@ -156,6 +156,7 @@ class GeoImportDialogDataProviders(QDialog, FORM_CLASS):
                     # not needed anymore, as we use QgsNetworkAccessManager.instance() now
                     #, proxies=self.settings.get_proxies()[1]
                     , timeout=self.settings.request_timeout
+                    , cache=True
                 )
 
                 if not response.ok:
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class HttpCache:
+    """
+    APIのJSON応答の永続キャッシュ（条件付きリクエスト用）
+    ETag/Last-Modifiedを持つ200応答を保存し、次回はIf-None-Match/If-Modified-Sinceで再検証する
+    304が返れば保存済みの本文を使うため、変更のないポータルの再閲覧ではほとんど転送しない
+    URLと認証設定（authcfg）の組ごとに保存し、合計サイズがMAX_BYTESを超えたら古いものから消す
+    """
+
+    FILE_NAME = 'http_cache.db'
+    MAX_BYTES = 100 * 1024 * 1024
+
+    def __init__(self, cache_dir):
+        self.db_path = os.path.join(cache_dir, self.FILE_NAME)
+
+    def _connect(self):
+        # 収集の並列ワーカーからも呼ばれるため、操作ごとに接続する
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                headers TEXT,
+                body BLOB,
+                size INTEGER,
+                stored REAL,
+                accessed REAL
+            )
+        ''')
+        return conn
+
+    @staticmethod
+    def key(url, authcfg):
+        return hashlib.sha1(u'{0}\n{1}'.format(authcfg or '', url).encode('utf-8')).hexdigest()
+
+    def lookup(self, url, authcfg):
+        """保存済みの応答（dict）を返す。無ければNone"""
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    'SELECT etag, last_modified, headers, body FROM responses WHERE key=?',
+                    (self.key(url, authcfg),)
+                ).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'headers': json.loads(row[2]), 'body': row[3]}
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry.get('etag'):
+            headers[b'If-None-Match'] = entry['etag'].encode()
+        if entry.get('last_modified'):
+            headers[b'If-Modified-Since'] = entry['last_modified'].encode()
+        return headers
+
+    @staticmethod
+    def is_storable(headers):
+        """再検証できる（検証子があり、no-storeでない）応答ならTrue"""
+        if 'no-store' in (headers.get('cache-control') or '').lower():
+            return False
+        return bool(headers.get('etag') or headers.get('last-modified'))
+
+    def store(self, url, authcfg, headers, body):
+        if not self.is_storable(headers):
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (self.key(url, authcfg), url, headers.get('etag'), headers.get('last-modified'),
+                         json.dumps(headers), sqlite3.Binary(body), len(body), now, now)
+                    )
+                    self._prune(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+    def touch(self, url, authcfg, headers):
+        """304で再検証できた応答の参照時刻（と更新された検証子）を記録する"""
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        'UPDATE responses SET accessed=?, etag=COALESCE(?, etag), last_modified=COALESCE(?, last_modified) '
+                        'WHERE key=?',
+                        (time.time(), headers.get('etag'), headers.get('last-modified'), self.key(url, authcfg))
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _prune(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.MAX_BYTES:
+            return
+        expired = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if total <= self.MAX_BYTES:
+                break
+            expired.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM responses WHERE key=?', expired)
@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import inspect
-
-from urllib.parse import unquote
+import os
+import random
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from urllib.parse import unquote, urlparse
+from qgis.PyQt.QtCore import QByteArray
 from qgis.PyQt.QtCore import QEventLoop
+from qgis.PyQt.QtCore import QObject
+from qgis.PyQt.QtCore import QTimer
 from qgis.PyQt.QtCore import QUrl
+from qgis.PyQt.QtCore import pyqtSignal
 from qgis.PyQt.QtNetwork import QNetworkReply
 from qgis.PyQt.QtNetwork import QNetworkRequest
 from qgis.core import QgsApplication
 from qgis.core import QgsNetworkAccessManager
 
+from .http_cache import HttpCache
 from .settings import Settings
 from .util import Util
 
@@ -30,9 +40,565 @@ class RequestsExceptionUserAbort(RequestsException):
     pass
 
 
+class RequestsExceptionHostUnavailable(RequestsException):
+    """HostHealthが遮断中のためリクエストを送らなかった（retry_after: 遮断が明けるまでの秒数）"""
+
+    def __init__(self, message, retry_after=0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RetryPolicy:
+    """
+    一時的な失敗（タイムアウト・接続断・429・5xx）をジッター付き指数バックオフで再試行する方針
+    Retry-Afterヘッダーがあればその秒数（またはHTTP日付）まで待つ
+    同じホストへの再試行はホストごとの予算（トークンバケット）で制限し、落ちているサーバーへの再試行の連発を防ぐ
+    """
+
+    RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+    RETRY_METHODS = ('get', 'head')
+    # ホストごとの再試行予算: 最大BUDGET_CAPACITY回、BUDGET_REFILL_SECONDSごとに1回分回復
+    BUDGET_CAPACITY = 20
+    BUDGET_REFILL_SECONDS = 6.0
+
+    _budgets = {}
+    _budgets_lock = threading.Lock()
+
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, method, response):
+        if method.lower() not in self.RETRY_METHODS:
+            return False
+        if isinstance(response.exception, RequestsExceptionUserAbort):
+            return False
+        if response.status_code in self.RETRY_STATUS_CODES:
+            return True
+        # HTTPステータスが無い＝接続・タイムアウト等のネットワークエラー
+        # 2xxでエラー＝本文の転送途中で切断された
+        return response.exception is not None and (
+            response.status_code is None or 200 <= response.status_code < 300
+        )
+
+    def delay(self, attempt, response):
+        """attempt回目（0始まり）の再試行までの待ち秒数"""
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        # フルジッター: 0～base*2^attempt の一様乱数
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def retry_after(self, response):
+        value = (response.headers or {}).get('retry-after')
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def consume_budget(self, url):
+        """ホストの再試行予算を1回分使う。使い切っていればFalse"""
+        host = urlparse(url).netloc.lower()
+        now = time.monotonic()
+        with self._budgets_lock:
+            tokens, updated = self._budgets.get(host, (float(self.BUDGET_CAPACITY), now))
+            tokens = min(float(self.BUDGET_CAPACITY), tokens + (now - updated) / self.BUDGET_REFILL_SECONDS)
+            if tokens < 1.0:
+                self._budgets[host] = (tokens, now)
+                return False
+            self._budgets[host] = (tokens - 1.0, now)
+            return True
+
+
+class HostHealth:
+    """
+    ホストごとの接続状態キャッシュ（サーキットブレーカー）
+    正常なホストへのリクエストは事前確認なしでそのまま送る
+    接続に続けて失敗したホストは一定時間（TTL）遮断し、リクエストを送らずに即座に失敗とする
+    TTLを過ぎたら確認リクエストを1回だけ通し（half-open）、成功すれば復帰、失敗すれば遮断時間を延ばす
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    # 遮断するまでの連続失敗回数（1回の失敗は再試行を使い切った後の結果）
+    FAILURE_THRESHOLD = 2
+    OPEN_SECONDS = 30.0
+    MAX_OPEN_SECONDS = 300.0
+    # ホストが落ちているとみなす応答（HTTPステータスなし＝接続・タイムアウト等のエラーも含む）
+    FAILURE_STATUS_CODES = (502, 503, 504)
+
+    _hosts = {}
+    _hosts_lock = threading.Lock()
+
+    @staticmethod
+    def host_key(url):
+        return urlparse(url).netloc.lower()
+
+    @classmethod
+    def acquire(cls, url):
+        """
+        ホストの状態を返す
+        遮断のTTLが切れていれば最初の呼び出し元にだけHALF_OPENを返す（確認はその呼び出し元が行う）
+        """
+        host = cls.host_key(url)
+        now = time.monotonic()
+        with cls._hosts_lock:
+            entry = cls._hosts.get(host)
+            if entry is None or entry['open_until'] is None:
+                return cls.CLOSED
+            if entry['probing'] or now < entry['open_until']:
+                return cls.OPEN
+            entry['probing'] = True
+            return cls.HALF_OPEN
+
+    @classmethod
+    def remaining_open_seconds(cls, url):
+        """遮断が明けるまでの秒数（確認中なら確認が終わる頃まで）。遮断していなければ0"""
+        with cls._hosts_lock:
+            entry = cls._hosts.get(cls.host_key(url))
+            if entry is None or entry['open_until'] is None:
+                return 0.0
+            remaining = entry['open_until'] - time.monotonic()
+            if entry['probing']:
+                remaining = max(remaining, 1.0)
+            return max(0.0, remaining)
+
+    @classmethod
+    def reason(cls, url):
+        with cls._hosts_lock:
+            entry = cls._hosts.get(cls.host_key(url))
+            return entry['reason'] if entry else None
+
+    @classmethod
+    def is_failure(cls, response):
+        if isinstance(response.exception, RequestsExceptionUserAbort):
+            return False
+        if response.status_code is None:
+            return response.exception is not None
+        return response.status_code in cls.FAILURE_STATUS_CODES
+
+    @classmethod
+    def record(cls, url, response):
+        """応答結果をホストの状態に反映する"""
+        if isinstance(response.exception, RequestsExceptionUserAbort):
+            return
+        if cls.is_failure(response):
+            cls.record_failure(url, response.reason or str(response.status_code))
+        else:
+            cls.record_success(url)
+
+    @classmethod
+    def record_success(cls, url):
+        with cls._hosts_lock:
+            cls._hosts.pop(cls.host_key(url), None)
+
+    @classmethod
+    def record_failure(cls, url, reason):
+        host = cls.host_key(url)
+        now = time.monotonic()
+        with cls._hosts_lock:
+            entry = cls._hosts.setdefault(
+                host, {'failures': 0, 'open_until': None, 'open_seconds': 0.0, 'probing': False, 'reason': None}
+            )
+            entry['failures'] += 1
+            entry['reason'] = reason
+            if entry['probing']:
+                # 確認に失敗したので遮断時間を倍にして再び遮断
+                entry['open_seconds'] = min(cls.MAX_OPEN_SECONDS, entry['open_seconds'] * 2)
+                entry['open_until'] = now + entry['open_seconds']
+                entry['probing'] = False
+            elif entry['failures'] >= cls.FAILURE_THRESHOLD:
+                entry['open_seconds'] = entry['open_seconds'] or cls.OPEN_SECONDS
+                entry['open_until'] = now + entry['open_seconds']
+
+
+class Response:
+    """
+    1回分の応答（requestsのResponse互換の最小限の属性）
+    ヘッダー等が他の応答と混ざらないよう、状態はすべてインスタンスごとに持つ
+    """
+
+    def __init__(self, url=None):
+        self.url = url
+        self.status_code = 200
+        self.status_message = 'OK'
+        self.text = ''
+        self.ok = True
+        self.headers = {}
+        self.reason = ''
+        self.exception = None
+        # download_file指定時は本文をメモリに持たず、書き込んだファイルとサイズを持つ
+        self.download_file = None
+        self.bytes_written = 0
+        # Rangeで途中から再開した場合の開始位置
+        self.resumed_from = 0
+        # 304で再検証し、HttpCacheに保存済みの本文を返した場合True
+        self.from_cache = False
+
+    def iter_content(self, _):
+        return [self.text]
+
+
+class HttpRequest(QObject):
+    """
+    非同期リクエスト1件分
+    QNetworkReplyをリクエストごとに持つため、同じHttpCallから何件でも同時に送れる
+    完了するとrequestFinished(Response)を発行する。wait()で完了を待てばFuture相当に使える
+    一時的な失敗はRetryPolicyに従い、タイマーで再送する（イベントループは止めない）
+    download_fileを指定すると、本文はreadyReadのたびにそのファイルへ書き込む（メモリ使用量は一定）
+    if_range（ETag/Last-Modified）を指定し、download_fileが途中まであればRangeで続きから取得する
+    サーバーが206を返さなければ最初から取り直す
+    download_fileの指定時は圧縮転送を使わない（identity=Falseで圧縮を許可。その場合Rangeでの再開は行わない）
+    cache=TrueのGETはHttpCacheの保存済み応答を条件付きで再検証し、304なら保存済みの本文で200として完了する
+    """
+
+    requestFinished = pyqtSignal(object)
+    # 本文の前に応答ヘッダー（2xx）を受け取った時点で1回だけ発行: status_code, headers（小文字キー）
+    headersReceived = pyqtSignal(object, object)
+    # bytes_received, bytes_total（2GBを超えるためobjectで渡す）
+    downloadProgress = pyqtSignal(object, object)
+
+    # ファイルへ書き出す場合の受信バッファ上限（これを超えるとQtがソケットからの読み込みを止める）
+    DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+    # 完了前に呼び出し元が参照を手放してもGCされないよう、実行中のリクエストを保持する
+    _in_flight = set()
+
+    def __init__(self, http_call, url, **kwargs):
+        super().__init__()
+        self.http_call = http_call
+        self.settings = http_call.settings
+        self.util = http_call.util
+        self.url = url
+        self.kwargs = kwargs
+        self.method = kwargs.get('http_method', 'get')
+        self.retry = kwargs.get('retry', True)
+        self.attempt = 0
+        self.reply = None
+        self.response = None
+        self.aborted = False
+        self.done = False
+        self.mb_downloaded = 0
+        self.download_file = kwargs.get('download_file')
+        self._file = None
+        self._bytes_written = 0
+        self._write_error = None
+        self._resume_validator = kwargs.get('if_range')
+        self._resume_offset = 0
+        self._append = False
+        self._restart = False
+        self._expected_size = None
+        self._headers_emitted = False
+        self.cache = None
+        self._cache_entry = None
+        if kwargs.get('cache') and self.method == 'get' and not self.download_file:
+            self.cache = http_call.response_cache()
+        self._retry_timer = QTimer(self)
+        self._retry_timer.setSingleShot(True)
+        self._retry_timer.timeout.connect(self._send)
+
+    def start(self):
+        self._in_flight.add(self)
+        self._send()
+        return self
+
+    def is_finished(self):
+        return self.done
+
+    def result(self):
+        """完了していれば応答、未完了ならNone"""
+        return self.response if self.done else None
+
+    def wait(self):
+        """完了までイベントループを回して待ち、応答を返す"""
+        if not self.done:
+            loop = QEventLoop()
+            self.requestFinished.connect(loop.quit)
+            # quitを繋ぐ前に完了していた場合に備えて再確認
+            if not self.done:
+                loop.exec()
+        return self.response
+
+    def add_done_callback(self, callback):
+        """完了時にcallback(response)を呼ぶ。完了済みならすぐに呼ぶ"""
+        if self.done:
+            callback(self.response)
+        else:
+            self.requestFinished.connect(callback)
+
+    def abort(self):
+        """
+        転送を中止する。応答はRequestsExceptionUserAbortで完了する
+        完了後に呼ばれた場合も（確認ダイアログの表示中に転送が終わった等）中止扱いにする
+        """
+        if self.done:
+            self.aborted = True
+            return
+        self.aborted = True
+        self._retry_timer.stop()
+        self._close_file()
+        if self.reply is not None and self.reply.isRunning():
+            # finishedが発行され_on_finishedで完了する
+            self.reply.abort()
+            return
+        self.response = self.response or Response(self.url)
+        self._abort_response(self.response)
+        self._finish()
+
+    def _abort_response(self, response):
+        response.ok = False
+        response.reason = 'Aborted by user'
+        response.exception = RequestsExceptionUserAbort(response.reason)
+
+    def _send(self):
+        if self.aborted:
+            return
+        self._close_file()
+        self._bytes_written = 0
+        self._append = False
+        self._restart = False
+        # 途中までのファイルと検証子があれば続きから要求する（無ければ最初から書き直す）
+        self._resume_offset = 0
+        kwargs = self.kwargs
+        if self.download_file and self._resume_validator and HttpCall.is_identity(kwargs) \
+                and os.path.exists(self.download_file):
+            self._resume_offset = os.path.getsize(self.download_file)
+        if self._resume_offset:
+            headers = dict(kwargs.get('headers') or {})
+            headers[b'Range'] = 'bytes={0}-'.format(self._resume_offset).encode()
+            headers[b'If-Range'] = self._resume_validator.encode()
+            kwargs = dict(kwargs, headers=headers)
+            self.util.msg_log_debug(u'{0}バイト目から再開します: {1}'.format(self._resume_offset, self.url))
+        if self.cache is not None:
+            self._cache_entry = self.cache.lookup(self.url, self.settings.authcfg)
+            if self._cache_entry is not None:
+                headers = dict(kwargs.get('headers') or {})
+                headers.update(self.cache.conditional_headers(self._cache_entry))
+                kwargs = dict(kwargs, headers=headers)
+        try:
+            req = self.http_call.build_request(self.url, **kwargs)
+            self.util.msg_log_debug(u'http_call request: {} {}'.format(self.method, req.url().toString()))
+            method_call = getattr(QgsNetworkAccessManager.instance(), self.method)
+            self.reply = method_call(req)
+            self.reply.setReadBufferSize(self.DOWNLOAD_BUFFER_SIZE if self.download_file else 0)
+            if self.settings.authcfg:
+                self.util.msg_log_debug("update reply w/ authcfg: {0}".format(self.settings.authcfg))
+                QgsApplication.authManager().updateNetworkReply(self.reply, self.settings.authcfg)
+            self.reply.downloadProgress.connect(self._on_progress)
+            self.reply.metaDataChanged.connect(self._on_meta_data_changed)
+            if self.download_file:
+                self.reply.readyRead.connect(self._on_ready_read)
+            self.reply.finished.connect(self._on_finished)
+        except Exception as e:
+            self.util.msg_log_error(u'unexpected error sending request: {0}'.format(self.url))
+            self.util.msg_log_last_exception()
+            self.response = Response(self.url)
+            self.response.ok = False
+            self.response.status_code = None
+            self.response.reason = str(e)
+            self.response.exception = e
+            self._finish()
+
+    def _on_progress(self, bytes_received, bytes_total):
+        if self._append:
+            # 再開時はファイル全体に対する進捗にする
+            bytes_received += self._resume_offset
+            if bytes_total > 0:
+                bytes_total += self._resume_offset
+        self.downloadProgress.emit(bytes_received, bytes_total)
+        mb_received = bytes_received / (1024 * 1024)
+        if mb_received - self.mb_downloaded >= 1:
+            self.mb_downloaded = mb_received
+            self.util.msg_log_debug(
+                u'downloadProgress {:.1f} of {:.1f} MB" '
+                .format(mb_received, bytes_total / (1024 * 1024))
+            )
+
+    def _on_meta_data_changed(self):
+        # 再試行・再開で送り直しても、ヘッダーの通知は最初の応答の1回だけ
+        if self._headers_emitted or self.reply is None or not self._is_success(self.reply):
+            return
+        self._headers_emitted = True
+        headers = {}
+        for k, v in self.reply.rawHeaderPairs():
+            headers[k.data().decode().lower()] = v.data().decode()
+        self.headersReceived.emit(self.http_call.status_code(self.reply), headers)
+
+    def _on_ready_read(self):
+        # エラー応答の本文はファイルに書かず、従来どおりtextに読み込む
+        if self._file is None:
+            if not self._is_success(self.reply):
+                return
+            if not self._begin_body(self.reply):
+                self.reply.abort()
+                return
+        try:
+            self._write(self.reply.readAll())
+        except (IOError, OSError) as e:
+            # スロット内の例外はQtまで伝えず、転送を止めて応答のエラーにする
+            self._write_error = e
+            self._close_file()
+            self.reply.abort()
+
+    def _is_success(self, reply):
+        status = self.http_call.status_code(reply)
+        return status is not None and 200 <= status < 300
+
+    def _begin_body(self, reply):
+        """本文の書き込み前に、続きへ追記（206）か最初から（200）かを決める。範囲が合わなければFalse"""
+        self._append = False
+        status = self.http_call.status_code(reply)
+        content_range = bytes(reply.rawHeader(b'Content-Range')).decode('latin-1')
+        # 完了時に受信サイズを確かめるため、ファイル全体の大きさを控えておく
+        # （圧縮転送ではContent-Lengthが展開前の大きさのため確かめない）
+        self._expected_size = None
+        if not bytes(reply.rawHeader(b'Content-Encoding')).strip():
+            self._expected_size = HttpCall.content_size(status, {
+                'content-length': bytes(reply.rawHeader(b'Content-Length')).decode('latin-1'),
+                'content-range': content_range,
+            })
+        if self._resume_offset and status == 206:
+            # Content-Range: bytes <start>-<end>/<total>
+            try:
+                start = int(content_range.split()[1].split('-')[0])
+            except (IndexError, ValueError):
+                start = None
+            if start != self._resume_offset:
+                self.util.msg_log_warning(u'要求と異なる範囲が返されたため最初から取得します: {0}'.format(content_range))
+                self._restart = True
+                return False
+            self._append = True
+            self._bytes_written = self._resume_offset
+        elif self._resume_offset:
+            self.util.msg_log_debug(u'サーバーが再開に応じなかったため最初から取得します: {0}'.format(self.url))
+        return True
+
+    def _write(self, data):
+        if self._file is None:
+            self._file = open(self.download_file, 'ab' if self._append else 'wb')
+        if data:
+            self._file.write(data.data() if hasattr(data, 'data') else data)
+            self._bytes_written += len(data)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _on_finished(self):
+        reply = self.reply
+        self.reply = None
+        streamed = False
+        if self.download_file and self._write_error is None and not self.aborted \
+                and reply.error() == self.http_call.QNR_NO_ERROR:
+            try:
+                # 残りを書き出す（空の本文でもファイルは作る）
+                if self._file is not None or self._begin_body(reply):
+                    self._write(reply.readAll())
+                    streamed = True
+            except (IOError, OSError) as e:
+                self._write_error = e
+        self._close_file()
+        # 接続が切れても正常終了扱いになる場合があるため、受信サイズで判定する
+        incomplete = streamed and self._expected_size is not None and self._bytes_written != self._expected_size
+        if self.download_file and self._resume_offset and not self.aborted \
+                and (self._restart or self.http_call.status_code(reply) == 416):
+            # 範囲が合わない・要求範囲が無効（416）ならファイルを捨てて最初から取り直す
+            reply.deleteLater()
+            self._resume_validator = None
+            os.remove(self.download_file)
+            self._send()
+            return
+        response = self.http_call.read_reply(reply, Response(self.url))
+        if incomplete:
+            msg = 'Incomplete download: {0} of {1} bytes'.format(self._bytes_written, self._expected_size)
+            self.util.msg_log_error(msg)
+            response.ok = False
+            response.reason = msg
+            response.exception = RequestsExceptionConnectionError(msg)
+        elif streamed:
+            response.download_file = self.download_file
+            response.bytes_written = self._bytes_written
+            response.resumed_from = self._resume_offset if self._append else 0
+        if self._write_error is not None:
+            self.util.msg_log_error(u'ダウンロードファイルの書き込みに失敗: {0} - {1}'.format(self.download_file, self._write_error))
+            response.ok = False
+            response.reason = str(self._write_error)
+            response.exception = self._write_error
+        if self.aborted:
+            self._abort_response(response)
+        elif self.cache is not None:
+            self._apply_cache(response)
+        try:
+            reply.deleteLater()
+        except Exception:
+            self.util.msg_log_error('unexpected error deleting QNetworkReply')
+            self.util.msg_log_last_exception()
+        self.response = response
+
+        if self._schedule_retry(response):
+            return
+        # 接続前の事前確認を省くため、結果をホストの状態キャッシュに残す
+        HostHealth.record(self.url, response)
+        self._finish()
+
+    def _apply_cache(self, response):
+        """304なら保存済みの応答で置き換え、再検証できる200なら保存する"""
+        if response.status_code == 304 and self._cache_entry is not None:
+            self.util.msg_log_debug(u'304 Not Modified: キャッシュを使用します: {0}'.format(self.url))
+            headers = dict(self._cache_entry['headers'])
+            # 304の本文長は保存済みの本文に当てはまらないため引き継がない
+            headers.update({k: v for k, v in response.headers.items() if k.lower() != 'content-length'})
+            response.headers = headers
+            response.status_code = 200
+            response.status_message = 'OK'
+            response.text = QByteArray(self._cache_entry['body'])
+            response.from_cache = True
+            self.cache.touch(self.url, self.settings.authcfg, headers)
+        elif response.ok and response.status_code == 200:
+            self.cache.store(self.url, self.settings.authcfg, response.headers, bytes(response.text))
+
+    def _schedule_retry(self, response):
+        policy = self.http_call.retry_policy
+        if response.ok or self.aborted or self._write_error is not None or not self.retry or not policy.is_retryable(self.method, response):
+            return False
+        if self.attempt >= policy.max_retries:
+            self.util.msg_log_warning(u'再試行の上限に達しました ({0}回): {1}'.format(self.attempt, self.url))
+            return False
+        if not policy.consume_budget(self.url):
+            self.util.msg_log_warning(u'ホストの再試行予算を使い切ったため再試行しません: {0}'.format(self.url))
+            return False
+        delay = policy.delay(self.attempt, response)
+        self.attempt += 1
+        if self.download_file:
+            # 受信済みの部分は検証子があれば再試行時に続きから取得する
+            self._resume_validator = HttpCall.range_validator(response.headers)
+        self.util.msg_log_debug(
+            u'{0:.1f}秒後に再試行します ({1}/{2}): {3} [{4}]'.format(
+                delay, self.attempt, policy.max_retries, self.url, response.status_code or response.reason
+            )
+        )
+        self._retry_timer.start(int(delay * 1000))
+        return True
+
+    def _finish(self):
+        self.done = True
+        self._in_flight.discard(self)
+        self.requestFinished.emit(self.response)
+
+
 class HttpCall:
     """
     Wrapper around gsNetworkAccessManager and QgsAuthManager to make HTTP calls.
+    execute_request_async()はHttpRequestを返し、複数のリクエストを同時に実行できる
+    execute_request()は従来どおり応答が返るまで待つ
     """
 
     def __init__(self, settings, util):
@@ -41,7 +607,7 @@ class HttpCall:
         assert isinstance(util, Util)
         self.settings = settings
         self.util = util
-        self.reply = None
+        self.retry_policy = RetryPolicy(max_retries=getattr(settings, 'http_max_retries', 4))
 
     # Qt5 / Qt6 の違いで QNetworkReply のエラー定数が名前空間化されている場合があるため
     # ここで互換性用の定数を解決しておく（Qt5/Qt6対応）
@@ -61,50 +627,64 @@ class HttpCall:
             QNR_TIMEOUT_ERROR = getattr(QNetworkReply, 'TimeoutError', 1)
             QNR_CONNECTION_REFUSED_ERROR = getattr(QNetworkReply, 'ConnectionRefusedError', 2)
 
-    
+    # 圧縮率による展開の打ち切りを行わない展開後のサイズ（Qt6）
+    DECOMPRESSED_SAFETY_CHECK_THRESHOLD = 256 * 1024 * 1024
+
     def execute_request(self, url, **kwargs):
         """
         Uses QgsNetworkAccessManager and QgsAuthManager.
+        一時的な失敗はRetryPolicyに従って再試行する（retry=Falseで無効）
+        最終的な結果はHostHealthに記録する
         """
-        # HTTPメソッドを取得（デフォルトはget）
-        method = kwargs.get('http_method', 'get')
+        return self.execute_request_async(url, **kwargs).wait()
 
-        headers = kwargs.get('headers', {})
-        # 圧縮コンテンツが正しく展開されない問題を修正
-        # QNetworkRequestにこのヘッダーを設定すると、QNetworkAccessManagerに
-        # 「自分で処理するからコンテンツエンコーディング処理はしないでください」と伝えることになる
+    def execute_request_async(self, url, **kwargs):
+        """
+        リクエストを送信してすぐにHttpRequestを返す（完了はrequestFinishedで通知）
+        引数はexecute_requestと同じ
+        """
+        return HttpRequest(self, url, **kwargs).start()
+
+    def response_cache(self):
+        """条件付きリクエスト用のHttpCache（設定で無効、またはキャッシュフォルダが無ければNone）"""
+        if not getattr(self.settings, 'http_cache', True):
+            return None
+        cache_dir = getattr(self.settings, 'cache_dir', None)
+        if not cache_dir or not os.path.isdir(cache_dir):
+            return None
+        return HttpCache(cache_dir)
+
+    def build_request(self, url, **kwargs):
+        """QNetworkRequestを組み立てる"""
+        # 呼び出し元の辞書（CkanConnector.ua_chrome等）は書き換えない
+        headers = dict(kwargs.get('headers') or {})
+        # Accept-Encodingを自分で設定するとQtは本文を展開しないため、指定されていても送らない
+        # 未設定ならQtがgzip/deflateを要求し、受信時に展開する（Qt5/Qt6共通）
         # 参照: https://bugs.webkit.org/show_bug.cgi?id=63696#c1
-        try:
-            del headers[b'Accept-Encoding']
-        except KeyError as ke:
-            # 1回目の削除後は存在しないため、デバッグレベルでログ出力
-            self.util.msg_log_debug(u'unexpected error deleting request header: {}'.format(ke))
-            pass
+        for key in list(headers):
+            name = key.decode('latin-1') if isinstance(key, bytes) else key
+            if name.lower() == 'accept-encoding':
+                del headers[key]
+        # identity: 圧縮させずにそのままのバイト列を受け取る（サイズ確認やRangeで再開するダウンロード用）
+        if HttpCall.is_identity(kwargs):
+            headers[b'Accept-Encoding'] = b'identity'
 
         # QUrlによる二重クォートを回避
-        url = unquote(url)
-
-        self.util.msg_log_debug(u'http_call request: {} {}'.format(method, url))
-
-        # レスポンスオブジェクトの定義
-        class Response:
-            status_code = 200
-            status_message = 'OK'
-            text = ''
-            ok = True
-            headers = {}
-            reason = ''
-            exception = None
-
-            def iter_content(self, _):
-                return [self.text]
-
-        self.http_call_result = Response()
+        # encoded: クエリの値をエンコード済みのURL（APIの検索条件など）は、&や+の意味が変わるので戻さない
+        if not kwargs.get('encoded'):
+            url = unquote(url)
         url = self.util.remove_newline(url)
 
         # ネットワークリクエストを作成
         req = QNetworkRequest()
         req.setUrl(QUrl(url))
+        # timeout（秒）は転送が止まってからの打ち切り時間として設定する（Qt 5.15以降）
+        timeout = kwargs.get('timeout')
+        if timeout and hasattr(req, 'setTransferTimeout'):
+            req.setTransferTimeout(int(timeout * 1000))
+        # Qt6は展開後10MBを超えると圧縮率で展開を打ち切るため、大きなJSON（カタログ取得のページ等）用に引き上げる（Qt 6.2以降）
+        if hasattr(req, 'setDecompressedSafetyCheckThreshold'):
+            req.setDecompressedSafetyCheckThreshold(self.DECOMPRESSED_SAFETY_CHECK_THRESHOLD)
         # FollowRedirectsAttribute は Qt のバージョンで存在しない場合があるため
         # 存在チェックしてから設定する（Qt5/Qt6互換性のため）
         try:
@@ -127,171 +707,102 @@ class HttpCall:
             except:
                 self.util.msg_log_error(u'FAILED to set header: {} => {}'.format(k, v))
                 self.util.msg_log_last_exception()
+        if kwargs.get('cache'):
+            # 再検証はHttpCacheで行うため、Qtのディスクキャッシュは読み書きしない
+            # （Qtが304を保存済みの応答に置き換えると、こちらで本文を得られない）
+            try:
+                req.setAttribute(QNetworkRequest.Attribute.CacheLoadControlAttribute, QNetworkRequest.CacheLoadControl.AlwaysNetwork)
+                req.setAttribute(QNetworkRequest.Attribute.CacheSaveControlAttribute, False)
+            except AttributeError:
+                req.setAttribute(QNetworkRequest.CacheLoadControlAttribute, QNetworkRequest.AlwaysNetwork)
+                req.setAttribute(QNetworkRequest.CacheSaveControlAttribute, False)
         if self.settings.authcfg:
-            self.util.msg_log_debug(u'before updateNetworkRequest')
             QgsApplication.authManager().updateNetworkRequest(req, self.settings.authcfg)
-            self.util.msg_log_debug(u'before updateNetworkRequest')
-
-        if self.reply is not None and self.reply.isRunning():
-            self.reply.close()
-
-        self.util.msg_log_debug(u'getting QgsNetworkAccessManager.instance()')
-        #func = getattr(QgsNetworkAccessManager.instance(), method)
-        #func = QgsNetworkAccessManager().get(req)
-
-
-
-
-        #manager = QNetworkAccessManager()
-        #event = QEventLoop()
-        #response = manager.get(QNetworkRequest(QUrl(url)))
-        #response.downloadProgress.connect(self.download_progress)
-        #response.finished.connect(event.quit)
-        #event.exec()
-        #response_msg = response.readAll()
-        ##response_msg = str(response_msg)
-        #response_msg = str(response_msg, encoding='utf-8')
-        ##response_msg = response_msg.decode('utf-8')
-        #response.deleteLater()
-        #self.util.msg_log_debug(u'response message:\n{} ...'.format(response_msg[:255]))
-        #self.http_call_result.text = response_msg  # in Python3 all strings are unicode, so QString is not defined
-        #return self.http_call_result
-
-
-
-        # Calling the server ...
-        self.util.msg_log_debug('before self.reply = func(req)')
-        #self.reply = func(req)
-        #self.reply = QgsNetworkAccessManager.instance().get(req)
-        method_call = getattr(QgsNetworkAccessManager.instance(), method)
-        self.reply = method_call(req)
-        #self.reply.setReadBufferSize(1024*1024*1024)
-        #self.reply.setReadBufferSize(1024 * 1024 * 1024 * 1024)
-        self.reply.setReadBufferSize(0)
-        self.util.msg_log_debug('after self.reply = func(req)')
-
-        # Let's log the whole call for debugging purposes:
-        if self.settings.debug:
-            self.util.msg_log_debug("\nSending %s request to %s" % (method.upper(), req.url().toString()))
-            headers = {str(h): str(req.rawHeader(h)) for h in req.rawHeaderList()}
-            for k, v in headers.items():
-                try:
-                    self.util.msg_log_debug("%s: %s" % (k, v))
-                except:
-                    self.util.msg_log_debug('error logging headers')
-
-        if self.settings.authcfg:
-            self.util.msg_log_debug("update reply w/ authcfg: {0}".format(self.settings.authcfg))
-            QgsApplication.authManager().updateNetworkReply(self.reply, self.settings.authcfg)
-
-        self.util.msg_log_debug('before connecting to events')
-
-        # connect downloadProgress event
+        return req
+
+    @staticmethod
+    def is_identity(kwargs):
+        """圧縮転送を使わないリクエストか（identity指定、無指定ならdownload_file指定時）"""
+        return bool(kwargs.get('identity', bool(kwargs.get('download_file'))))
+
+    @staticmethod
+    def range_validator(headers):
+        """If-Rangeに使える検証子（強いETag、無ければLast-Modified）"""
+        etag = (headers or {}).get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return (headers or {}).get('last-modified') or None
+
+    @staticmethod
+    def content_size(status_code, headers):
+        """リソース全体のバイト数（206はContent-Rangeの全体長、それ以外はContent-Length）。不明ならNone"""
+        headers = headers or {}
+        value = headers.get('content-length') or ''
+        if status_code == 206:
+            value = (headers.get('content-range') or '').rpartition('/')[2]
+        value = value.strip()
+        return int(value) if value.isdigit() else None
+
+    def status_code(self, reply):
+        """HTTPステータスコード（まだ受信していなければNone）"""
+        # Qt6では QNetworkRequest.Attribute.<Name> へ移動している
         try:
-            self.reply.downloadProgress.connect(self.download_progress)
-            #pass
-        except:
-            self.util.msg_log_error('error connecting "downloadProgress" event')
-            self.util.msg_log_last_exception()
-
-        # connect reply finished event
-        try:
-            self.reply.finished.connect(self.reply_finished)
-            #pass
-        except:
-            self.util.msg_log_error('error connecting reply "finished" progress event')
-            self.util.msg_log_last_exception()
-        self.util.msg_log_debug('after connecting to events')
+            return reply.attribute(QNetworkRequest.Attribute.HttpStatusCodeAttribute)
+        except AttributeError:
+            return reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
 
-        # Call and block
-        self.event_loop = QEventLoop()
-        try:
-            self.reply.finished.connect(self.event_loop.quit)
-        except:
-            self.util.msg_log_error('error connecting reply "finished" progress event to event loop quit')
-            self.util.msg_log_last_exception()
-
-        self.mb_downloaded = 0
-        # Catch all exceptions (and clean up requests)
-        self.event_loop.exec()
-
-        # Let's log the whole response for debugging purposes:
-        if self.settings.debug:
-            self.util.msg_log_debug(
-                u'\nGot response [{}/{}] ({} bytes) from:\n{}\nexception:{}'.format(
-                    self.http_call_result.status_code,
-                    self.http_call_result.status_message,
-                    len(self.http_call_result.text),
-                    self.reply.url().toString(),
-                    self.http_call_result.exception
-                )
-            )
-            headers = {str(h): str(self.reply.rawHeader(h)) for h in self.reply.rawHeaderList()}
-            for k, v in headers.items():
-                self.util.msg_log_debug("%s: %s" % (k, v))
-            self.util.msg_log_debug("Payload :\n%s ......" % self.http_call_result.text[:255])
-
-        self.reply.close()
-        self.util.msg_log_debug("Deleting reply ...")
-        try:
-            self.reply.deleteLater()
-        except:
-            self.util.msg_log_error('unexpected error deleting QNetworkReply')
-            self.util.msg_log_last_exception()
-
-        self.reply = None
-
-        if self.http_call_result.exception is not None:
-            self.util.msg_log_error('http_call_result.exception is not None')
-            self.http_call_result.ok = False
-            # raise self.http_call_result.exception
-        return self.http_call_result
-
-    def download_progress(self, bytes_received, bytes_total):
-        mb_received = bytes_received / (1024 * 1024)
-        if mb_received - self.mb_downloaded >= 1:
-            self.mb_downloaded = mb_received
-            self.util.msg_log_debug(
-                u'downloadProgress {:.1f} of {:.1f} MB" '
-                .format(mb_received, bytes_total / (1024 * 1024))
-            )
-
-    def reply_finished(self):
+    def read_reply(self, reply, response):
+        """完了したQNetworkReplyの内容をresponseに読み込む"""
         self.util.msg_log_debug('------- reply_finished')
         try:
-            err = self.reply.error()
-            # Qt6では QNetworkRequest.Attribute.<Name> へ移動している
+            err = reply.error()
+            httpStatus = self.status_code(reply)
             try:
-                httpStatus = self.reply.attribute(QNetworkRequest.Attribute.HttpStatusCodeAttribute)
-                httpStatusMessage = self.reply.attribute(QNetworkRequest.Attribute.HttpReasonPhraseAttribute)
+                httpStatusMessage = reply.attribute(QNetworkRequest.Attribute.HttpReasonPhraseAttribute)
             except AttributeError:
-                httpStatus = self.reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
-                httpStatusMessage = self.reply.attribute(QNetworkRequest.HttpReasonPhraseAttribute)
-            self.http_call_result.status_code = httpStatus
-            self.http_call_result.status_message = httpStatusMessage
-            for k, v in self.reply.rawHeaderPairs():
-                self.http_call_result.headers[k.data().decode()] = v.data().decode()
-                self.http_call_result.headers[k.data().decode().lower()] = v.data().decode()
+                httpStatusMessage = reply.attribute(QNetworkRequest.HttpReasonPhraseAttribute)
+            response.status_code = httpStatus
+            response.status_message = httpStatusMessage
+            for k, v in reply.rawHeaderPairs():
+                response.headers[k.data().decode()] = v.data().decode()
+                response.headers[k.data().decode().lower()] = v.data().decode()
             if err == self.QNR_NO_ERROR:
                 self.util.msg_log_debug('QNetworkReply.NoError')
-                self.http_call_result.text = self.reply.readAll()
-                self.http_call_result.ok = True
+                response.text = reply.readAll()
+                response.ok = True
             else:
                 self.util.msg_log_error('QNetworkReply Error')
-                self.http_call_result.ok = False
+                response.ok = False
                 msg = "Network error #{0}: {1}"\
                     .format(
-                        self.reply.error(),
-                        self.reply.errorString()
+                        reply.error(),
+                        reply.errorString()
                 )
-                self.http_call_result.reason = msg
+                response.reason = msg
                 self.util.msg_log_error(msg)
-                if err == QNR_TIMEOUT_ERROR:
-                    self.http_call_result.exception = RequestsExceptionTimeout(msg)
-                if err == self.QNR_CONNECTION_REFUSED_ERROR:
-                    self.http_call_result.exception = RequestsExceptionConnectionError(msg)
+                if err == self.QNR_TIMEOUT_ERROR:
+                    response.exception = RequestsExceptionTimeout(msg)
+                elif err == self.QNR_CONNECTION_REFUSED_ERROR:
+                    response.exception = RequestsExceptionConnectionError(msg)
                 else:
-                    self.http_call_result.exception = Exception(msg)
+                    response.exception = Exception(msg)
         except:
             self.util.msg_log_error(u'unexpected error in {}'.format(inspect.stack()[0][3]))
             self.util.msg_log_last_exception()
+            response.ok = False
+
+        # Let's log the whole response for debugging purposes:
+        if self.settings.debug:
+            self.util.msg_log_debug(
+                u'\nGot response [{}/{}] ({} bytes) from:\n{}\nexception:{}'.format(
+                    response.status_code,
+                    response.status_message,
+                    len(response.text),
+                    response.url,
+                    response.exception
+                )
+            )
+        if response.exception is not None:
+            self.util.msg_log_error('http_call_result.exception is not None')
+            response.ok = False
+        return response
@@ -1,12 +1,27 @@
+import itertools
 import sqlite3
 import os
 import json
+import time
 
-def save_ckan_packages_to_sqlite(db_path, packages):
-    # ログ出力は呼び出し元で行うこと
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    # テーブル作成
+
+# 検索・絞り込み用の派生カラム（raw_jsonから生成）。旧キャッシュDBの移行時に追加する
+_PACKAGE_DERIVED_COLUMNS = (
+    ('name', 'TEXT'),
+    ('organization', 'TEXT'),
+    ('metadata_modified', 'TEXT'),
+    ('search_text', 'TEXT'),
+)
+_RESOURCE_DERIVED_COLUMNS = (
+    ('format_lc', 'TEXT'),
+)
+
+
+def _create_tables(c, tokenizer=None):
+    """
+    キャッシュDBのテーブルとインデックスを作成する
+    tokenizer: 全文検索インデックスのトークン化方式（Noneなら既存の方式を維持）
+    """
     c.execute('''CREATE TABLE IF NOT EXISTS packages (
         id TEXT PRIMARY KEY,
         title TEXT,
@@ -14,7 +29,11 @@ def save_ckan_packages_to_sqlite(db_path, packages):
         author TEXT,
         author_email TEXT,
         license_id TEXT,
-        raw_json TEXT
+        raw_json TEXT,
+        name TEXT,
+        organization TEXT,
+        metadata_modified TEXT,
+        search_text TEXT
     )''')
     c.execute('''CREATE TABLE IF NOT EXISTS resources (
         id TEXT PRIMARY KEY,
@@ -23,6 +42,7 @@ def save_ckan_packages_to_sqlite(db_path, packages):
         url TEXT,
         name TEXT,
         raw_json TEXT,
+        format_lc TEXT,
         FOREIGN KEY(package_id) REFERENCES packages(id)
     )''')
     c.execute('''CREATE TABLE IF NOT EXISTS groups (
@@ -32,60 +52,782 @@ def save_ckan_packages_to_sqlite(db_path, packages):
         description TEXT,
         raw_json TEXT
     )''')
-    # データ挿入
-    for pkg in packages:
-        c.execute('''INSERT OR REPLACE INTO packages (id, title, notes, author, author_email, license_id, raw_json) VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            (
-                pkg.get('id'),
-                pkg.get('title'),
-                pkg.get('notes'),
-                pkg.get('author'),
-                pkg.get('author_email'),
-                pkg.get('license_id'),
-                json.dumps(pkg, ensure_ascii=False)
-            )
+    # パッケージ⇔グループの対応表（グループ絞り込みをSQLで行うため）
+    c.execute('''CREATE TABLE IF NOT EXISTS package_groups (
+        package_id TEXT,
+        group_name TEXT,
+        PRIMARY KEY(package_id, group_name)
+    )''')
+    # 旧スキーマのDBには派生カラムが無いので追加する
+    migrated = _add_missing_columns(c, 'packages', _PACKAGE_DERIVED_COLUMNS)
+    migrated = _add_missing_columns(c, 'resources', _RESOURCE_DERIVED_COLUMNS) or migrated
+    c.execute('CREATE INDEX IF NOT EXISTS idx_resources_format_lc ON resources (format_lc, package_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_resources_package_id ON resources (package_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_package_groups_group ON package_groups (group_name, package_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_packages_organization ON packages (organization)')
+    if migrated:
+        _backfill_derived_columns(c)
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )''')
+    # サーバーごとの差分同期の状態（metadata_modifiedの最大値＝ハイウォーターマーク）
+    c.execute('''CREATE TABLE IF NOT EXISTS sync_state (
+        server_url TEXT PRIMARY KEY,
+        high_water_mark TEXT,
+        last_sync TEXT,
+        last_full_sync TEXT,
+        harvest_filter TEXT
+    )''')
+    _add_missing_columns(c, 'sync_state', (('harvest_filter', 'TEXT'),))
+    # 中断したカタログ取得の再開用チェックポイント（サーバーごと）
+    c.execute('''CREATE TABLE IF NOT EXISTS harvest_runs (
+        server_url TEXT PRIMARY KEY,
+        mode TEXT,
+        high_water_mark TEXT,
+        started TEXT,
+        harvest_filter TEXT
+    )''')
+    _add_missing_columns(c, 'harvest_runs', (('harvest_filter', 'TEXT'),))
+    c.execute('''CREATE TABLE IF NOT EXISTS harvest_checkpoints (
+        server_url TEXT,
+        seq INTEGER,
+        shard TEXT,
+        next_offset INTEGER DEFAULT 0,
+        total INTEGER,
+        PRIMARY KEY (server_url, shard)
+    )''')
+    # 全文検索インデックス（SQLiteがFTS5付きでビルドされている場合のみ）
+    if _create_fts_table(c, tokenizer):
+        _rebuild_fts(c)
+        _bump_generation(c)
+
+
+# 全文検索インデックスのトークン化方式
+# trigram:   FTS5組み込みのtrigramトークナイザ（3文字以上の部分一致。SQLite 3.34以降）
+# bigram:    CJK文字列を2文字ずつ区切ってからunicode61で索引（1文字以上の語に対応）
+# unicode61: FTS5標準（空白・記号区切り。日本語の文中の語はヒットしない）
+FTS_TOKENIZERS = ('trigram', 'bigram', 'unicode61')
+
+
+def _get_meta(c, key):
+    c.execute('SELECT value FROM cache_meta WHERE key = ?', (key,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(c, key, value):
+    c.execute(
+        'INSERT INTO cache_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+        (key, value)
+    )
+
+
+def get_cache_generation(c):
+    """
+    キャッシュ内容の世代番号（パッケージが書き込まれるたびに増える）
+    検索件数などの読み取り側キャッシュの無効化に使う
+    """
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'cache_meta'")
+    if c.fetchone() is None:
+        return 0
+    return int(_get_meta(c, 'generation') or 0)
+
+
+def _bump_generation(c):
+    _set_meta(c, 'generation', str(get_cache_generation(c) + 1))
+
+
+# trigramトークナイザが使えるか（プロセス内で1回だけ確認する）
+_trigram_supported = None
+
+
+def _resolve_tokenizer(c, tokenizer):
+    """このSQLiteで使えるトークン化方式に読み替える（trigramが無い古いSQLiteではbigram）"""
+    global _trigram_supported
+    if tokenizer != 'trigram':
+        return tokenizer
+    if _trigram_supported is None:
+        try:
+            c.execute("CREATE VIRTUAL TABLE temp.fts_trigram_probe USING fts5(x, tokenize = 'trigram')")
+            c.execute('DROP TABLE temp.fts_trigram_probe')
+            _trigram_supported = True
+        except sqlite3.OperationalError:
+            _trigram_supported = False
+    return 'trigram' if _trigram_supported else 'bigram'
+
+
+def _create_fts_table(c, tokenizer=None):
+    """
+    全文検索用のFTS5仮想テーブルを作成する。rowidはpackages.rowidと一致させる
+    tokenizerが既存インデックスと異なる場合は作り直す
+    新規作成した場合のみTrueを返す（既存データの投入が必要）
+    """
+    current = _get_meta(c, 'fts_tokenizer') if has_fts(c) else None
+    if tokenizer is not None or current is None:
+        # このSQLiteで使えない方式は、作成時と同じく代わりの方式に読み替えてから比べる
+        # （読み替えずに比べると、保存のたびに不一致としてインデックスを作り直してしまう）
+        tokenizer = _resolve_tokenizer(c, tokenizer if tokenizer in FTS_TOKENIZERS else 'trigram')
+    if current is not None and (tokenizer is None or tokenizer == current):
+        return False
+    c.execute('DROP TABLE IF EXISTS packages_fts')
+    for candidate in (tokenizer, 'bigram'):
+        fts_tokenize = 'trigram' if candidate == 'trigram' else 'unicode61'
+        try:
+            c.execute('''CREATE VIRTUAL TABLE packages_fts USING fts5(
+                title, notes, tags, author, organization, tokenize = '{0}'
+            )'''.format(fts_tokenize))
+        except sqlite3.OperationalError:
+            # trigramが無い古いSQLiteではbigramに切り替え、FTS5自体が無ければsearch_textの部分一致検索のみ
+            continue
+        _set_meta(c, 'fts_tokenizer', candidate)
+        return True
+    return False
+
+
+def has_fts(c):
+    c.execute("SELECT name FROM sqlite_master WHERE name = 'packages_fts'")
+    return c.fetchone() is not None
+
+
+def get_fts_tokenizer(c):
+    """現在の全文検索インデックスのトークン化方式（インデックスが無ければNone）"""
+    if not has_fts(c):
+        return None
+    c.execute("SELECT name FROM sqlite_master WHERE name = 'cache_meta'")
+    if c.fetchone() is None:
+        # メタ情報導入前のインデックスはunicode61
+        return 'unicode61'
+    return _get_meta(c, 'fts_tokenizer') or 'unicode61'
+
+
+def _is_cjk(ch):
+    code = ord(ch)
+    return (
+        0x3040 <= code <= 0x30FF      # ひらがな・カタカナ
+        or 0x3400 <= code <= 0x4DBF   # CJK統合漢字拡張A
+        or 0x4E00 <= code <= 0x9FFF   # CJK統合漢字
+        or 0xF900 <= code <= 0xFAFF   # CJK互換漢字
+        or 0xFF66 <= code <= 0xFF9F   # 半角カタカナ
+        or 0x20000 <= code <= 0x2FFFF
+    )
+
+
+def _split_cjk_runs(text):
+    """テキストを(CJK文字列か, 文字列)の連続に分割する"""
+    runs = []
+    for ch in text:
+        cjk = _is_cjk(ch)
+        if runs and runs[-1][0] == cjk:
+            runs[-1][1].append(ch)
+        else:
+            runs.append((cjk, [ch]))
+    return [(cjk, ''.join(chars)) for cjk, chars in runs]
+
+
+def _cjk_bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def cjk_bigram_text(text):
+    """
+    索引用にCJK文字列を重なりのある2文字単位に展開する（例: 都市計画 → 都市 市計 計画 画）
+    末尾の1文字も残すことで、1文字の検索語も前方一致でヒットする
+    """
+    parts = []
+    for cjk, run in _split_cjk_runs(text):
+        if cjk:
+            parts.extend(_cjk_bigrams(run))
+            parts.append(run[-1])
+        else:
+            parts.append(run)
+    return ' '.join(parts)
+
+
+def _fts_values(pkg, tokenizer=None):
+    """FTSの各カラムに入れるテキスト（title, notes, tags, author, organization）"""
+    title = pkg.get('title')
+    if isinstance(title, dict):
+        title = ' '.join(str(v) for v in title.values())
+    tags = []
+    for tag in pkg.get('tags') or []:
+        if isinstance(tag, dict) and 'name' in tag:
+            tags.append(str(tag['name']))
+        elif isinstance(tag, str):
+            tags.append(tag)
+    authors = [str(pkg[k]) for k in ('author', 'maintainer') if pkg.get(k)]
+    org = pkg.get('organization')
+    org_texts = []
+    if isinstance(org, dict):
+        org_texts = [str(org[k]) for k in ('name', 'title', 'description') if org.get(k)]
+    values = (
+        str(title) if title else '',
+        str(pkg.get('notes') or ''),
+        ' '.join(tags),
+        ' '.join(authors),
+        ' '.join(org_texts),
+    )
+    if tokenizer == 'bigram':
+        values = tuple(cjk_bigram_text(v) for v in values)
+    return values
+
+
+def _write_fts(c, package_id, pkg, tokenizer=None):
+    c.execute('SELECT rowid FROM packages WHERE id = ?', (package_id,))
+    row = c.fetchone()
+    if row is None:
+        return
+    c.execute('DELETE FROM packages_fts WHERE rowid = ?', (row[0],))
+    c.execute(
+        'INSERT INTO packages_fts (rowid, title, notes, tags, author, organization) VALUES (?, ?, ?, ?, ?, ?)',
+        (row[0],) + _fts_values(pkg, tokenizer)
+    )
+
+
+def _rebuild_fts(c):
+    tokenizer = get_fts_tokenizer(c)
+    c.execute('DELETE FROM packages_fts')
+    for package_id, raw_json in c.execute('SELECT id, raw_json FROM packages').fetchall():
+        try:
+            pkg = json.loads(raw_json)
+        except (TypeError, ValueError):
+            continue
+        _write_fts(c, package_id, pkg, tokenizer)
+
+
+def _fts_phrase(tokens, prefix):
+    phrase = '"{0}"'.format(' '.join(tokens).replace('"', '""'))
+    return phrase + '*' if prefix else phrase
+
+
+def build_fts_query(search_txt, tokenizer='unicode61'):
+    """
+    検索語をFTS5のMATCH式に変換する（空白区切りの各語をAND条件）
+    記号がFTS5の構文として解釈されないよう、各語はダブルクォートで囲む
+    戻り値: (MATCH式またはNone, インデックスで検索できない語のリスト)
+    インデックスで検索できない語（trigramで3文字未満）は呼び出し側でsearch_textの部分一致にする
+    """
+    terms = []
+    fallback_terms = []
+    for term in search_txt.split():
+        if tokenizer == 'trigram':
+            # trigramは3文字未満の語を索引から引けない
+            if len(term) < 3:
+                fallback_terms.append(term)
+            else:
+                terms.append(_fts_phrase([term], False))
+        elif tokenizer == 'bigram':
+            runs = _split_cjk_runs(term)
+            tokens = []
+            for cjk, run in runs:
+                if cjk and len(run) > 1:
+                    tokens.extend(_cjk_bigrams(run))
+                else:
+                    tokens.append(run)
+            last_cjk, last_run = runs[-1]
+            # 1文字のCJKや英数字で終わる語は前方一致にする
+            terms.append(_fts_phrase(tokens, not last_cjk or len(last_run) == 1))
+        else:
+            terms.append(_fts_phrase([term], True))
+    return (' '.join(terms) or None), fallback_terms
+
+
+def _add_missing_columns(c, table, columns):
+    existing = {row[1] for row in c.execute('PRAGMA table_info({0})'.format(table))}
+    added = False
+    for name, col_type in columns:
+        if name not in existing:
+            c.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(table, name, col_type))
+            added = True
+    return added
+
+
+def _backfill_derived_columns(c):
+    """旧キャッシュDBの派生カラム・対応表をraw_jsonから一度だけ再構築する"""
+    rows = c.execute('SELECT id, raw_json FROM packages').fetchall()
+    for package_id, raw_json in rows:
+        try:
+            pkg = json.loads(raw_json)
+        except (TypeError, ValueError):
+            continue
+        c.execute(
+            'UPDATE packages SET name = ?, organization = ?, metadata_modified = ?, search_text = ? WHERE id = ?',
+            (pkg.get('name'), _organization_name(pkg), pkg.get('metadata_modified'), _search_text(pkg), package_id)
         )
-        for res in pkg.get('resources', []):
-            c.execute('''INSERT OR REPLACE INTO resources (id, package_id, format, url, name, raw_json) VALUES (?, ?, ?, ?, ?, ?)''',
-                (
-                    res.get('id'),
-                    pkg.get('id'),
-                    res.get('format'),
-                    res.get('url'),
-                    res.get('name'),
-                    json.dumps(res, ensure_ascii=False)
-                )
-            )
+        _write_package_groups(c, package_id, pkg)
+    rows = c.execute('SELECT id, format FROM resources').fetchall()
+    c.executemany(
+        'UPDATE resources SET format_lc = ? WHERE id = ?',
+        [(_format_lc({'format': fmt}), res_id) for res_id, fmt in rows]
+    )
+
+
+def ensure_cache_schema(conn):
+    """
+    既存のキャッシュDBを最新スキーマに揃える（検索前に呼び出す）
+    キャッシュ未作成のDBにはテーブルを作らない（ローカルフォルダからの自動作成判定を妨げないため）
+    """
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'packages'")
+    if c.fetchone() is None:
+        return
+    _create_tables(c)
     conn.commit()
-    conn.close()
+
+
+def _organization_name(pkg):
+    org = pkg.get('organization')
+    if isinstance(org, dict):
+        return org.get('name') or org.get('title')
+    if isinstance(org, str):
+        return org
+    return None
+
+
+def _format_lc(res):
+    return (res.get('format') or '').strip().lower()
+
+
+def _search_text(pkg):
+    """
+    テキスト検索対象（タイトル・説明・タグ・作成者・組織）を小文字で連結する
+    """
+    text_fields = []
+    title = pkg.get('title')
+    if title:
+        if isinstance(title, dict):
+            text_fields.extend(str(v) for v in title.values())
+        else:
+            text_fields.append(str(title))
+    if pkg.get('notes'):
+        text_fields.append(str(pkg['notes']))
+    for tag in pkg.get('tags') or []:
+        if isinstance(tag, dict) and 'name' in tag:
+            text_fields.append(str(tag['name']))
+        elif isinstance(tag, str):
+            text_fields.append(tag)
+    if pkg.get('author'):
+        text_fields.append(str(pkg['author']))
+    if pkg.get('maintainer'):
+        text_fields.append(str(pkg['maintainer']))
+    org = pkg.get('organization')
+    if isinstance(org, dict):
+        for k in ('name', 'title', 'description'):
+            v = org.get(k)
+            if v:
+                text_fields.append(str(v))
+    # 区切りに改行を使い、フィールドをまたいだ誤一致を避ける
+    return '\n'.join(text_fields).lower()
+
+
+def _write_package_groups(c, package_id, pkg):
+    c.execute('DELETE FROM package_groups WHERE package_id = ?', (package_id,))
+    for group in pkg.get('groups') or []:
+        if isinstance(group, dict) and group.get('name'):
+            c.execute(
+                'INSERT OR IGNORE INTO package_groups (package_id, group_name) VALUES (?, ?)',
+                (package_id, group['name'])
+            )
+
+
+def connect_for_write(db_path):
+    """
+    大量書き込み用にチューニングした接続を開く
+    WALにより書き込み中も検索（読み取り）をブロックしない
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # WALではNORMALでもDBが壊れることはない（電源断時に直近のコミットが失われるのみ）
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA cache_size = -65536')  # 64MB
+    return conn
+
+
+def _batched(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+# INSERT OR REPLACEはrowidが変わるため、FTSと対応が取れるようUPSERTで更新する
+_UPSERT_PACKAGE_SQL = '''INSERT INTO packages (id, title, notes, author, author_email, license_id, raw_json, name, organization, metadata_modified, search_text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET title = excluded.title, notes = excluded.notes, author = excluded.author,
+        author_email = excluded.author_email, license_id = excluded.license_id, raw_json = excluded.raw_json,
+        name = excluded.name, organization = excluded.organization,
+        metadata_modified = excluded.metadata_modified, search_text = excluded.search_text'''
+
+
+def _write_package_batch(c, batch, fts, tokenizer):
+    """1バッチ分のパッケージ・リソース・グループ対応・FTSをexecutemanyでまとめて書き込む"""
+    # 取得中に更新されたデータセットは後のページにも現れるため、同じIDは後のものだけを使う
+    # （重複したままだとFTSに同じrowidを2回挿入してしまう）
+    batch = list({pkg.get('id'): pkg for pkg in batch}.values())
+    package_rows = []
+    group_rows = []
+    fts_rows = []
+    resource_rows = []
+    package_ids = []
+    for pkg in batch:
+        package_id = pkg.get('id')
+        package_ids.append((package_id,))
+        package_rows.append((
+            package_id,
+            pkg.get('title'),
+            pkg.get('notes'),
+            pkg.get('author'),
+            pkg.get('author_email'),
+            pkg.get('license_id'),
+            json.dumps(pkg, ensure_ascii=False),
+            pkg.get('name'),
+            _organization_name(pkg),
+            pkg.get('metadata_modified'),
+            _search_text(pkg)
+        ))
+        for group in pkg.get('groups') or []:
+            if isinstance(group, dict) and group.get('name'):
+                group_rows.append((package_id, group['name']))
+        if fts:
+            fts_rows.append(_fts_values(pkg, tokenizer) + (package_id,))
+        for res in pkg.get('resources') or []:
+            resource_rows.append((
+                res.get('id'),
+                package_id,
+                res.get('format'),
+                res.get('url'),
+                res.get('name'),
+                json.dumps(res, ensure_ascii=False),
+                _format_lc(res)
+            ))
+    c.executemany(_UPSERT_PACKAGE_SQL, package_rows)
+    # 更新されたパッケージの古いグループ対応・リソースは入れ替える
+    c.executemany('DELETE FROM package_groups WHERE package_id = ?', package_ids)
+    c.executemany('INSERT OR IGNORE INTO package_groups (package_id, group_name) VALUES (?, ?)', group_rows)
+    c.executemany('DELETE FROM resources WHERE package_id = ?', package_ids)
+    c.executemany(
+        'INSERT OR REPLACE INTO resources (id, package_id, format, url, name, raw_json, format_lc) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        resource_rows
+    )
+    if fts:
+        c.executemany('DELETE FROM packages_fts WHERE rowid = (SELECT rowid FROM packages WHERE id = ?)', package_ids)
+        c.executemany(
+            'INSERT INTO packages_fts (rowid, title, notes, tags, author, organization)'
+            ' SELECT rowid, ?, ?, ?, ?, ? FROM packages WHERE id = ?',
+            fts_rows
+        )
+    return len(package_rows), len(resource_rows)
+
+
+def save_ckan_packages_to_sqlite(db_path, packages, tokenizer=None, batch_size=1000, progress_callback=None):
+    """
+    パッケージをSQLiteキャッシュに一括保存する
+    packages: パッケージdictのイテラブル（ジェネレータ可。batch_size件ずつ読み出して書き込む）
+    progress_callback: バッチ書き込みごとに呼ばれる callback(保存済みパッケージ数)
+    戻り値: 保存件数と書き込み速度のdict（packages, resources, seconds, rows_per_second）
+    """
     # ログ出力は呼び出し元で行うこと
+    started = time.monotonic()
+    package_count = 0
+    resource_count = 0
+    conn = connect_for_write(db_path)
+    try:
+        c = conn.cursor()
+        # テーブル作成
+        _create_tables(c, tokenizer)
+        conn.commit()
+        fts = has_fts(c)
+        tokenizer = get_fts_tokenizer(c)
+        # データ挿入（バッチごとに1トランザクション）
+        for batch in _batched(packages, batch_size):
+            n_packages, n_resources = _write_package_batch(c, batch, fts, tokenizer)
+            _bump_generation(c)
+            conn.commit()
+            package_count += n_packages
+            resource_count += n_resources
+            if progress_callback is not None:
+                progress_callback(package_count)
+        _bump_generation(c)
+        conn.commit()
+    finally:
+        conn.close()
+    seconds = time.monotonic() - started
+    rows = package_count + resource_count
+    # ログ出力は呼び出し元で行うこと
+    return {
+        'packages': package_count,
+        'resources': resource_count,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds > 0 else 0.0,
+    }
+
+
+def get_sync_state(db_path, server_url):
+    """
+    差分同期の状態を返す（未同期ならNone）
+    戻り値: {'high_water_mark', 'last_sync', 'last_full_sync', 'harvest_filter'}
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sync_state'")
+        if c.fetchone() is None:
+            return None
+        c.execute('SELECT * FROM sync_state WHERE server_url = ?', (server_url,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        state = dict(zip([column[0] for column in c.description], row))
+        return {
+            'high_water_mark': state.get('high_water_mark'),
+            'last_sync': state.get('last_sync'),
+            'last_full_sync': state.get('last_full_sync'),
+            'harvest_filter': state.get('harvest_filter'),
+        }
+    finally:
+        conn.close()
+
+
+def update_sync_state(db_path, server_url, full_sync=False, harvest_filter=None, advance=True):
+    """
+    同期完了時に呼び出し、キャッシュ内のmetadata_modifiedの最大値をハイウォーターマークとして記録する
+    harvest_filter: 取得時の絞り込み条件（条件が変わった場合は次回を全件同期にするため記録する）
+    advance: Falseなら取りこぼしがあった範囲を次回も取得するよう、ハイウォーターマークを進めない
+        （差分同期は前回のまま、全件同期は記録しない＝次回も全件同期）
+    """
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    conn = sqlite3.connect(db_path)
+    try:
+        c = conn.cursor()
+        _create_tables(c)
+        high_water_mark = None
+        if advance:
+            c.execute('SELECT MAX(metadata_modified) FROM packages')
+            high_water_mark = c.fetchone()[0]
+        elif not full_sync:
+            c.execute('SELECT high_water_mark FROM sync_state WHERE server_url = ?', (server_url,))
+            row = c.fetchone()
+            high_water_mark = row[0] if row else None
+        c.execute(
+            '''INSERT INTO sync_state (server_url, high_water_mark, last_sync, last_full_sync, harvest_filter) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(server_url) DO UPDATE SET high_water_mark = excluded.high_water_mark,
+                last_sync = excluded.last_sync,
+                last_full_sync = coalesce(excluded.last_full_sync, sync_state.last_full_sync),
+                harvest_filter = excluded.harvest_filter''',
+            (server_url, high_water_mark, now, now if full_sync else None, harvest_filter or '')
+        )
+        conn.commit()
+        return high_water_mark
+    finally:
+        conn.close()
+
+
+def staging_db_path(db_path):
+    """カタログ取得中の書き込み先（ステージングDB）のパス"""
+    return db_path + '.staging'
+
+
+def _remove_db_files(path):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def create_staging_db(db_path):
+    """
+    現在のキャッシュDBを複製してステージングDBを作る（差分同期は既存データに追記するため）
+    残っている古いステージングDBは破棄する
+    戻り値: ステージングDBのパス
+    """
+    staging_path = staging_db_path(db_path)
+    _remove_db_files(staging_path)
+    if os.path.exists(db_path):
+        src = sqlite3.connect(db_path)
+        dst = sqlite3.connect(staging_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    return staging_path
+
+
+def swap_staging_db(db_path):
+    """
+    ステージングDBの内容をキャッシュDBへ1トランザクションで反映し、ステージングDBを削除する
+    SQLiteのバックアップAPIで置き換えるため、検索中の読み取り側は切り替え前後どちらかの一貫した内容だけを見る
+    """
+    staging_path = staging_db_path(db_path)
+    src = sqlite3.connect(staging_path)
+    try:
+        src.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        dst = sqlite3.connect(db_path, timeout=30)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    _remove_db_files(staging_path)
+
+
+def get_harvest_checkpoint(db_path, server_url):
+    """
+    中断したカタログ取得のチェックポイントを返す（無ければNone）
+    戻り値: {'mode', 'high_water_mark', 'started', 'harvest_filter', 'shards': [(shard, next_offset, total), ...]}
+    shardはfq文字列（分割なしの全件取得はNone）、totalは未取得ならNone
+    harvest_filterは開始時の絞り込み条件（記録の無い古いチェックポイントはNone）
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'harvest_runs'")
+        if c.fetchone() is None:
+            return None
+        # harvest_filter列が無い古いステージングDBでも読めるよう、列名で取り出す
+        c.execute('SELECT * FROM harvest_runs WHERE server_url = ?', (server_url,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        run = dict(zip([column[0] for column in c.description], row))
+        c.execute(
+            'SELECT shard, next_offset, total FROM harvest_checkpoints WHERE server_url = ? ORDER BY seq',
+            (server_url,)
+        )
+        shards = [(shard or None, next_offset, total) for shard, next_offset, total in c.fetchall()]
+        return {
+            'mode': run.get('mode'),
+            'high_water_mark': run.get('high_water_mark'),
+            'started': run.get('started'),
+            'harvest_filter': run.get('harvest_filter'),
+            'shards': shards,
+        }
+    finally:
+        conn.close()
+
+
+def start_harvest_checkpoint(db_path, server_url, mode, high_water_mark, shards, harvest_filter=None):
+    """
+    カタログ取得の開始時にチェックポイントを作成する（既存のものは置き換える）
+    harvest_filter: 取得時の絞り込み条件（条件が変わったら再開しないよう記録する）
+    """
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    conn = sqlite3.connect(db_path)
+    try:
+        c = conn.cursor()
+        _create_tables(c)
+        c.execute('DELETE FROM harvest_checkpoints WHERE server_url = ?', (server_url,))
+        c.execute(
+            'INSERT OR REPLACE INTO harvest_runs (server_url, mode, high_water_mark, started, harvest_filter) VALUES (?, ?, ?, ?, ?)',
+            (server_url, mode, high_water_mark, now, harvest_filter or '')
+        )
+        c.executemany(
+            'INSERT INTO harvest_checkpoints (server_url, seq, shard, next_offset, total) VALUES (?, ?, ?, 0, NULL)',
+            [(server_url, seq, shard or '') for seq, shard in enumerate(shards)]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def update_harvest_checkpoint(db_path, server_url, shard, next_offset, total):
+    """シャードの書き込み済みオフセットを記録する"""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(
+            'UPDATE harvest_checkpoints SET next_offset = ?, total = ? WHERE server_url = ? AND shard = ?',
+            (next_offset, total, server_url, shard or '')
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def clear_harvest_checkpoint(db_path, server_url):
+    """取得完了時（または全件取得のやり直し時）にチェックポイントを削除する"""
+    conn = sqlite3.connect(db_path)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'harvest_runs'")
+        if c.fetchone() is None:
+            return
+        c.execute('DELETE FROM harvest_checkpoints WHERE server_url = ?', (server_url,))
+        c.execute('DELETE FROM harvest_runs WHERE server_url = ?', (server_url,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_cached_package_ids(db_path):
+    """キャッシュ済みパッケージIDの集合を返す"""
+    conn = sqlite3.connect(db_path)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'packages'")
+        if c.fetchone() is None:
+            return set()
+        c.execute('SELECT id FROM packages')
+        return set(row[0] for row in c.fetchall())
+    finally:
+        conn.close()
+
+
+def delete_packages(db_path, package_ids, batch_size=1000):
+    """
+    サーバーから消えたパッケージを、リソース・グループ対応・FTSの行とあわせて削除する
+    戻り値: 削除したパッケージ数
+    """
+    deleted = 0
+    conn = connect_for_write(db_path)
+    try:
+        c = conn.cursor()
+        fts = has_fts(c)
+        for batch in _batched(package_ids, batch_size):
+            ids = [(package_id,) for package_id in batch]
+            if fts:
+                c.executemany('DELETE FROM packages_fts WHERE rowid = (SELECT rowid FROM packages WHERE id = ?)', ids)
+            c.executemany('DELETE FROM resources WHERE package_id = ?', ids)
+            c.executemany('DELETE FROM package_groups WHERE package_id = ?', ids)
+            c.executemany('DELETE FROM packages WHERE id = ?', ids)
+            deleted += len(ids)
+        if deleted:
+            _bump_generation(c)
+        conn.commit()
+    finally:
+        conn.close()
+    return deleted
+
 
 def save_ckan_groups_to_sqlite(db_path, groups):
     """
     CKANグループリストをSQLiteに保存
     """
     conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS groups (
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        title TEXT,
-        description TEXT,
-        raw_json TEXT
-    )''')
-    c.execute('DELETE FROM groups')
-    for group in groups:
-        c.execute('''INSERT OR REPLACE INTO groups (id, name, title, description, raw_json) VALUES (?, ?, ?, ?, ?)''',
-            (
-                group.get('id'),
-                group.get('name'),
-                group.get('title'),
-                group.get('description'),
-                json.dumps(group, ensure_ascii=False)
+    try:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS groups (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            title TEXT,
+            description TEXT,
+            raw_json TEXT
+        )''')
+        c.execute('DELETE FROM groups')
+        for group in groups:
+            c.execute('''INSERT OR REPLACE INTO groups (id, name, title, description, raw_json) VALUES (?, ?, ?, ?, ?)''',
+                (
+                    group.get('id'),
+                    group.get('name'),
+                    group.get('title'),
+                    group.get('description'),
+                    json.dumps(group, ensure_ascii=False)
+                )
             )
-        )
-    conn.commit()
-    conn.close()
+        conn.commit()
+    finally:
+        conn.close()
 
 if __name__ == '__main__':
     # 例: all_results = ... (全データセットのリスト)
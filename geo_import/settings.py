@@ -14,6 +14,10 @@ class Settings:
         self.debug = True
         self.results_limit = 50  # 検索結果の表示件数制限
         self.request_timeout = 15  # HTTP要求のタイムアウト秒数
+        self.http_max_retries = 4  # 一時的なエラー（タイムアウト・429・5xx）時の再試行回数
+        self.download_concurrency = 4  # リソースの同時ダウンロード数
+        self.download_host_concurrency = 2  # 同一ホストからの同時ダウンロード数
+        self.http_cache = True  # カタログAPIの応答をキャッシュし、条件付きリクエストで再検証する
         self.ckan_url = None
         self.selected_ckan_servers = ''
         self.custom_servers = {}
@@ -21,6 +25,13 @@ class Settings:
         self.cache_dir = None
         self.boxdrive_support = True  # BoxDriveサポートを有効化
         self.long_path_support = True  # 長いパス名対応を有効化
+        self.search_tokenizer = 'trigram'  # 全文検索インデックスのトークン化方式（trigram/bigram/unicode61）
+        self.harvest_concurrency = 4  # カタログ取得時の同一ホストへの同時リクエスト数
+        self.harvest_shard_strategy = 'auto'  # カタログ取得のシャード分割方式（auto/none/organization/metadata_modified/id_prefix）
+        self.harvest_profile = 'light'  # カタログ取得で要求する項目（light: 検索・一覧に必要な項目のみ / full: 全項目）
+        self.harvest_geo_only = False  # 地理空間データのリソースを持つデータセットだけを取得する
+        self.harvest_geo_formats = 'SHP,Shapefile,GeoJSON,GPKG,GeoPackage,KML,KMZ,GML,WMS,WFS,CSV'  # 地理空間データとみなすリソース形式（カンマ区切り）
+        self.harvest_host_wait = 300  # カタログ取得中、遮断中のホストの回復を1ページあたり待つ最大秒数
         self.DLG_CAPTION = u'geo_import'
         self.KEY_CACHE_DIR = 'geo_import/cache_dir'
         self.KEY_CKAN_API = 'geo_import/ckan_api'
@@ -31,6 +42,17 @@ class Settings:
         self.KEY_SHOW_DEBUG_INFO = 'geo_import/show_debug_info'
         self.KEY_BOXDRIVE_SUPPORT = 'geo_import/boxdrive_support'
         self.KEY_LONG_PATH_SUPPORT = 'geo_import/long_path_support'
+        self.KEY_SEARCH_TOKENIZER = 'geo_import/search_tokenizer'
+        self.KEY_HARVEST_CONCURRENCY = 'geo_import/harvest_concurrency'
+        self.KEY_HARVEST_SHARD_STRATEGY = 'geo_import/harvest_shard_strategy'
+        self.KEY_HARVEST_PROFILE = 'geo_import/harvest_profile'
+        self.KEY_HARVEST_GEO_ONLY = 'geo_import/harvest_geo_only'
+        self.KEY_HARVEST_GEO_FORMATS = 'geo_import/harvest_geo_formats'
+        self.KEY_HARVEST_HOST_WAIT = 'geo_import/harvest_host_wait'
+        self.KEY_HTTP_MAX_RETRIES = 'geo_import/http_max_retries'
+        self.KEY_DOWNLOAD_CONCURRENCY = 'geo_import/download_concurrency'
+        self.KEY_DOWNLOAD_HOST_CONCURRENCY = 'geo_import/download_host_concurrency'
+        self.KEY_HTTP_CACHE = 'geo_import/http_cache'
         self.version = self._determine_version()
 
     def load(self):
@@ -44,6 +66,26 @@ class Settings:
         # BoxDriveサポートと長いパス名対応の設定を読み込み
         self.boxdrive_support = qgis_settings.value(self.KEY_BOXDRIVE_SUPPORT, True, bool)
         self.long_path_support = qgis_settings.value(self.KEY_LONG_PATH_SUPPORT, True, bool)
+        # 全文検索のトークン化方式（日本語は単語境界が無いためtrigram/bigramを推奨）
+        self.search_tokenizer = qgis_settings.value(self.KEY_SEARCH_TOKENIZER, 'trigram')
+        if self.search_tokenizer not in ('trigram', 'bigram', 'unicode61'):
+            self.search_tokenizer = 'trigram'
+        # カタログ取得の並列数（公開ポータルに負荷をかけすぎないよう1～8に制限）
+        self.harvest_concurrency = min(8, max(1, qgis_settings.value(self.KEY_HARVEST_CONCURRENCY, 4, int)))
+        self.harvest_shard_strategy = qgis_settings.value(self.KEY_HARVEST_SHARD_STRATEGY, 'auto')
+        if self.harvest_shard_strategy not in ('auto', 'none', 'organization', 'metadata_modified', 'id_prefix'):
+            self.harvest_shard_strategy = 'auto'
+        self.harvest_profile = qgis_settings.value(self.KEY_HARVEST_PROFILE, 'light')
+        if self.harvest_profile not in ('light', 'full'):
+            self.harvest_profile = 'light'
+        self.harvest_geo_only = qgis_settings.value(self.KEY_HARVEST_GEO_ONLY, False, bool)
+        self.harvest_geo_formats = qgis_settings.value(self.KEY_HARVEST_GEO_FORMATS, self.harvest_geo_formats) or self.harvest_geo_formats
+        self.harvest_host_wait = min(3600, max(0, qgis_settings.value(self.KEY_HARVEST_HOST_WAIT, 300, int)))
+        self.http_max_retries = min(10, max(0, qgis_settings.value(self.KEY_HTTP_MAX_RETRIES, 4, int)))
+        # リソースの並列ダウンロード数（全体1～16、同一ホスト1～6: Qtのホストごとの接続数上限が6）
+        self.download_concurrency = min(16, max(1, qgis_settings.value(self.KEY_DOWNLOAD_CONCURRENCY, 4, int)))
+        self.download_host_concurrency = min(6, max(1, qgis_settings.value(self.KEY_DOWNLOAD_HOST_CONCURRENCY, 2, int)))
+        self.http_cache = qgis_settings.value(self.KEY_HTTP_CACHE, True, bool)
         # サーバリストはキャッシュフォルダに保存
         if not self.cache_dir:
             # デフォルトキャッシュディレクトリ
@@ -103,6 +145,17 @@ class Settings:
         qgis_settings.setValue(self.KEY_SHOW_DEBUG_INFO, self.debug)
         qgis_settings.setValue(self.KEY_BOXDRIVE_SUPPORT, self.boxdrive_support)
         qgis_settings.setValue(self.KEY_LONG_PATH_SUPPORT, self.long_path_support)
+        qgis_settings.setValue(self.KEY_SEARCH_TOKENIZER, self.search_tokenizer)
+        qgis_settings.setValue(self.KEY_HARVEST_CONCURRENCY, self.harvest_concurrency)
+        qgis_settings.setValue(self.KEY_HARVEST_SHARD_STRATEGY, self.harvest_shard_strategy)
+        qgis_settings.setValue(self.KEY_HARVEST_PROFILE, self.harvest_profile)
+        qgis_settings.setValue(self.KEY_HARVEST_GEO_ONLY, self.harvest_geo_only)
+        qgis_settings.setValue(self.KEY_HARVEST_GEO_FORMATS, self.harvest_geo_formats)
+        qgis_settings.setValue(self.KEY_HARVEST_HOST_WAIT, self.harvest_host_wait)
+        qgis_settings.setValue(self.KEY_HTTP_MAX_RETRIES, self.http_max_retries)
+        qgis_settings.setValue(self.KEY_DOWNLOAD_CONCURRENCY, self.download_concurrency)
+        qgis_settings.setValue(self.KEY_DOWNLOAD_HOST_CONCURRENCY, self.download_host_concurrency)
+        qgis_settings.setValue(self.KEY_HTTP_CACHE, self.http_cache)
         # サーバリストはキャッシュフォルダに保存
         if not self.cache_dir:
             self.cache_dir = os.path.join(os.path.expanduser('~'), '.geo_import_cache')
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""CkanHarvesterのテスト（差分同期・再開・削除検出など。偽のCKANコネクタを使う。QGISのPython環境で実行する）"""
+
+import copy
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from geo_import.ckan_harvester import CkanHarvester
+    from geo_import.ckan_harvester import _solr_date
+    from geo_import.ckanconnector import CkanConnector
+    from geo_import.httpcall import RequestsExceptionHostUnavailable
+    from geo_import.save_ckan_to_sqlite import get_harvest_checkpoint
+    from geo_import.save_ckan_to_sqlite import get_sync_state
+except ImportError:
+    # QGIS（qgis.core）が無い環境ではスキップする
+    CkanHarvester = None
+
+
+SERVER_URL = 'http://example.com/api/3/'
+
+
+class FakeUtil:
+
+    def __init__(self):
+        self.warnings = []
+        self.errors = []
+
+    def msg_log_debug(self, msg):
+        pass
+
+    def msg_log_warning(self, msg):
+        self.warnings.append(msg)
+
+    def msg_log_error(self, msg):
+        self.errors.append(msg)
+
+    def tr(self, msg):
+        return msg
+
+
+class FakeConnector:
+    """
+    メモリ上のカタログに対してpackage_searchに答える
+    fqは取得で使う条件（res_format・metadata_modifiedの範囲・IDの先頭文字）だけを解釈する
+    """
+
+    SHARD_STRATEGIES = CkanConnector.SHARD_STRATEGIES if CkanHarvester else ()
+    get_harvest_shards = CkanConnector.get_harvest_shards if CkanHarvester else None
+
+    def __init__(self, packages):
+        self.util = FakeUtil()
+        self.packages = {pkg['id']: pkg for pkg in packages}
+        self.calls = []
+        # (start, 回数) -> 返すエラー（package_searchの失敗を再現する）
+        self.failures = {}
+        # 各検索の後に呼ぶ関数（取得中のカタログの更新を再現する）
+        self.after_search = None
+
+    def _match(self, pkg, fq):
+        if not fq:
+            return True
+        bound = re.search(r'metadata_modified:\[(\S+) TO \*\]', fq)
+        if bound and _solr_date(pkg['metadata_modified']) < bound.group(1):
+            return False
+        formats = re.search(r'res_format:\(([^)]*)\)', fq)
+        if formats and not set(re.findall(r'"([^"]*)"', formats.group(1))) & set(r['format'] for r in pkg['resources']):
+            return False
+        prefix = re.search(r'(?<!-)id:(\w)\*', fq)
+        if prefix and not pkg['id'].startswith(prefix.group(1)):
+            return False
+        excluded = re.search(r'-id:\(([^)]*)\)', fq)
+        if excluded and any(pkg['id'].startswith(p.rstrip('*')) for p in excluded.group(1).split(' OR ')):
+            return False
+        return True
+
+    def package_search(self, text, groups=None, page=None, rows=None, start=None, fq=None, sort=None, fl=None, facet_fields=None, cache=False):
+        self.calls.append({'start': start, 'rows': rows, 'fq': fq, 'fl': fl})
+        key = (start, len([c for c in self.calls if c['start'] == start and c['fl'] == fl]))
+        if fl != 'id' and key in self.failures:
+            return False, self.failures[key]
+        matched = [pkg for pkg in self.packages.values() if self._match(pkg, fq)]
+        if sort == 'id asc':
+            matched.sort(key=lambda pkg: pkg['id'])
+        else:
+            matched.sort(key=lambda pkg: (pkg['metadata_modified'], pkg['id']))
+        result = {'count': len(matched), 'results': copy.deepcopy(matched[start:start + rows])}
+        if self.after_search is not None:
+            self.after_search(self)
+        return True, result
+
+
+def _package(package_id, modified, fmt='GeoJSON', title=None):
+    return {
+        'id': package_id,
+        'name': package_id,
+        'title': title or package_id,
+        'notes': '',
+        'metadata_modified': modified,
+        'resources': [{'id': package_id + '-r1', 'format': fmt, 'url': 'http://example.com/{0}.dat'.format(package_id)}],
+    }
+
+
+@unittest.skipIf(CkanHarvester is None, 'QGISのPython環境が必要です')
+class CkanHarvesterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'cache.db')
+        self.settings = types.SimpleNamespace(
+            ckan_url=SERVER_URL,
+            search_tokenizer='unicode61',
+            request_timeout=15,
+            harvest_concurrency=1,
+            harvest_shard_strategy='none',
+            harvest_profile='full',
+            harvest_geo_only=False,
+            harvest_geo_formats='GeoJSON',
+            harvest_host_wait=300,
+        )
+        self.cc = FakeConnector([
+            _package('p{0}'.format(i), '2024-01-0{0}T00:00:00'.format(i), fmt='GeoJSON' if i % 2 else 'CSV')
+            for i in range(1, 7)
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _harvester(self):
+        harvester = CkanHarvester(self.settings, FakeUtil(), self.cc, self.db_path)
+        harvester.ROWS_PER_PAGE = 2
+        harvester.MIN_ROWS_PER_PAGE = 1
+        return harvester
+
+    def _cached(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return dict(conn.execute('SELECT id, title FROM packages').fetchall())
+        finally:
+            conn.close()
+
+    def test_full_then_delta(self):
+        ok, result = self._harvester().harvest()
+        self.assertTrue(ok)
+        self.assertEqual((result['mode'], result['packages'], result['completed']), ('full', 6, True))
+        self.assertEqual(get_sync_state(self.db_path, SERVER_URL)['high_water_mark'], '2024-01-06T00:00:00')
+
+        # 更新・追加されたものだけを取得する
+        self.cc.packages['p2'] = _package('p2', '2024-02-01T00:00:00', title='updated')
+        self.cc.packages['p7'] = _package('p7', '2024-02-02T00:00:00')
+        self.cc.calls = []
+        ok, result = self._harvester().harvest()
+        self.assertTrue(ok)
+        self.assertEqual((result['mode'], result['packages'], result['completed']), ('delta', 3, True))
+        self.assertIn('metadata_modified:[2024-01-06T00:00:00Z TO *]', self.cc.calls[0]['fq'])
+        cached = self._cached()
+        self.assertEqual(len(cached), 7)
+        self.assertEqual(cached['p2'], 'updated')
+        self.assertEqual(get_sync_state(self.db_path, SERVER_URL)['high_water_mark'], '2024-02-02T00:00:00')
+
+    def test_delta_reconciles_deleted_packages(self):
+        self._harvester().harvest()
+        del self.cc.packages['p3']
+        self.cc.calls = []
+        ok, result = self._harvester().harvest()
+        self.assertTrue(ok)
+        self.assertEqual(result['deleted'], 1)
+        # 差分取得ではID一覧（fl=id）を取得して削除を検出する
+        self.assertTrue(any(call['fl'] == 'id' for call in self.cc.calls))
+        self.assertNotIn('p3', self._cached())
+
+    def test_short_fetch_uses_id_listing(self):
+        # 先頭ページの取得後にp2が更新されると、以降のページがずれてp3を取りこぼす
+        # 取りこぼしたIDは削除扱いにせず、ハイウォーターマークも記録しない
+        def update_p2(cc):
+            if len(cc.calls) == 1:
+                cc.packages['p2'] = _package('p2', '2024-02-01T00:00:00')
+        self.cc.after_search = update_p2
+        ok, result = self._harvester().harvest()
+        self.assertTrue(ok)
+        self.assertTrue(result['completed'])
+        self.assertEqual(result['deleted'], 0)
+        self.assertTrue(any(call['fl'] == 'id' for call in self.cc.calls))
+        self.assertIsNone(get_sync_state(self.db_path, SERVER_URL)['high_water_mark'])
+
+    def test_resume_after_cancel(self):
+        ok, result = self._harvester().harvest(progress_callback=lambda page, max_page, results: page < 2)
+        self.assertTrue(ok)
+        self.assertFalse(result['completed'])
+        # 中断してもキャッシュDBは置き換わらず、ステージングDBにチェックポイントが残る
+        self.assertFalse(os.path.exists(self.db_path))
+        harvester = self._harvester()
+        checkpoint = get_harvest_checkpoint(harvester.db_path, SERVER_URL)
+        offset = checkpoint['shards'][0][1]
+        self.assertGreater(offset, 0)
+
+        self.cc.calls = []
+        ok, result = harvester.harvest()
+        self.assertTrue(ok)
+        self.assertTrue(result['completed'])
+        self.assertTrue(result['resumed'])
+        self.assertEqual(self.cc.calls[0]['start'], offset)
+        self.assertEqual(len(self._cached()), 6)
+        self.assertIsNone(get_harvest_checkpoint(self.db_path, SERVER_URL))
+
+    def test_resume_discarded_when_filter_changes(self):
+        self.settings.harvest_geo_only = True
+        self._harvester().harvest(progress_callback=lambda page, max_page, results: False)
+        # 絞り込み条件を変えたら中断した取得は再開せず、全件取得し直す
+        self.settings.harvest_geo_only = False
+        ok, result = self._harvester().harvest()
+        self.assertTrue(ok)
+        self.assertEqual((result['mode'], result['resumed'], result['completed']), ('full', False, True))
+        self.assertEqual(len(self._cached()), 6)
+        self.assertEqual(get_sync_state(self.db_path, SERVER_URL)['harvest_filter'], '')
+
+    def test_geo_only_filter(self):
+        self.settings.harvest_geo_only = True
+        ok, result = self._harvester().harvest()
+        self.assertTrue(ok)
+        self.assertEqual(sorted(self._cached()), ['p1', 'p3', 'p5'])
+
+    def test_id_prefix_shards(self):
+        self.settings.harvest_shard_strategy = 'auto'
+        self.cc.packages = {pkg_id: _package(pkg_id, '2024-01-01T00:00:00') for pkg_id in ('0a', '1b', '1c', 'fd', 'zz')}
+        harvester = self._harvester()
+        harvester.SHARD_THRESHOLD = 3
+        ok, result = harvester.harvest()
+        self.assertTrue(ok)
+        self.assertTrue(result['completed'])
+        self.assertEqual(len({call['fq'] for call in self.cc.calls if call['fl'] != 'id' and call['rows']}), 17)
+        self.assertEqual(sorted(self._cached()), ['0a', '1b', '1c', 'fd', 'zz'])
+
+    def test_host_unavailable_page_is_retried(self):
+        # 遮断中で送れなかったページは分割せずに同じページを取り直す
+        self.cc.failures[(2, 1)] = RequestsExceptionHostUnavailable('open', 5)
+        harvester = self._harvester()
+        with mock.patch.object(harvester, '_sleep', return_value=True) as sleep:
+            ok, result = harvester.harvest()
+        self.assertTrue(ok)
+        self.assertTrue(result['completed'])
+        sleep.assert_called_once_with(5)
+        self.assertEqual([call['rows'] for call in self.cc.calls if call['start'] == 2], [2, 2])
+        self.assertEqual(len(self._cached()), 6)
+
+    def test_host_unavailable_wait_budget(self):
+        # 待ち時間の上限を超えたらエラーとして打ち切り、チェックポイントを残す
+        self.settings.harvest_host_wait = 8
+        for attempt in range(1, 10):
+            self.cc.failures[(2, attempt)] = RequestsExceptionHostUnavailable('open', 5)
+        harvester = self._harvester()
+        with mock.patch.object(harvester, '_sleep', return_value=True):
+            ok, result = harvester.harvest()
+        self.assertTrue(ok)
+        self.assertFalse(result['completed'])
+        self.assertIn('open', result['error'])
+        self.assertEqual(len([call for call in self.cc.calls if call['start'] == 2]), 2)
+        self.assertIsNotNone(get_harvest_checkpoint(harvester.db_path, SERVER_URL))
+
+
+if __name__ == '__main__':
+    unittest.main()
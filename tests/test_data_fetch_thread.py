@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""DataFetchThreadのページング（キーセット・OFFSET・件数）のテスト（QGISのPython環境で実行する）"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from geo_import.geo_import_dialog import DataFetchThread
+    from geo_import.save_ckan_to_sqlite import save_ckan_packages_to_sqlite
+except ImportError:
+    # QGIS（qgis.PyQt）が無い環境ではスキップする
+    DataFetchThread = None
+
+
+ALL_FORMATS = 'すべて'
+
+
+def _package(i):
+    return {
+        'id': 'p{0:02d}'.format(i),
+        'name': 'p{0:02d}'.format(i),
+        'title': 'river map {0}'.format(i) if i % 2 else 'station list {0}'.format(i),
+        'notes': '',
+        'metadata_modified': '2024-01-01T00:00:00',
+        'groups': [{'name': 'g1'}] if i % 3 == 0 else [],
+        'resources': [{'id': 'r{0}'.format(i), 'format': 'GeoJSON' if i % 2 else 'CSV', 'url': 'http://example.com/{0}'.format(i)}],
+    }
+
+
+@unittest.skipIf(DataFetchThread is None, 'QGISのPython環境が必要です')
+class DataFetchThreadTest(unittest.TestCase):
+
+    LIMIT = 3
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'cache.db')
+        save_ckan_packages_to_sqlite(self.db_path, [_package(i) for i in range(1, 11)], 'unicode61')
+        DataFetchThread._count_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _fetch(self, page, page_key=None, search_txt=None, format_text=ALL_FORMATS, group_names=None):
+        results = []
+        thread = DataFetchThread(
+            self.db_path, format_text, format_text.lower(), page, self.LIMIT,
+            search_txt=search_txt, group_names=group_names, page_key=page_key
+        )
+        thread.result_ready.connect(lambda *args: results.append(args))
+        thread.run()
+        page_results, result_count, page_count, total_resource_count, next_key = results[0]
+        return [pkg['id'] for pkg in page_results], result_count, page_count, total_resource_count, next_key
+
+    def _pages(self, **kwargs):
+        """キーセットで順に送ったページと、OFFSETで取得したページ"""
+        keyset = []
+        offset = []
+        page_key = None
+        for page in range(1, 5):
+            ids, result_count, page_count, _, page_key = self._fetch(page, page_key, **kwargs)
+            keyset.append(ids)
+            offset.append(self._fetch(page, **kwargs)[0])
+            if page_key is None:
+                break
+        return keyset, offset, result_count, page_count
+
+    def test_keyset_pages_match_offset_pages(self):
+        keyset, offset, result_count, page_count = self._pages()
+        self.assertEqual(keyset, offset)
+        self.assertEqual((result_count, page_count), (10, 4))
+        ids = [pkg_id for ids in keyset for pkg_id in ids]
+        self.assertEqual(ids, ['p{0:02d}'.format(i) for i in range(1, 11)])
+
+    def test_fts_keyset_pages_match_offset_pages(self):
+        keyset, offset, result_count, page_count = self._pages(search_txt='river')
+        self.assertEqual(keyset, offset)
+        self.assertEqual((result_count, page_count), (5, 2))
+        self.assertEqual(sorted(pkg_id for ids in keyset for pkg_id in ids), ['p01', 'p03', 'p05', 'p07', 'p09'])
+
+    def test_format_and_group_filters(self):
+        ids, result_count, _, total_resource_count, _ = self._fetch(1, format_text='CSV', group_names=['g1'])
+        self.assertEqual(ids, ['p06'])
+        self.assertEqual((result_count, total_resource_count), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
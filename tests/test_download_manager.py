@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""DownloadManagerのテスト（同時実行数の上限・サイズ確認の保留。偽のコネクタを使う。QGISのPython環境で実行する）"""
+
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from geo_import.download_manager import DownloadManager
+except ImportError:
+    # QGIS（qgis.PyQt）が無い環境ではスキップする
+    DownloadManager = None
+
+
+class FakeUtil:
+
+    def msg_log_debug(self, msg):
+        pass
+
+
+class FakeRequest:
+
+    def __init__(self, url):
+        self.url = url
+        self.aborted = False
+        self.callbacks = []
+        self.downloadProgress = types.SimpleNamespace(connect=lambda slot: None)
+
+    def add_done_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def abort(self):
+        self.aborted = True
+
+    def finish(self):
+        for callback in self.callbacks:
+            callback(None)
+
+
+class FakeConnector:
+    """start_downloadで転送中のリクエストを返し、finishで完了させる"""
+
+    def __init__(self):
+        self.requests = {}
+        self.size_callbacks = {}
+
+    def start_download(self, url, dest_file, delete, size_callback=None):
+        request = FakeRequest(url)
+        self.requests[url] = request
+        self.size_callbacks[url] = size_callback
+        return True, '', None, request
+
+    def finish_download(self, request, dest_file):
+        if request.aborted:
+            return False, 'aborted', None
+        return True, '', dest_file
+
+
+@unittest.skipIf(DownloadManager is None, 'QGISのPython環境が必要です')
+class DownloadManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cc = FakeConnector()
+        settings = types.SimpleNamespace(download_concurrency=3, download_host_concurrency=2)
+        self.manager = DownloadManager(settings, FakeUtil(), self.cc)
+        self.finished = []
+        self.all_finished = []
+        self.manager.downloadFinished.connect(lambda job, ok, err, file_name: self.finished.append((job['url'], ok)))
+        self.manager.allFinished.connect(lambda: self.all_finished.append(True))
+
+    def _add(self, *urls):
+        for url in urls:
+            self.manager.add(url, '/tmp/' + url.rsplit('/', 1)[1], False)
+
+    def test_concurrency_limits(self):
+        self._add('http://a/1', 'http://a/2', 'http://a/3', 'http://b/1', 'http://b/2')
+        self.manager.start()
+        # 全体3件、同一ホスト2件まで（上限のホストは飛ばしてキューの後ろから開始する）
+        self.assertEqual(sorted(self.cc.requests), ['http://a/1', 'http://a/2', 'http://b/1'])
+        self.cc.requests['http://a/1'].finish()
+        self.assertEqual(sorted(self.cc.requests), ['http://a/1', 'http://a/2', 'http://a/3', 'http://b/1'])
+        for url in ('http://a/2', 'http://a/3', 'http://b/1'):
+            self.cc.requests[url].finish()
+        self.assertIn('http://b/2', self.cc.requests)
+        self.cc.requests['http://b/2'].finish()
+        self.assertEqual(len(self.finished), 5)
+        self.assertTrue(all(ok for url, ok in self.finished))
+        self.assertEqual(self.all_finished, [True])
+
+    def test_size_answer_pending(self):
+        # サイズ確認の回答前に転送が終わっても完了にせず、拒否されたら中止扱いにする
+        self.manager.size_callback = lambda file_size, job: None
+        self._add('http://a/big')
+        self.manager.start()
+        self.cc.size_callbacks['http://a/big'](500.0)
+        self.cc.requests['http://a/big'].finish()
+        self.assertEqual(self.finished, [])
+        self.assertEqual(self.all_finished, [])
+        job = self.manager.jobs[0]
+        self.manager.size_answered(job, False)
+        self.assertTrue(self.cc.requests['http://a/big'].aborted)
+        self.assertEqual(self.finished, [('http://a/big', False)])
+        self.assertEqual(self.all_finished, [True])
+
+    def test_cancel(self):
+        self._add('http://a/1', 'http://a/2', 'http://a/3')
+        self.manager.start()
+        self.manager.cancel()
+        self.assertTrue(all(request.aborted for request in self.cc.requests.values()))
+        for request in list(self.cc.requests.values()):
+            request.finish()
+        # 未開始のものは取り消され、実行中のものだけが中止として完了する
+        self.assertEqual(sorted(self.finished), [('http://a/1', False), ('http://a/2', False)])
+        self.assertEqual(self.all_finished, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""save_ckan_to_sqliteの回帰テスト（標準ライブラリのみ: python -m unittest discover tests）"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# geo_import/__init__.pyはQGISを読み込むため、モジュールを直接読み込む
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'geo_import'))
+
+import save_ckan_to_sqlite  # noqa: E402
+
+
+def _package(package_id, title):
+    return {
+        'id': package_id,
+        'name': package_id,
+        'title': title,
+        'notes': '',
+        'metadata_modified': '2024-01-01T00:00:00',
+        'resources': [{'id': package_id + '-r1', 'format': 'CSV', 'url': 'http://example.com/a.csv'}],
+    }
+
+
+class SavePackagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_duplicate_ids_in_one_batch(self):
+        # 取得中に更新されたデータセットが同じバッチに2回現れても保存でき、後のものが残る
+        packages = [_package('p1', 'old title'), _package('p2', 'other'), _package('p1', 'new title')]
+        result = save_ckan_to_sqlite.save_ckan_packages_to_sqlite(self.db_path, packages, 'trigram')
+        self.assertEqual(result['packages'], 2)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute('SELECT id, title FROM packages ORDER BY id').fetchall()
+            self.assertEqual(rows, [('p1', 'new title'), ('p2', 'other')])
+            if save_ckan_to_sqlite.has_fts(conn.cursor()):
+                count = conn.execute('SELECT COUNT(*) FROM packages_fts').fetchone()[0]
+                self.assertEqual(count, 2)
+        finally:
+            conn.close()
+
+    def test_tokenizer_fallback_is_not_rebuilt(self):
+        # trigramが無いSQLiteではbigramで作成し、trigram指定の保存のたびに作り直さない
+        with mock.patch.object(save_ckan_to_sqlite, '_trigram_supported', False), \
+                mock.patch.object(save_ckan_to_sqlite, '_rebuild_fts', wraps=save_ckan_to_sqlite._rebuild_fts) as rebuild:
+            for i in range(3):
+                save_ckan_to_sqlite.save_ckan_packages_to_sqlite(self.db_path, [_package('p1', 'title {0}'.format(i))], 'trigram')
+            self.assertEqual(rebuild.call_count, 1)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            self.assertEqual(save_ckan_to_sqlite.get_fts_tokenizer(conn.cursor()), 'bigram')
+        finally:
+            conn.close()
+
+    def test_sync_state_not_advanced_after_short_fetch(self):
+        # 取りこぼしがあった同期ではハイウォーターマークを進めない（差分は前回のまま、全件は記録しない）
+        server = 'http://example.com/api/3/'
+        save_ckan_to_sqlite.save_ckan_packages_to_sqlite(self.db_path, [_package('p1', 'a')])
+        self.assertEqual(save_ckan_to_sqlite.update_sync_state(self.db_path, server, full_sync=True), '2024-01-01T00:00:00')
+        newer = dict(_package('p2', 'b'), metadata_modified='2024-02-01T00:00:00')
+        save_ckan_to_sqlite.save_ckan_packages_to_sqlite(self.db_path, [newer])
+        self.assertEqual(save_ckan_to_sqlite.update_sync_state(self.db_path, server, advance=False), '2024-01-01T00:00:00')
+        self.assertIsNone(save_ckan_to_sqlite.update_sync_state(self.db_path, server, full_sync=True, advance=False))
+        self.assertIsNone(save_ckan_to_sqlite.get_sync_state(self.db_path, server)['high_water_mark'])
+
+
+if __name__ == '__main__':
+    unittest.main()